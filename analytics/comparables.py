@@ -0,0 +1,380 @@
+import os
+import time
+
+import numpy as np
+
+from chl.playerseason import _parse_season_yr
+from common.db import _shard_tables, attached_shards, connect_federated, get_generation
+from common.profiling import profile_run
+
+
+INDEX_PATH = os.path.join(os.getcwd(), 'comparables.npz')
+FEATURES = ['goals_gp', 'assists_gp', 'points_gp', 'pim_gp', 's_gp', 'pp_points_gp', 'sh_points_gp', 'p_gp']
+TABLES = ('player_seasons', 'chl_player_seasons')
+LEAF_SIZE = 32
+REBUILD_FRACTION = 0.1  # Rebuild the tree once this fraction of the seasons are outside it or replaced
+BRUTE_FORCE_MAX = 20000  # Filters leaving fewer candidates than this are scanned directly, without the tree
+
+
+def _load_rows(conn, after=None):
+    """Load the per game stat vectors of the NHL and CHL player seasons saved in each shard after the given rowids
+
+    :param conn: federated database connection
+    :param after: {str: int} | None, league: rowid of the shard's player_seasons or chl_player_seasons table
+    :return: np.ndarray (n, 4) of str, np.ndarray (n,) of str, np.ndarray (n,) of int, np.ndarray (n, len(FEATURES)),
+        {str: int}
+        (league, id, year, season) keys, position groups, first year of each season, raw vectors, and the largest
+        rowid loaded from each shard
+    """
+    if after is None:
+        after = {}
+    keys, positions, eras, values = [], [], [], []
+    max_rowids = dict(after)
+    c = conn.cursor()
+    for league, schema in attached_shards(conn):
+        max_rowid = after.get(league, 0)
+        tables = _shard_tables(conn, schema)
+        if 'player_seasons' in tables:
+            c.execute(
+                "SELECT rowid, 'NHL', id, year, season_type, pos, gp, goals, assists, points, pim, s, ppp, shp, p_gp "
+                'FROM ' + schema + '.player_seasons WHERE rowid > ? AND gp > 0',
+                (max_rowid,))
+        elif 'chl_player_seasons' in tables:
+            c.execute(
+                'SELECT rowid, league, id, year, season_name, pos, gp, goals, assists, points, pim, s, '
+                'ppg + ppa, shg + sha, p_g FROM ' + schema + '.chl_player_seasons WHERE rowid > ? AND gp > 0',
+                (max_rowid,))
+        else:
+            continue
+        for row in c.fetchall():
+            max_rowid = max(max_rowid, row[0])
+            keys.append(row[1:5])
+            positions.append(_position_group(row[5]))
+            eras.append(int(row[3][:4]))
+            values.append(row[6:])
+        max_rowids[league] = max_rowid
+
+    block = np.array(values, dtype=float).reshape(len(values), 1 + len(FEATURES))  # None becomes nan
+    gp = block[:, :1]
+    raw = np.empty((len(values), len(FEATURES)))
+    raw[:, :-1] = block[:, 1:-1] / gp
+    raw[:, -1] = block[:, -1]  # P/GP as published
+    keys = np.array(keys, dtype=str).reshape(len(keys), 4)
+    return keys, np.array(positions, dtype=str), np.array(eras, dtype=int), raw, max_rowids
+
+
+def _position_group(pos):
+    """Return the position of a player season as one of 'C', 'L', 'R', 'D', 'G' or '' so both sites' codes compare
+
+    :param pos: str
+    :return: str
+    """
+    if pos is None or pos.strip() == '':
+        return ''
+    return pos.strip()[0].upper()
+
+
+def _build_tree(points, leaf_size=LEAF_SIZE):
+    """Build a KD-tree over <points>, splitting each node at the median of its widest dimension
+
+    :param points: np.ndarray (n, d)
+    :param leaf_size: int
+    :return: {str: np.ndarray} 'perm' orders the points so every node covers perm[node_start:node_end];
+        internal nodes have 'split_dim', 'split_value' and 'left'/'right' children, leaves have left == -1
+    """
+    perm = np.arange(len(points))
+    node_start, node_end, split_dim, split_value, left, right = [0], [len(points)], [-1], [0.0], [-1], [-1]
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        lo, hi = node_start[node], node_end[node]
+        if hi - lo <= leaf_size:
+            continue
+        sub = points[perm[lo:hi]]
+        spreads = sub.max(axis=0) - sub.min(axis=0)
+        dim = int(np.argmax(spreads))
+        if spreads[dim] == 0:  # Identical points
+            continue
+        mid = (hi - lo) // 2
+        perm[lo:hi] = perm[lo:hi][np.argpartition(sub[:, dim], mid)]
+        split_dim[node] = dim
+        split_value[node] = points[perm[lo + mid], dim]
+        for child_start, child_end in [(lo, lo + mid), (lo + mid, hi)]:
+            node_start.append(child_start)
+            node_end.append(child_end)
+            split_dim.append(-1)
+            split_value.append(0.0)
+            left.append(-1)
+            right.append(-1)
+            stack.append(len(node_start) - 1)
+        left[node], right[node] = len(node_start) - 2, len(node_start) - 1
+    return {
+        'perm': perm, 'node_start': np.array(node_start), 'node_end': np.array(node_end),
+        'split_dim': np.array(split_dim), 'split_value': np.array(split_value),
+        'left': np.array(left), 'right': np.array(right),
+    }
+
+
+def _merge_best(best_distances, best_indices, distances, indices, k):
+    """Return the <k> nearest of two candidate sets
+
+    :return: np.ndarray, np.ndarray
+    """
+    distances = np.concatenate((best_distances, distances))
+    indices = np.concatenate((best_indices, indices))
+    if len(distances) > k:
+        nearest = np.argpartition(distances, k - 1)[:k]
+        distances, indices = distances[nearest], indices[nearest]
+    return distances, indices
+
+
+class ComparablesIndex:
+    """KD-tree over standardized per game stat vectors of every player season.
+
+    Seasons saved after the tree was built are kept in a delta scanned directly, and seasons replaced since are
+    masked out, until the next full rebuild.
+    """
+
+    def __init__(self, keys, positions, eras, raw, max_rowids, generation):
+        self.means = np.nanmean(raw, axis=0) if len(raw) > 0 else np.zeros(len(FEATURES))
+        self.stds = np.nanstd(raw, axis=0) if len(raw) > 0 else np.ones(len(FEATURES))
+        self.stds[~(self.stds > 0)] = 1
+        self.keys = keys
+        self.positions = positions
+        self.eras = eras
+        self.vectors = self._standardize(raw)
+        self.num_indexed = len(raw)
+        self.deleted = np.zeros(len(raw), dtype=bool)
+        self.tree = _build_tree(self.vectors)
+        self.max_rowids = max_rowids
+        self.generation = generation
+        self._key_index = None
+
+    def _standardize(self, raw):
+        vectors = (raw - self.means) / self.stds
+        vectors[np.isnan(vectors)] = 0  # Missing stats count as average
+        return vectors
+
+    def key_index(self):
+        """Return a dict of (league, id, year, season) keys to their live row in the index"""
+        if self._key_index is None:
+            self._key_index = {}
+            for i, key in enumerate(self.keys.tolist()):
+                if not self.deleted[i]:
+                    self._key_index[tuple(key)] = i
+        return self._key_index
+
+    def append(self, keys, positions, eras, raw):
+        """Add seasons saved since the last update to the delta, masking out older versions of the same seasons"""
+        key_index = self.key_index()
+        for key in keys.tolist():
+            old = key_index.get(tuple(key))
+            if old is not None:
+                self.deleted[old] = True
+        start = len(self.keys)
+        self.keys = np.concatenate((self.keys, keys))
+        self.positions = np.concatenate((self.positions, positions))
+        self.eras = np.concatenate((self.eras, eras))
+        self.vectors = np.concatenate((self.vectors, self._standardize(raw)))
+        self.deleted = np.concatenate((self.deleted, np.zeros(len(keys), dtype=bool)))
+        for i, key in enumerate(keys.tolist()):
+            key_index[tuple(key)] = start + i
+
+    def needs_rebuild(self):
+        stale = (len(self.keys) - self.num_indexed) + int(self.deleted.sum())
+        return stale > REBUILD_FRACTION * max(self.num_indexed, 1)
+
+    def candidates(self, leagues=None, positions=None, era=None):
+        """Return a boolean mask of the live seasons matching the filters
+
+        :param leagues: [str] | None
+        :param positions: [str] | None, e.g. ['C', 'D']
+        :param era: (int, int) | None, first and last season start year
+        :return: np.ndarray
+        """
+        mask = ~self.deleted
+        if leagues is not None:
+            mask &= np.isin(self.keys[:, 0], leagues)
+        if positions is not None:
+            mask &= np.isin(self.positions, [_position_group(pos) for pos in positions])
+        if era is not None:
+            mask &= (self.eras >= era[0]) & (self.eras <= era[1])
+        return mask
+
+    def query(self, target, k, mask):
+        """Return the distances and rows of the <k> seasons nearest to <target> among those allowed by <mask>
+
+        :param target: np.ndarray (d,), standardized
+        :param k: int
+        :param mask: np.ndarray (n,) of bool
+        :return: np.ndarray, np.ndarray, nearest first
+        """
+        if int(mask.sum()) < BRUTE_FORCE_MAX:
+            indices = np.flatnonzero(mask)
+            distances = ((self.vectors[indices] - target) ** 2).sum(axis=1)
+            best_distances, best_indices = _merge_best(np.empty(0), np.empty(0, dtype=int), distances, indices, k)
+        else:
+            best_distances, best_indices = self._query_tree(target, k, mask)
+            delta = np.arange(self.num_indexed, len(self.keys))
+            delta = delta[mask[delta]]
+            distances = ((self.vectors[delta] - target) ** 2).sum(axis=1)
+            best_distances, best_indices = _merge_best(best_distances, best_indices, distances, delta, k)
+        order = np.argsort(best_distances)
+        return np.sqrt(best_distances[order]), best_indices[order]
+
+    def _query_tree(self, target, k, mask):
+        tree = self.tree
+        perm, node_start, node_end = tree['perm'], tree['node_start'], tree['node_end']
+        split_dim, split_value, left, right = tree['split_dim'], tree['split_value'], tree['left'], tree['right']
+        best_distances, best_indices = np.empty(0), np.empty(0, dtype=int)
+        worst = np.inf
+        stack = [(0, 0.0)]  # (node, lower bound of the squared distance to any of its points)
+        while stack:
+            node, bound = stack.pop()
+            if bound >= worst:
+                continue
+            if left[node] == -1:
+                indices = perm[node_start[node]:node_end[node]]
+                indices = indices[mask[indices]]
+                if len(indices) == 0:
+                    continue
+                distances = ((self.vectors[indices] - target) ** 2).sum(axis=1)
+                best_distances, best_indices = _merge_best(best_distances, best_indices, distances, indices, k)
+                if len(best_distances) == k:
+                    worst = best_distances.max()
+                continue
+            diff = target[split_dim[node]] - split_value[node]
+            if diff <= 0:
+                near, far = left[node], right[node]
+            else:
+                near, far = right[node], left[node]
+            stack.append((far, max(bound, diff * diff)))
+            stack.append((near, bound))
+        return best_distances, best_indices
+
+    def save(self, path=INDEX_PATH):
+        arrays = dict(('tree_' + name, array) for name, array in self.tree.items())
+        np.savez(
+            path + '.tmp.npz', means=self.means, stds=self.stds, keys=self.keys, positions=self.positions,
+            eras=self.eras, vectors=self.vectors, deleted=self.deleted, num_indexed=self.num_indexed,
+            max_rowid_leagues=np.array(sorted(self.max_rowids), dtype=str),
+            max_rowids=np.array([self.max_rowids[league] for league in sorted(self.max_rowids)], dtype=int),
+            generation=np.array(self.generation),
+            **arrays)
+        os.replace(path + '.tmp.npz', path)
+
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        with np.load(path) as data:
+            index = cls.__new__(cls)
+            index.means, index.stds = data['means'], data['stds']
+            index.keys, index.positions, index.eras = data['keys'], data['positions'], data['eras']
+            index.vectors, index.deleted = data['vectors'], data['deleted']
+            index.num_indexed = int(data['num_indexed'])
+            if 'max_rowid_leagues' in data.files:
+                index.max_rowids = dict(zip(data['max_rowid_leagues'].tolist(), data['max_rowids'].tolist()))
+            else:  # Built before the database was sharded: its rowids are meaningless now
+                index.max_rowids = None
+            index.generation = tuple(int(generation) for generation in data['generation'])
+            index.tree = dict((name[5:], data[name]) for name in data.files if name.startswith('tree_'))
+            index._key_index = None
+        return index
+
+
+def build_comparables_index(path=INDEX_PATH):
+    """Build the comparables index from every saved player season and persist it
+
+    :param path: str
+    :return: ComparablesIndex
+    """
+    conn = connect_federated()
+    c = conn.cursor()
+    start_time = time.time()
+    generation = get_generation(c, TABLES)
+    index = ComparablesIndex(*_load_rows(conn), generation=generation)
+    index.save(path)
+    conn.close()
+    print(str(index.num_indexed) + " seasons indexed. That took " + str(time.time() - start_time) + " seconds")
+    return index
+
+
+def update_comparables_index(path=INDEX_PATH):
+    """Bring the persisted index up to date after a crawl: add the seasons saved since it was last updated, and
+    rebuild it from scratch if it does not exist yet or too much of it has changed
+
+    :param path: str
+    :return: ComparablesIndex
+    """
+    if not os.path.exists(path):
+        return build_comparables_index(path)
+    index = ComparablesIndex.load(path)
+    if index.max_rowids is None:
+        return build_comparables_index(path)
+    conn = connect_federated()
+    c = conn.cursor()
+    generation = get_generation(c, TABLES)
+    if generation != index.generation:
+        keys, positions, eras, raw, max_rowids = _load_rows(conn, index.max_rowids)
+        index.append(keys, positions, eras, raw)
+        index.max_rowids, index.generation = max_rowids, generation
+        print(str(len(keys)) + " new seasons added to the comparables index")
+        if index.needs_rebuild():
+            conn.close()
+            return build_comparables_index(path)
+        index.save(path)
+    conn.close()
+    return index
+
+
+_loaded_index = None
+_loaded_mtime = None
+
+
+def _get_loaded_index():
+    """Return the persisted index, loading it again whenever it has been updated on disk
+
+    :return: ComparablesIndex
+    """
+    global _loaded_index, _loaded_mtime
+    mtime = os.path.getmtime(INDEX_PATH)
+    if _loaded_index is None or mtime != _loaded_mtime:
+        _loaded_index = ComparablesIndex.load()
+        _loaded_mtime = mtime
+    return _loaded_index
+
+
+def most_similar(league, id_, season, k=10, leagues=None, positions=None, era=None, index=None):
+    """Return the <k> player seasons most similar to a given one, by distance between standardized per game stats
+
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :param id_: str
+    :param season: str, the year and season type for the NHL (e.g. ('20152016', '2')), the season name otherwise
+    :param k: int
+    :param leagues: [str] | None, only consider seasons played in these leagues
+    :param positions: [str] | None, only consider seasons of players at these positions
+    :param era: (int, int) | None, only consider seasons starting in these years (inclusive)
+    :param index: ComparablesIndex | None, defaults to the persisted index
+    :return: [(float, str, str, str, str)] (distance, league, id, year, season), most similar first
+    """
+    if index is None:
+        index = _get_loaded_index()
+    if league == 'NHL':
+        year, season_type = season
+        key = ('NHL', id_, year, season_type)
+    else:
+        key = (league, id_, _parse_season_yr(season), season)
+    target_row = index.key_index().get(key)
+    assert target_row is not None, '{} is not in the comparables index'.format(key)
+
+    mask = index.candidates(leagues, positions, era)
+    mask[target_row] = False
+    distances, rows = index.query(index.vectors[target_row], k, mask)
+    results = []
+    for distance, row in zip(distances.tolist(), rows.tolist()):
+        results.append((distance,) + tuple(index.keys[row].tolist()))
+    return results
+
+
+if __name__ == '__main__':
+    with profile_run('comparables'):
+        update_comparables_index()
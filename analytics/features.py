@@ -0,0 +1,186 @@
+import time
+
+import numpy as np
+
+from analytics.seasonmatrix import AGE_CUTOFF
+from chl.playerseason import _parse_season_type
+from common.db import _shard_tables, attached_shards, connect_federated
+from common.profiling import profile_run
+
+
+DAYS_PER_YEAR = 365.25
+# Per shard: the season table, its season key, the page table and its draft columns
+SOURCES = [
+    ('player_seasons', "'NHL', s.id, s.year, s.season_type", 'player_pages',
+     'p.draft_year, p.draft_round, p.draft_overall'),
+    ('chl_player_seasons', 's.league, s.id, s.season_name, NULL', 'chl_player_pages',
+     'p.nhl_draft_year, p.nhl_draft_round, p.nhl_draft_overall'),
+]
+
+
+def _ensure_player_season_features_tables(c):
+    """Utility function for creating the player_season_features table, and feature_sources, the largest rowid of every
+    shard's season and page table it has been updated with
+
+    :param c: database cursor
+    :return:
+    """
+    c.execute('''CREATE TABLE IF NOT EXISTS player_season_features
+                 (
+                 league TEXT, id TEXT, season TEXT, season_type TEXT, start_year INTEGER, age REAL,
+                 height REAL, weight REAL, shoots TEXT,
+                 draft_year INTEGER, draft_round INTEGER, draft_overall INTEGER, years_since_draft INTEGER,
+                 PRIMARY KEY (league, id, season, season_type)
+                 )''')
+    c.execute('CREATE INDEX IF NOT EXISTS player_season_features_season '
+              'ON player_season_features (league, start_year, season_type)')
+    c.execute('CREATE INDEX IF NOT EXISTS player_season_features_draft ON player_season_features (draft_year)')
+    c.execute('''CREATE TABLE IF NOT EXISTS feature_sources
+                 (
+                 source TEXT PRIMARY KEY, max_rowid INTEGER
+                 )''')
+
+
+def _load_changed_rows(c, schema, season_table, key_sql, page_table, draft_sql, after_seasons, after_pages):
+    """Load the seasons of a shard saved after <after_seasons>, and every season of the players whose page was saved
+    after <after_pages>, each with the bio and draft columns of the player's page
+
+    :param page_table: str | None, None if the shard has no pages saved yet
+    :return: [tuple], (league, id, season, season_type, birth date, height, weight, shoots, draft year, draft round,
+        draft overall) rows
+    """
+    if page_table is None:
+        c.execute('SELECT ' + key_sql + ', NULL, NULL, NULL, NULL, NULL, NULL, NULL FROM ' + schema + '.' +
+                  season_table + ' s WHERE s.rowid > ?', (after_seasons,))
+        return c.fetchall()
+    page_join = (' LEFT JOIN ' + schema + '.' + page_table + ' p ON p.id = s.id' +
+                 (' AND p.league = s.league' if page_table == 'chl_player_pages' else ''))
+    select = ('SELECT ' + key_sql + ', p.birth_date, p.height, p.weight, p.shoots, ' + draft_sql + ' FROM ' +
+              schema + '.' + season_table + ' s' + page_join)
+    c.execute(select + ' WHERE s.rowid > ?', (after_seasons,))
+    rows = c.fetchall()
+    c.execute(
+        select + ' WHERE s.rowid <= ? AND s.id IN (SELECT id FROM ' + schema + '.' + page_table + ' WHERE rowid > ?)',
+        (after_seasons, after_pages))
+    return rows + c.fetchall()
+
+
+def _numbers(values):
+    """Return text columns (draft years, rounds, picks) as floats, nan where they are not a number
+
+    :param values: list
+    :return: np.ndarray
+    """
+    text = np.array(['' if value is None else str(value) for value in values], dtype=str)
+    numbers = np.full(len(text), np.nan)
+    digits = np.char.isdigit(text)
+    numbers[digits] = text[digits].astype(float)
+    return numbers
+
+
+def compute_features(rows):
+    """Compute the features of player seasons, every column at once
+
+    :param rows: [tuple], as loaded by _load_changed_rows
+    :return: {str: np.ndarray}, 'season_type' (CHL ones from the season name), 'start_year', 'age' (in years, on the
+        age cutoff date of the first year of the season), 'draft_year', 'draft_round', 'draft_overall' and
+        'years_since_draft', nan where unknown
+    """
+    seasons = np.array([row[2] for row in rows], dtype=str)
+    nhl = np.array([row[0] == 'NHL' for row in rows], dtype=bool)
+    # The first year of an NHL year (YYYYYYYY) or a CHL season name ('2015-16 Regular Season', but '2016 Playoffs')
+    start_years = seasons.astype('U4').astype(int)
+    start_years[~nhl & ~np.char.endswith(seasons.astype('U5'), '-')] -= 1
+
+    birth_text = np.array([row[4] if row[4] is not None else '' for row in rows], dtype=str)
+    births = np.full(len(rows), np.datetime64('NaT'), dtype='datetime64[D]')
+    known = (np.char.str_len(birth_text) == 10) & np.char.isdigit(birth_text.astype('U4'))
+    births[known] = birth_text[known].astype('datetime64[D]')
+    cutoffs = ((start_years - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (AGE_CUTOFF // 100 - 1))
+    cutoffs = cutoffs.astype('datetime64[D]') + (AGE_CUTOFF % 100 - 1)
+    ages = (cutoffs - births).astype(float) / DAYS_PER_YEAR
+    ages[~known] = np.nan
+
+    draft_years = _numbers([row[8] for row in rows])
+    return {
+        'season_type': np.array([row[3] if row[0] == 'NHL' else _parse_season_type(row[2]) for row in rows], dtype=str),
+        'start_year': start_years,
+        'age': ages,
+        'draft_year': draft_years,
+        'draft_round': _numbers([row[9] for row in rows]),
+        'draft_overall': _numbers([row[10] for row in rows]),
+        'years_since_draft': start_years - draft_years,
+    }
+
+
+def _to_db_values(array, integer=False):
+    """Return a numpy column as a list of python values, with nan as None
+
+    :param array: np.ndarray
+    :param integer: bool
+    :return: list
+    """
+    return [None if value != value else int(value) if integer else value for value in array.tolist()]
+
+
+def update_season_features():
+    """Bring player_season_features up to date with the seasons and pages saved since it was last updated, every
+    shard from the largest rowids of its tables recorded in feature_sources. Seasons replaced with INSERT OR REPLACE
+    get a new rowid, and are recomputed. A shard table whose rowids went back (rebuilt, see common.db.rebuild_table)
+    has the whole table rebuilt.
+
+    :return: int, player seasons computed
+    """
+    conn = connect_federated()
+    c = conn.cursor()
+    start_time = time.time()
+    _ensure_player_season_features_tables(c)
+    after = dict(c.execute('SELECT source, max_rowid FROM feature_sources').fetchall())
+
+    sources, max_rowids = [], {}
+    for league, schema in attached_shards(conn):
+        tables = _shard_tables(conn, schema)
+        for season_table, key_sql, page_table, draft_sql in SOURCES:
+            if season_table not in tables:
+                continue
+            if page_table not in tables:  # Once it is created, every season of the players with a page is loaded
+                page_table = None
+            sources.append((league, schema, season_table, key_sql, page_table, draft_sql))
+            for table in (season_table, page_table):
+                if table is None:
+                    continue
+                max_rowids[league + '.' + table] = c.execute(
+                    'SELECT IFNULL(MAX(rowid), 0) FROM ' + schema + '.' + table).fetchone()[0]
+    if any(max_rowids[source] < after.get(source, 0) for source in max_rowids):
+        print("A table was rebuilt, rebuilding player_season_features")
+        c.execute('DELETE FROM player_season_features')
+        after = {}
+
+    rows = []
+    for league, schema, season_table, key_sql, page_table, draft_sql in sources:
+        after_pages = after.get(league + '.' + page_table, 0) if page_table is not None else 0
+        rows += _load_changed_rows(c, schema, season_table, key_sql, page_table, draft_sql,
+                                   after.get(league + '.' + season_table, 0), after_pages)
+    if len(rows) > 0:
+        features = compute_features(rows)
+        columns = [
+            _to_db_values(features['start_year'], True), _to_db_values(features['age']),
+            [row[5] for row in rows], [row[6] for row in rows], [row[7] for row in rows],
+            _to_db_values(features['draft_year'], True), _to_db_values(features['draft_round'], True),
+            _to_db_values(features['draft_overall'], True), _to_db_values(features['years_since_draft'], True),
+        ]
+        c.executemany(
+            'INSERT OR REPLACE INTO player_season_features VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [row[:3] + (season_type,) + values
+             for row, season_type, values in zip(rows, features['season_type'].tolist(), zip(*columns))])
+    c.executemany('INSERT OR REPLACE INTO feature_sources VALUES (?, ?)', sorted(max_rowids.items()))
+    conn.commit()
+    conn.close()
+    print(str(len(rows)) + " player season features computed. That took " + str(time.time() - start_time) +
+          " seconds")
+    return len(rows)
+
+
+if __name__ == '__main__':
+    with profile_run('features'):
+        update_season_features()
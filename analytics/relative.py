@@ -0,0 +1,211 @@
+import time
+
+import numpy as np
+
+from chl.playerseason import _parse_season_type
+from common.db import connect_federated
+from common.profiling import profile_run
+
+
+STATS = ['goals', 'assists', 'points']
+
+
+def _create_player_season_relative_table(c):
+    """Utility function for creating/initializing the player_season_relative table
+
+    :param c: database cursor
+    :return:
+    """
+    c.execute('DROP TABLE IF EXISTS player_season_relative')
+    c.execute('''CREATE TABLE player_season_relative
+                 (
+                 league TEXT, id TEXT, year TEXT, season_type TEXT, season_name TEXT, gp INTEGER,
+                 goals INTEGER, assists INTEGER, points INTEGER,
+                 lg_goals_gp REAL, lg_assists_gp REAL, lg_points_gp REAL,
+                 goals_z REAL, assists_z REAL, points_z REAL,
+                 goals_pct REAL, assists_pct REAL, points_pct REAL,
+                 adj_goals REAL, adj_assists REAL, adj_points REAL,
+                 PRIMARY KEY (league, id, year, season_type)
+                 )''')
+    c.execute('CREATE INDEX player_season_relative_group ON player_season_relative (league, year, season_type)')
+
+
+def _load_season_block(c):
+    """Load the games played and STATS columns of every NHL and CHL player season in one pass
+
+    :param c: database cursor
+    :return: [(str, str, str, str, str)], np.ndarray, np.ndarray
+        (league, id, year, season_type, season_name) per row, games played (n,), and STATS (n, len(STATS)), with
+        missing values as nan
+    """
+    keys = []
+    values = []
+    c.execute('SELECT id, year, season_type, gp, goals, assists, points FROM player_seasons')
+    for row in c.fetchall():
+        keys.append(('NHL', row[0], row[1], row[2], None))
+        values.append(row[3:])
+    c.execute('SELECT league, id, year, season_name, gp, goals, assists, points FROM chl_player_seasons')
+    for row in c.fetchall():
+        keys.append((row[0], row[1], row[2], _parse_season_type(row[3]), row[3]))
+        values.append(row[4:])
+    block = np.array(values, dtype=float).reshape(len(values), 1 + len(STATS))  # None becomes nan
+    return keys, block[:, 0], block[:, 1:]
+
+
+def _group_sums(inverse, values, num_groups):
+    """Return the sum and the count of the non-nan <values> of every group
+
+    :param inverse: np.ndarray, group index of every row
+    :param values: np.ndarray
+    :param num_groups: int
+    :return: np.ndarray, np.ndarray
+    """
+    valid = ~np.isnan(values)
+    sums = np.bincount(inverse[valid], weights=values[valid], minlength=num_groups)
+    counts = np.bincount(inverse[valid], minlength=num_groups)
+    return sums, counts
+
+
+def _z_scores(inverse, values, num_groups):
+    """Return the z-score of every value within its group
+
+    :param inverse: np.ndarray
+    :param values: np.ndarray
+    :param num_groups: int
+    :return: np.ndarray
+    """
+    sums, counts = _group_sums(inverse, values, num_groups)
+    square_sums, _ = _group_sums(inverse, values ** 2, num_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        stds = np.sqrt(np.maximum(square_sums / counts - means ** 2, 0))
+        z = (values - means[inverse]) / stds[inverse]
+    z[~np.isfinite(z)] = np.nan
+    return z
+
+
+def _percentiles(inverse, values, num_groups):
+    """Return the percentile rank (0-100, ties share their mid rank) of every value within its group
+
+    :param inverse: np.ndarray
+    :param values: np.ndarray
+    :param num_groups: int
+    :return: np.ndarray
+    """
+    percentiles = np.full(len(values), np.nan)
+    valid = np.flatnonzero(~np.isnan(values))
+    if len(valid) == 0:
+        return percentiles
+    groups = inverse[valid]
+    order = np.lexsort((values[valid], groups))
+    sorted_groups = groups[order]
+    sorted_values = values[valid][order]
+    positions = np.arange(len(order))
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    new_run = new_group.copy()  # A run is a set of tied values within a group
+    new_run[1:] |= sorted_values[1:] != sorted_values[:-1]
+    group_start = np.maximum.accumulate(np.where(new_group, positions, 0))
+    run_start = np.maximum.accumulate(np.where(new_run, positions, 0))
+    run_ids = np.cumsum(new_run) - 1
+    run_lengths = np.bincount(run_ids)[run_ids]
+    group_sizes = np.bincount(sorted_groups, minlength=num_groups)[sorted_groups]
+    percentiles[valid[order]] = 100.0 * (run_start - group_start + 0.5 * run_lengths) / group_sizes
+    return percentiles
+
+
+def _rates(inverse, gp, values, num_groups):
+    """Return the per game rate of <values> of every group, counting only rows where both are known
+
+    :param inverse: np.ndarray
+    :param gp: np.ndarray
+    :param values: np.ndarray
+    :param num_groups: int
+    :return: np.ndarray
+    """
+    known = ~np.isnan(gp) & ~np.isnan(values)
+    stat_sums = np.bincount(inverse[known], weights=values[known], minlength=num_groups)
+    gp_sums = np.bincount(inverse[known], weights=gp[known], minlength=num_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rates = stat_sums / gp_sums
+    rates[~np.isfinite(rates)] = np.nan
+    return rates
+
+
+def compute_relative_stats(keys, gp, stats):
+    """Compute league-relative statistics for every player season, grouped by (league, year, season_type).
+
+    For every stat in STATS: the league average per game played, the z-score and percentile of the season total
+    within its group, and an era-adjusted total scaling the stat by how the group's per game rate compares with the
+    league's rate over all years for that season_type.
+
+    :param keys: [(str, str, str, str, str)], (league, id, year, season_type, season_name) per row
+    :param gp: np.ndarray (n,)
+    :param stats: np.ndarray (n, len(STATS))
+    :return: {str: np.ndarray}, league averages ('lg_<stat>_gp'), '<stat>_z', '<stat>_pct' and 'adj_<stat>' by row
+    """
+    groups, inverse = np.unique(
+        np.array([key[0] + '|' + key[2] + '|' + key[3] for key in keys], dtype=object).astype(str),
+        return_inverse=True)
+    eras, era_inverse = np.unique(
+        np.array([key[0] + '|' + key[3] for key in keys], dtype=object).astype(str), return_inverse=True)
+    num_groups, num_eras = len(groups), len(eras)
+
+    relative = {}
+    for i, stat in enumerate(STATS):
+        values = stats[:, i]
+        group_rates = _rates(inverse, gp, values, num_groups)
+        era_rates = _rates(era_inverse, gp, values, num_eras)
+        relative['lg_' + stat + '_gp'] = group_rates[inverse]
+        relative[stat + '_z'] = _z_scores(inverse, values, num_groups)
+        relative[stat + '_pct'] = _percentiles(inverse, values, num_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            adjusted = values * era_rates[era_inverse] / group_rates[inverse]
+        adjusted[~np.isfinite(adjusted)] = np.nan
+        relative['adj_' + stat] = adjusted
+    return relative
+
+
+def _to_db_values(array):
+    """Return a numpy column as a list of python values, with nan as None
+
+    :param array: np.ndarray
+    :return: list
+    """
+    return [None if value != value else value for value in array.tolist()]
+
+
+def save_relative_stats():
+    """Recompute the player_season_relative table from every NHL and CHL player season
+
+    :return: None
+    """
+    conn = connect_federated()
+    c = conn.cursor()
+    start_time = time.time()
+
+    keys, gp, stats = _load_season_block(c)
+    relative = compute_relative_stats(keys, gp, stats)
+
+    columns = [_to_db_values(gp)]
+    columns += [_to_db_values(stats[:, i]) for i in range(len(STATS))]
+    for prefix, suffix in [('lg_', '_gp'), ('', '_z'), ('', '_pct'), ('adj_', '')]:
+        columns += [_to_db_values(relative[prefix + stat + suffix]) for stat in STATS]
+    rows = [
+        (league, id_, year, season_type, season_name) + values
+        for (league, id_, year, season_type, season_name), values in zip(keys, zip(*columns))
+    ]
+
+    _create_player_season_relative_table(c)
+    c.executemany(
+        'INSERT OR REPLACE INTO player_season_relative VALUES '
+        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        rows)
+    conn.commit()
+    conn.close()
+    print(str(len(rows)) + " player seasons compared. That took " + str(time.time() - start_time) + " seconds")
+
+
+if __name__ == '__main__':
+    with profile_run('relative'):
+        save_relative_stats()
@@ -0,0 +1,422 @@
+import os
+import json
+import time
+import shutil
+
+import numpy as np
+
+from common.db import _shard_tables, attached_shards, connect_federated, get_generation
+from common.profiling import profile_run
+from common.search import normalize_name
+
+
+MATRIX_DIR = os.path.join(os.getcwd(), 'season-matrix')
+STATS = ['gp', 'goals', 'assists', 'points', 'plus_minus', 'pim', 's']
+TABLES = ('player_seasons', 'chl_player_seasons', 'player_pages', 'chl_player_pages')
+AGE_CUTOFF = 915  # Ages are counted on September 15th of the year a season starts, as hockey does (MMDD)
+ARRAYS = [
+    'player_leagues', 'player_ids', 'player_persons', 'person_births', 'person_draft_years', 'season_leagues',
+    'season_keys', 'season_types', 'season_starts', 'indptr', 'season_indices', 'stats'
+]
+
+
+def _season_start(league, key):
+    """Return the year a season starts in, from its NHL year ('20152016') or CHL season name ('2015-16 Regular Season',
+    '2016 Playoffs')"""
+    if league == 'NHL':
+        return int(key[:4])
+    first = key.split()[0]
+    return int(first[:4]) if '-' in first else int(first[:4]) - 1
+
+
+def _load_season_rows(conn, after):
+    """Load the NHL and CHL player seasons saved in each shard after the given rowids
+
+    :param conn: federated database connection
+    :param after: {str: int}, league: rowid of the shard's player_seasons or chl_player_seasons table
+    :return: [(str, str, str, str, tuple)], {str: int}
+        (league, id, season key, season type, stats) rows, and the largest rowid loaded from each shard
+    """
+    stats_sql = ', '.join(STATS)
+    rows = []
+    max_rowids = dict(after)
+    c = conn.cursor()
+    for league, schema in attached_shards(conn):
+        max_rowid = after.get(league, 0)
+        tables = _shard_tables(conn, schema)
+        if 'player_seasons' in tables:
+            c.execute(
+                "SELECT rowid, 'NHL', id, year, season_type, " + stats_sql + ' FROM ' + schema +
+                '.player_seasons WHERE rowid > ?',
+                (max_rowid,))
+        elif 'chl_player_seasons' in tables:
+            c.execute(
+                'SELECT rowid, league, id, season_name, NULL, ' + stats_sql + ' FROM ' + schema +
+                '.chl_player_seasons WHERE rowid > ?',
+                (max_rowid,))
+        else:
+            continue
+        for row in c.fetchall():
+            max_rowid = max(max_rowid, row[0])
+            league_name, season_key, season_type = row[1], row[3], row[4]
+            if season_type is None:  # Kinds of chl seasons, with nhl.com codes
+                season_name = season_key.lower()
+                season_type = '3' if 'playoff' in season_name else '1' if 'pre' in season_name else '2'
+            rows.append((league_name, row[2], season_key, season_type, row[5:]))
+        max_rowids[league] = max_rowid
+    return rows, max_rowids
+
+
+def _load_pages(conn):
+    """Return the name, birth date and NHL draft year of every player with a saved page
+
+    :param conn: federated database connection
+    :return: {(str, str): (str, str, str)} (league, id): (name, birth date, draft year)
+    """
+    pages = {}
+    queries = [
+        "SELECT 'NHL', id, name, birth_date, draft_year FROM player_pages",
+        'SELECT league, id, name, birth_date, nhl_draft_year FROM chl_player_pages',
+    ]
+    for sql in queries:
+        try:
+            rows = conn.execute(sql).fetchall()
+        except Exception:  # No pages saved yet: the view does not exist
+            continue
+        for league, id_, name, birth_date, draft_year in rows:
+            pages[(league, id_)] = (name, birth_date, draft_year)
+    return pages
+
+
+def _birth_number(birth_date):
+    """Return a birth date ('YYYY-MM-DD') as YYYYMMDD, 0 if unknown"""
+    if birth_date is None or len(birth_date) != 10 or not birth_date[:4].isdigit():
+        return 0
+    return int(birth_date[:4] + birth_date[5:7] + birth_date[8:10])
+
+
+class SeasonMatrix:
+    """Every saved player season as a sparse player x season x stat array, in CSR form: the seasons of player p are
+    entries indptr[p]:indptr[p + 1] of season_indices (the season of each) and stats (a row of STATS each, nan where
+    unknown).
+
+    Players are (league, id) rows; players of different leagues with the same normalized name and birth date on
+    their pages are one person, so cohorts can follow players from league to league.
+    """
+
+    def __init__(self, arrays, max_rowids, generation):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.max_rowids = max_rowids
+        self.generation = generation
+        self._entry_players = None
+
+    @property
+    def num_players(self):
+        return len(self.player_ids)
+
+    def entry_players(self):
+        """Return the player row of every entry
+
+        :return: np.ndarray (nnz,) of int
+        """
+        if self._entry_players is None:
+            self._entry_players = np.repeat(
+                np.arange(self.num_players, dtype=np.int32), np.diff(np.asarray(self.indptr)))
+        return self._entry_players
+
+    def stat(self, name):
+        """Return the values of a stat of every entry
+
+        :param name: str, one of STATS
+        :return: np.ndarray (nnz,)
+        """
+        return self.stats[:, STATS.index(name)]
+
+    def entry_ages(self):
+        """Return the age of the player of every entry when the season started, -1 where the birth date is unknown
+
+        :return: np.ndarray (nnz,) of int
+        """
+        births = np.asarray(self.person_births)[np.asarray(self.player_persons)[self.entry_players()]]
+        ages = np.asarray(self.season_starts)[self.season_indices] - births // 10000 - (births % 10000 > AGE_CUTOFF)
+        ages[births == 0] = -1
+        return ages
+
+    def entry_mask(self, leagues=None, min_age=None, max_age=None, season_types=('2',), min_gp=1):
+        """Return a boolean mask of the entries matching every filter given
+
+        :param leagues: [str] | None
+        :param min_age: int | None
+        :param max_age: int | None
+        :param season_types: [str] | None, nhl.com codes, regular seasons by default
+        :param min_gp: int | None
+        :return: np.ndarray (nnz,) of bool
+        """
+        mask = np.ones(len(self.season_indices), dtype=bool)
+        if leagues is not None:
+            mask &= np.isin(np.asarray(self.season_leagues)[self.season_indices], leagues)
+        if season_types is not None:
+            mask &= np.isin(np.asarray(self.season_types)[self.season_indices], season_types)
+        if min_age is not None or max_age is not None:
+            ages = self.entry_ages()
+            if min_age is not None:
+                mask &= ages >= min_age
+            if max_age is not None:
+                mask &= (ages <= max_age) & (ages >= 0)
+        if min_gp is not None:
+            mask &= self.stat('gp') >= min_gp
+        return mask
+
+    def persons(self, mask):
+        """Return the persons with an entry in <mask>
+
+        :param mask: np.ndarray (nnz,) of bool
+        :return: np.ndarray of int, sorted
+        """
+        return np.unique(np.asarray(self.player_persons)[self.entry_players()[mask]])
+
+    def cohort(self, *conditions):
+        """Return the persons meeting every condition, each the filters of entry_mask, for example those in the OHL at
+        17 and in the NHL by 21:
+
+            matrix.cohort({'leagues': ['OHL'], 'min_age': 17, 'max_age': 17}, {'leagues': ['NHL'], 'max_age': 21})
+
+        :param conditions: dict
+        :return: np.ndarray of int
+        """
+        persons = None
+        for condition in conditions:
+            matching = self.persons(self.entry_mask(**condition))
+            persons = matching if persons is None else np.intersect1d(persons, matching, assume_unique=True)
+        return persons
+
+    def draft_class(self, year):
+        """Return the persons drafted into the NHL in <year>
+
+        :param year: int
+        :return: np.ndarray of int
+        """
+        return np.flatnonzero(np.asarray(self.person_draft_years) == year)
+
+    def career_arcs(self, persons, stat='points', leagues=('NHL',), since_draft=True, length=20):
+        """Return the careers of <persons> as a dense array of <stat> per year, counted from the draft or by age
+
+        :param persons: np.ndarray of int
+        :param stat: str, one of STATS
+        :param leagues: [str] | None
+        :param since_draft: bool, columns are years since the draft if True, ages otherwise
+        :param length: int, columns
+        :return: np.ndarray (len(persons), length), summed over the seasons of a year, nan for years not played
+        """
+        mask = self.entry_mask(leagues=leagues)
+        entry_persons = np.asarray(self.player_persons)[self.entry_players()]
+        mask &= np.isin(entry_persons, persons)
+        rows = np.searchsorted(persons, entry_persons[mask])
+        starts = np.asarray(self.season_starts)[self.season_indices[mask]]
+        if since_draft:
+            columns = starts - np.asarray(self.person_draft_years)[entry_persons[mask]]
+        else:
+            births = np.asarray(self.person_births)[entry_persons[mask]]
+            columns = starts - births // 10000 - (births % 10000 > AGE_CUTOFF)
+        keep = (columns >= 0) & (columns < length)
+        arcs = np.zeros((len(persons), length))
+        played = np.zeros((len(persons), length), dtype=bool)
+        values = np.nan_to_num(self.stat(stat)[mask][keep])
+        np.add.at(arcs, (rows[keep], columns[keep]), values)
+        played[rows[keep], columns[keep]] = True
+        arcs[~played] = np.nan
+        return arcs
+
+    def person_players(self, persons):
+        """Return the (league, id) of every player row of <persons>
+
+        :param persons: np.ndarray of int
+        :return: [[(str, str)]]
+        """
+        rows = np.flatnonzero(np.isin(self.player_persons, persons))
+        by_person = dict((person, []) for person in np.asarray(persons).tolist())
+        for row in rows.tolist():
+            by_person[int(self.player_persons[row])].append((str(self.player_leagues[row]), str(self.player_ids[row])))
+        return [by_person[person] for person in np.asarray(persons).tolist()]
+
+    def save(self, path=MATRIX_DIR):
+        """Write the arrays to a new version directory, then switch meta.json to it, so readers never see a partial
+        matrix; the previous versions are removed"""
+        os.makedirs(path, exist_ok=True)
+        version = 'v' + str(int(time.time() * 1000))
+        version_path = os.path.join(path, version)
+        os.makedirs(version_path)
+        for name in ARRAYS:
+            np.save(os.path.join(version_path, name + '.npy'), np.asarray(getattr(self, name)))
+        meta = {'version': version, 'max_rowids': self.max_rowids, 'generation': list(self.generation),
+                'stats': STATS}
+        with open(os.path.join(path, 'meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
+        for name in os.listdir(path):  # Readers still mapping an old version keep its files until they are done
+            if name.startswith('v') and name != version:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    @classmethod
+    def load(cls, path=MATRIX_DIR, mmap_mode='r'):
+        """Return the persisted matrix, its arrays memory mapped rather than read
+
+        :param path: str
+        :param mmap_mode: str | None, None reads the arrays into memory
+        :return: SeasonMatrix
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        assert meta['stats'] == STATS, 'the season matrix was built with other stats, rebuild it'
+        arrays = dict((name, np.load(os.path.join(path, meta['version'], name + '.npy'), mmap_mode=mmap_mode))
+                      for name in ARRAYS)
+        return cls(arrays, meta['max_rowids'], tuple(meta['generation']))
+
+
+def _index_of(values, index):
+    """Return the position of every value in <index>, {value: position}, adding the values not in it yet"""
+    positions = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        position = index.get(value)
+        if position is None:
+            position = index[value] = len(index)
+        positions[i] = position
+    return positions
+
+
+def _link_persons(player_leagues, player_ids, pages):
+    """Return the person of every player row, and the birth date and draft year of every person
+
+    :return: np.ndarray (n,) of int, np.ndarray of int, np.ndarray of int
+    """
+    person_keys = []
+    for league, id_ in zip(player_leagues.tolist(), player_ids.tolist()):
+        name, birth_date, _ = pages.get((league, id_), (None, None, None))
+        if name is not None and _birth_number(birth_date) != 0:
+            person_keys.append('|'.join((normalize_name(name), birth_date)))
+        else:  # Without a page, a player is only known in their league
+            person_keys.append('|'.join((league, id_)))
+    unique_keys, persons = np.unique(np.array(person_keys, dtype=str), return_inverse=True)
+    births = np.zeros(len(unique_keys), dtype=np.int32)
+    draft_years = np.zeros(len(unique_keys), dtype=np.int32)
+    for (league, id_), person in zip(zip(player_leagues.tolist(), player_ids.tolist()), persons.tolist()):
+        _, birth_date, draft_year = pages.get((league, id_), (None, None, None))
+        births[person] = births[person] or _birth_number(birth_date)
+        if draft_year is not None and str(draft_year).isdigit():
+            draft_years[person] = draft_years[person] or int(draft_year)
+    return persons.astype(np.int32), births, draft_years
+
+
+def _merge(matrix, rows, pages, max_rowids, generation):
+    """Return a matrix of the entries of <matrix> (None for an empty one) and of <rows>, later rows replacing the
+    entries of the same player and season
+
+    :return: SeasonMatrix
+    """
+    players, seasons = {}, {}
+    old_players = old_seasons = 0
+    if matrix is not None:
+        for key in zip(matrix.player_leagues.tolist(), matrix.player_ids.tolist()):
+            players[key] = len(players)
+        for key in zip(matrix.season_leagues.tolist(), matrix.season_keys.tolist(), matrix.season_types.tolist()):
+            seasons[key] = len(seasons)
+        old_players, old_seasons = len(players), len(seasons)
+    new_players = _index_of([(league, id_) for league, id_, _, _, _ in rows], players)
+    # A season is its league, key and type: an NHL year has a regular season and playoffs
+    new_seasons = _index_of([(league, key, season_type) for league, _, key, season_type, _ in rows], seasons)
+    new_stats = np.array([row[4] for row in rows], dtype=np.float32).reshape(len(rows), len(STATS))
+
+    if matrix is not None:
+        all_players = np.concatenate((matrix.entry_players(), new_players))
+        all_seasons = np.concatenate((np.asarray(matrix.season_indices), new_seasons))
+        all_stats = np.concatenate((np.asarray(matrix.stats), new_stats))
+    else:
+        all_players, all_seasons, all_stats = new_players, new_seasons, new_stats
+    # Sorted by player then season, newest last; of the entries of a player and season only the newest is kept
+    order = np.lexsort((np.arange(len(all_players)), all_seasons, all_players))
+    all_players, all_seasons, all_stats = all_players[order], all_seasons[order], all_stats[order]
+    newest = np.ones(len(all_players), dtype=bool)
+    newest[:-1] = (all_players[1:] != all_players[:-1]) | (all_seasons[1:] != all_seasons[:-1])
+    all_players, all_seasons, all_stats = all_players[newest], all_seasons[newest], all_stats[newest]
+
+    player_keys = sorted(players, key=players.get)
+    season_keys = sorted(seasons, key=seasons.get)
+    arrays = {
+        'player_leagues': np.array([league for league, _ in player_keys], dtype=str),
+        'player_ids': np.array([id_ for _, id_ in player_keys], dtype=str),
+        'season_leagues': np.array([league for league, _, _ in season_keys], dtype=str),
+        'season_keys': np.array([key for _, key, _ in season_keys], dtype=str),
+        'season_types': np.array([season_type for _, _, season_type in season_keys], dtype=str),
+        'season_starts': np.array([_season_start(league, key) for league, key, _ in season_keys], dtype=np.int32),
+        'indptr': np.concatenate(([0], np.cumsum(np.bincount(all_players, minlength=len(players))))).astype(np.int64),
+        'season_indices': all_seasons.astype(np.int32),
+        'stats': all_stats,
+    }
+    arrays['player_persons'], arrays['person_births'], arrays['person_draft_years'] = _link_persons(
+        arrays['player_leagues'], arrays['player_ids'], pages)
+    print(str(len(players) - old_players) + " new players, " + str(len(seasons) - old_seasons) + " new seasons, " +
+          str(len(rows)) + " season rows merged")
+    return SeasonMatrix(arrays, max_rowids, generation)
+
+
+def build_season_matrix(path=MATRIX_DIR):
+    """Build the season matrix from every saved player season and persist it
+
+    :param path: str
+    :return: SeasonMatrix
+    """
+    start_time = time.time()
+    conn = connect_federated(read_only=True)
+    generation = get_generation(conn.cursor(), TABLES)
+    rows, max_rowids = _load_season_rows(conn, {})
+    matrix = _merge(None, rows, _load_pages(conn), max_rowids, generation)
+    conn.close()
+    matrix.save(path)
+    print("Season matrix built. That took " + str(time.time() - start_time) + " seconds")
+    return matrix
+
+
+def update_season_matrix(path=MATRIX_DIR):
+    """Bring the persisted matrix up to date after a crawl: merge in the seasons saved since it was last updated and
+    link players to persons again with the pages saved since; build it if it does not exist yet
+
+    :param path: str
+    :return: SeasonMatrix
+    """
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return build_season_matrix(path)
+    start_time = time.time()
+    matrix = SeasonMatrix.load(path)
+    conn = connect_federated(read_only=True)
+    generation = get_generation(conn.cursor(), TABLES)
+    if generation != matrix.generation:
+        rows, max_rowids = _load_season_rows(conn, matrix.max_rowids)
+        matrix = _merge(matrix, rows, _load_pages(conn), max_rowids, generation)
+        matrix.save(path)
+        print("Season matrix updated. That took " + str(time.time() - start_time) + " seconds")
+    conn.close()
+    return matrix
+
+
+_loaded_matrix = None
+_loaded_mtime = None
+
+
+def get_season_matrix(path=MATRIX_DIR):
+    """Return the persisted matrix, memory mapped, loading it again whenever it has been updated on disk
+
+    :param path: str
+    :return: SeasonMatrix
+    """
+    global _loaded_matrix, _loaded_mtime
+    mtime = os.path.getmtime(os.path.join(path, 'meta.json'))
+    if _loaded_matrix is None or mtime != _loaded_mtime:
+        _loaded_matrix = SeasonMatrix.load(path)
+        _loaded_mtime = mtime
+    return _loaded_matrix
+
+
+if __name__ == '__main__':
+    with profile_run('seasonmatrix'):
+        update_season_matrix()
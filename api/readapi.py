@@ -0,0 +1,368 @@
+import sys
+import threading
+
+from collections import OrderedDict
+
+from common.db import connect_federated, federated_layout, get_generation
+from common.history import season_as_of
+from common.leaderboards import LEADERBOARD_TABLES, TOP_N, season_key
+from chl import playerpage as chl_playerpage
+from chl import playerseason as chl_playerseason
+from nhl import playerpage as nhl_playerpage
+from nhl import playerseason as nhl_playerseason
+
+
+MMAP_SIZE = 256 * 1024 * 1024  # Per database, of every read connection
+
+# Columns leaderboards can be sorted by
+NHL_STATS = [
+    'gp', 'goals', 'assists', 'points', 'plus_minus', 'pim', 'p_gp', 'ppg', 'ppp', 'shg', 'shp', 'otg', 's', 's_per',
+    'toi_gp', 'shifts_gp', 'fow_per'
+]
+# Stats leaderboards can also rank per 60 minutes on ice, as '<stat>_per_60'
+NHL_RATE_STATS = ['goals', 'assists', 'points', 'ppp', 's']
+CHL_STATS = [
+    'gp', 'goals', 'assists', 'points', 'plus_minus', 'pim', 'ppg', 'ppa', 'shg', 'sha', 's', 'gwg', 'otg',
+    'first_g', 'insurance_g', 'sho_g', 'sho_per', 'fow', 'fow_per', 'p_g', 'pim_g'
+]
+
+# name: (tables read, sql). Statements are compiled once per connection and reused from its statement cache.
+QUERIES = {
+    'nhl_career': (
+        ('player_seasons',),
+        'SELECT * FROM player_seasons WHERE id = ? ORDER BY year, season_type'),
+    'chl_career': (
+        ('chl_player_seasons',),
+        'SELECT * FROM chl_player_seasons WHERE id = ? AND league = ? ORDER BY year, season_name'),
+    'nhl_roster': (
+        ('player_seasons',),
+        'SELECT * FROM player_seasons '
+        "WHERE team_id IN (SELECT team_id FROM teams WHERE league = 'NHL' AND name = ?) "
+        'AND year = ? AND season_type = ? ORDER BY points DESC, name LIMIT ? OFFSET ?'),
+    'chl_roster': (
+        ('chl_player_seasons',),
+        'SELECT * FROM chl_player_seasons '
+        'WHERE team_id IN (SELECT team_id FROM teams WHERE league = ? AND name = ?) AND season_name = ? '
+        'ORDER BY points DESC, name LIMIT ? OFFSET ?'),
+    'nhl_season': (
+        ('player_seasons',),
+        'SELECT * FROM player_seasons WHERE year = ? AND season_type = ? ORDER BY points DESC, name, id '
+        'LIMIT ? OFFSET ?'),
+    'chl_season': (
+        ('chl_player_seasons',),
+        'SELECT * FROM chl_player_seasons WHERE league = ? AND season_name = ? ORDER BY points DESC, name, id '
+        'LIMIT ? OFFSET ?'),
+    'nhl_page': (
+        ('player_pages',),
+        'SELECT * FROM player_pages WHERE id = ?'),
+    'chl_page': (
+        ('chl_player_pages',),
+        'SELECT * FROM chl_player_pages WHERE id = ? AND league = ?'),
+    'nhl_draft_round': (
+        ('player_pages',),
+        'SELECT player_pages.* FROM drafts JOIN player_pages ON player_pages.draft_id = drafts.draft_id '
+        "WHERE drafts.league = 'NHL' AND drafts.year = ? AND drafts.round = ? ORDER BY drafts.overall"),
+    'nhl_leaderboard': (
+        ('player_seasons', 'leaderboards'),
+        'SELECT player_seasons.* FROM leaderboards JOIN player_seasons ON player_seasons.id = leaderboards.id '
+        'AND player_seasons.year = ? AND player_seasons.season_type = ? '
+        "WHERE leaderboards.league = 'NHL' AND leaderboards.season = ? AND leaderboards.stat = ? "
+        'ORDER BY leaderboards.rank LIMIT ?'),
+    # Ids only: joined to chl_player_seasons, a view over several shards, the seasons of every shard would be scanned
+    'chl_leaderboard': (
+        ('leaderboards',),
+        'SELECT id FROM leaderboards WHERE league = ? AND season = ? AND stat = ? ORDER BY rank LIMIT ?'),
+    'chl_player_season': (
+        ('chl_player_seasons',),
+        'SELECT * FROM chl_player_seasons WHERE id = ? AND season_name = ? AND league = ?'),
+    'chl_seasons': (
+        ('chl_seasons',),
+        'SELECT * FROM chl_seasons WHERE league = ? ORDER BY year DESC, season_name'),
+}
+for _stat in NHL_STATS:
+    QUERIES['nhl_leaders_' + _stat] = (
+        ('player_seasons',),
+        'SELECT * FROM player_seasons WHERE year = ? AND season_type = ? AND {0} IS NOT NULL '
+        'ORDER BY {0} DESC LIMIT ?'.format(_stat))
+for _stat in NHL_RATE_STATS:
+    QUERIES['nhl_leaders_' + _stat + '_per_60'] = (
+        ('player_seasons',),
+        'SELECT * FROM player_seasons WHERE year = ? AND season_type = ? AND {0} IS NOT NULL AND toi_gp > 0 '
+        'ORDER BY {0} * 3600.0 / (gp * toi_gp) DESC LIMIT ?'.format(_stat))
+for _stat in CHL_STATS:
+    QUERIES['chl_leaders_' + _stat] = (
+        ('chl_player_seasons',),
+        'SELECT * FROM chl_player_seasons WHERE league = ? AND season_name = ? AND {0} IS NOT NULL '
+        'ORDER BY {0} DESC LIMIT ?'.format(_stat))
+
+
+class UnknownStat(ValueError):
+    """Raised for a leaderboard of a stat the league's seasons can not be ranked by"""
+
+
+class QueryCache:
+    """LRU cache of query results, bounded by number of entries and by (estimated) bytes.
+
+    Every entry is stored with the write generations of the tables it was read from, and is only served while those
+    generations are unchanged.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key: (generation, size, rows)
+        self._lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                if entry is not None:  # Stale: a table it was read from has been written to since
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, generation, rows):
+        size = _estimate_size(rows)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (generation, size, rows)
+            self.num_bytes += size
+            while len(self._entries) > self.max_entries or self.num_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def _remove(self, key):
+        generation, size, rows = self._entries.pop(key)
+        self.num_bytes -= size
+
+
+def _estimate_size(rows):
+    """Return a rough number of bytes held by a list of result rows
+
+    :param rows: [tuple]
+    :return: int
+    """
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value)
+    return size
+
+
+_cache = QueryCache()
+_local = threading.local()
+
+
+def _get_connection():
+    """Return this thread's read connection, made again once a shard or a table has been created since it was made,
+    so a long-running reader sees the leagues crawled after it started
+
+    :return: sqlite3.Connection
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and federated_layout(conn) != _local.layout:
+        conn.close()
+        conn = None
+    if conn is None:
+        conn = connect_federated(read_only=True, mmap_size=MMAP_SIZE, cached_statements=len(QUERIES) + 16)
+        _local.conn = conn
+        _local.layout = federated_layout(conn)
+    return conn
+
+
+def _has_table(table):
+    """Return whether some shard holds <table>: a migrated or bulk-loaded database lacks the tables only crawls create
+
+    :param table: str
+    :return: bool
+    """
+    return _get_connection().execute(
+        "SELECT 1 FROM sqlite_temp_master WHERE type = 'view' AND name = ?", (table,)).fetchone() is not None
+
+
+def _run(name, params):
+    """Return the rows of query <name> with <params>, from the cache while none of its tables has been written to
+
+    :param name: str
+    :param params: tuple
+    :return: [tuple]
+    """
+    tables, sql = QUERIES[name]
+    conn = _get_connection()
+    generation = get_generation(conn.cursor(), tables)
+    key = (name, params)
+    rows = _cache.get(key, generation)
+    if rows is None:
+        rows = conn.execute(sql, params).fetchall()
+        _cache.put(key, generation, rows)
+    return rows
+
+
+def season_leaders(league, season, stat='points', limit=50, season_type='2'):
+    """Return the top <limit> player seasons of a season by <stat>, from its materialized leaderboard when it has one,
+    by sorting the season otherwise
+
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :param season: str, the year for the NHL (e.g. '20152016'), the season name for the CHL leagues
+    :param stat: str, one of NHL_STATS or CHL_STATS, or for the NHL one of NHL_RATE_STATS + '_per_60'
+    :param limit: int
+    :param season_type: '2' | '3' (regular season | playoffs), NHL only
+    :return: [PlayerSeason]
+    :raises UnknownStat: if <stat> can not rank the seasons of the league
+    """
+    if league == 'NHL':
+        if 'nhl_leaders_' + stat not in QUERIES:
+            raise UnknownStat('{} is not a nhl stat'.format(stat))
+        rows = []
+        if stat in LEADERBOARD_TABLES['player_seasons'][2] and limit <= TOP_N and _has_table('leaderboards'):
+            rows = _run('nhl_leaderboard', (season, season_type, season_key((season, season_type)), stat, limit))
+        if len(rows) == 0:  # No leaderboard for the stat or the season
+            rows = _run('nhl_leaders_' + stat, (season, season_type, limit))
+        return [nhl_playerseason._row_to_player_season(row) for row in rows]
+    else:
+        if stat not in CHL_STATS:
+            raise UnknownStat('{} is not a chl stat'.format(stat))
+        rows = []
+        if stat in LEADERBOARD_TABLES['chl_player_seasons'][2] and limit <= TOP_N and _has_table('leaderboards'):
+            ids = [row[0] for row in _run('chl_leaderboard', (league, season_key((season,)), stat, limit))]
+            rows = [row for id_ in ids for row in _run('chl_player_season', (id_, season, league))]
+        if len(rows) == 0:
+            rows = _run('chl_leaders_' + stat, (league, season, limit))
+        return [chl_playerseason._row_to_player_season(row) for row in rows]
+
+
+def season_table(league, season, season_type='2', limit=50, offset=0):
+    """Return a page of the player seasons of a season, best scorers first
+
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :param season: str, the year for the NHL (e.g. '20152016'), the season name for the CHL leagues
+    :param season_type: '2' | '3' (regular season | playoffs), NHL only
+    :param limit: int
+    :param offset: int
+    :return: [PlayerSeason]
+    """
+    if league == 'NHL':
+        rows = _run('nhl_season', (season, season_type, limit, offset))
+        return [nhl_playerseason._row_to_player_season(row) for row in rows]
+    else:
+        rows = _run('chl_season', (league, season, limit, offset))
+        return [chl_playerseason._row_to_player_season(row) for row in rows]
+
+
+def tables_generation(tables):
+    """Return the write generations of <tables>: results read from them are unchanged while these are
+
+    :param tables: [str]
+    :return: tuple
+    """
+    return get_generation(_get_connection().cursor(), tables)
+
+
+def player_career(id_, league='NHL'):
+    """Return every saved season of a player in a league, oldest first
+
+    :param id_: str
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :return: [PlayerSeason]
+    """
+    if league == 'NHL':
+        return [nhl_playerseason._row_to_player_season(row) for row in _run('nhl_career', (id_,))]
+    else:
+        return [chl_playerseason._row_to_player_season(row) for row in _run('chl_career', (id_, league))]
+
+
+def team_roster(league, team, season, season_type='2', limit=-1, offset=0):
+    """Return the player seasons of a team in a season, best scorers first
+
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :param team: str
+    :param season: str, the year for the NHL (e.g. '20152016'), the season name for the CHL leagues
+    :param season_type: '2' | '3' (regular season | playoffs), NHL only
+    :param limit: int, -1 for every player season
+    :param offset: int
+    :return: [PlayerSeason]
+    """
+    if league == 'NHL':
+        rows = _run('nhl_roster', (team, season, season_type, limit, offset))
+        return [nhl_playerseason._row_to_player_season(row) for row in rows]
+    else:
+        rows = _run('chl_roster', (league, team, season, limit, offset))
+        return [chl_playerseason._row_to_player_season(row) for row in rows]
+
+
+def season_table_as_of(league, season, as_of, season_type='2'):
+    """Return the player seasons of a season as they were saved at a point in time, best scorers first
+
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :param season: str, the year for the NHL (e.g. '20152016'), the season name for the CHL leagues
+    :param as_of: str, 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'
+    :param season_type: '2' | '3' (regular season | playoffs), NHL only
+    :return: [PlayerSeason]
+    """
+    c = _get_connection().cursor()
+    if league == 'NHL':
+        player_seasons = [
+            nhl_playerseason._row_to_player_season(row)
+            for row in season_as_of(c, 'player_seasons', (season, season_type), as_of)
+        ]
+    else:
+        player_seasons = [
+            chl_playerseason._row_to_player_season(row)
+            for row in season_as_of(c, 'chl_player_seasons', (league, season), as_of)
+        ]
+    return sorted(player_seasons, key=lambda player_season: (-(player_season.points or 0), player_season.name))
+
+
+def player_page(id_, league='NHL'):
+    """Return the saved page of a player, or None if it has not been saved
+
+    :param id_: str
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :return: PlayerPage | None
+    """
+    if league == 'NHL':
+        rows = _run('nhl_page', (id_,))
+        row_to_player_page = nhl_playerpage._row_to_player_page
+    else:
+        rows = _run('chl_page', (id_, league))
+        row_to_player_page = chl_playerpage._row_to_player_page
+    if len(rows) == 0:
+        return None
+    return row_to_player_page(rows[0])
+
+
+def draft_round(year, draft_round=1):
+    """Return the saved pages of the players picked in a round of an NHL entry draft, in the order they were picked
+
+    :param year: int
+    :param draft_round: int
+    :return: [PlayerPage]
+    """
+    return [nhl_playerpage._row_to_player_page(row) for row in _run('nhl_draft_round', (year, draft_round))]
+
+
+def season_catalogue(league):
+    """Return the catalogue of the seasons of a chl league, as last seen in the site's season dropdown, latest first
+
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
+    :return: [tuple] (league, season_name, url_frag, year, season_type, complete, num_rows, first_seen, last_crawled),
+        none before the first season crawl or in a migrated or bulk-loaded database
+    """
+    if not _has_table('chl_seasons'):
+        return []
+    return _run('chl_seasons', (league,))
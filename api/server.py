@@ -0,0 +1,202 @@
+import json
+import asyncio
+import hashlib
+import argparse
+import datetime
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from api import readapi
+from common import throttle
+from common.db import SHARDS
+from common.profiling import profile_run
+from common.search import search_players
+
+
+POOL_SIZE = 8  # Query threads, each with its own read-only connection (see readapi._get_connection)
+MAX_CACHED_RESPONSES = 4096  # Response bodies kept by ETag, so repeated requests skip the query and the encoding
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 500
+SEASON_TABLES = ('player_seasons', 'chl_player_seasons')
+PAGE_TABLES = ('player_pages', 'chl_player_pages')
+
+
+def _json_value(value):
+    """json.dumps fallback: dates as ISO strings, PlayerSeason/PlayerPage (and their parts) as their attributes"""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return vars(value)
+
+
+def _query_int(request, name, default, minimum=1, maximum=None):
+    raw = request.query.get(name)
+    if raw is None:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        raise web.HTTPBadRequest(text=name + ' must be an integer')
+    if value < minimum or (maximum is not None and value > maximum):
+        raise web.HTTPBadRequest(text=name + ' is out of range')
+    return value
+
+
+def _league(request):
+    league = request.match_info['league'].upper()
+    if league not in SHARDS:
+        raise web.HTTPNotFound(text='no league ' + league)
+    return league
+
+
+async def _in_pool(request, func, *args):
+    """Run a blocking query function on the query threads"""
+    return await asyncio.get_running_loop().run_in_executor(request.app['executor'], func, *args)
+
+
+async def _respond(request, tables, fetch, paginated=True):
+    """Answer a GET with the result of <fetch> as JSON.
+
+    The ETag is derived from the request and the write generations of the tables the result is read from, so a
+    client revalidating an unchanged result gets a 304 without the query being run.
+
+    :param request: web.Request
+    :param tables: [str], tables the result is read from
+    :param fetch: function(limit, offset) returning the items of a page, if paginated, else function() returning
+        one item or None
+    :param paginated: bool
+    :return: web.Response
+    """
+    generation = await _in_pool(request, readapi.tables_generation, list(tables))
+    etag = '"' + hashlib.sha1(repr((request.path_qs, generation)).encode()).hexdigest()[:24] + '"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers=headers)
+    cache = request.app['responses']
+    body = cache.get(etag)
+    if body is not None:
+        cache.move_to_end(etag)
+        return web.Response(body=body, content_type='application/json', charset='utf-8', headers=headers)
+    try:
+        if paginated:
+            page = _query_int(request, 'page', 1)
+            per_page = _query_int(request, 'per_page', DEFAULT_PER_PAGE, maximum=MAX_PER_PAGE)
+            # One item more than the page tells whether there is a next page
+            items = await _in_pool(request, fetch, per_page + 1, (page - 1) * per_page)
+            next_url = None
+            if len(items) > per_page:
+                next_url = str(request.rel_url.update_query(page=page + 1, per_page=per_page))
+            body = {'items': items[:per_page], 'page': page, 'per_page': per_page, 'next': next_url}
+        else:
+            item = await _in_pool(request, fetch)
+            if item is None:
+                raise web.HTTPNotFound(text='not found')
+            body = {'item': item}
+    except readapi.UnknownStat as e:
+        raise web.HTTPBadRequest(text=str(e))
+    body = json.dumps(body, default=_json_value).encode('utf-8')
+    cache[etag] = body
+    while len(cache) > MAX_CACHED_RESPONSES:
+        cache.popitem(last=False)
+    return web.Response(body=body, content_type='application/json', charset='utf-8', headers=headers)
+
+
+async def search(request):
+    query = request.query.get('q', '')
+    leagues = request.query.getall('league', None)
+    return await _respond(
+        request, ['player_names'],
+        lambda limit, offset: [
+            {'id': id_, 'league': league, 'name': name}
+            for id_, league, name in search_players(query, limit + offset, leagues)[offset:]
+        ])
+
+
+async def player(request):
+    league, id_ = _league(request), request.match_info['id']
+    return await _respond(request, PAGE_TABLES, lambda: readapi.player_page(id_, league), paginated=False)
+
+
+async def career(request):
+    league, id_ = _league(request), request.match_info['id']
+    return await _respond(
+        request, SEASON_TABLES, lambda limit, offset: readapi.player_career(id_, league)[offset:offset + limit])
+
+
+async def season_catalogue(request):
+    league = _league(request)
+    return await _respond(
+        request, ['chl_seasons'],
+        lambda limit, offset: [list(row) for row in readapi.season_catalogue(league)[offset:offset + limit]])
+
+
+async def season(request):
+    league, season_name = _league(request), request.match_info['season']
+    season_type = request.query.get('type', '2')
+    return await _respond(
+        request, SEASON_TABLES,
+        lambda limit, offset: readapi.season_table(league, season_name, season_type, limit, offset))
+
+
+async def leaders(request):
+    league, season_name, stat = _league(request), request.match_info['season'], request.match_info['stat']
+    season_type = request.query.get('type', '2')
+
+    def fetch(limit, offset):
+        # Within the materialized leaderboards, deeper pages sort the season
+        return readapi.season_leaders(league, season_name, stat, offset + limit, season_type)[offset:]
+    return await _respond(request, SEASON_TABLES + ('leaderboards',), fetch)
+
+
+async def roster(request):
+    league, team, season_name = _league(request), request.match_info['team'], request.match_info['season']
+    season_type = request.query.get('type', '2')
+    return await _respond(
+        request, SEASON_TABLES,
+        lambda limit, offset: readapi.team_roster(league, team, season_name, season_type, limit, offset))
+
+
+async def fetch_metrics(request):
+    # Changes with every decision of a crawler, so never cached
+    rows = await _in_pool(request, throttle.persisted_metrics)
+    return web.json_response({'items': rows}, headers={'Cache-Control': 'no-store'})
+
+
+async def _close_executor(app):
+    app['executor'].shutdown(wait=False)
+
+
+def make_app(pool_size=POOL_SIZE):
+    """Return the service: players, seasons, careers and leaderboards as JSON, read through read-only connections,
+    and the fetch metrics of the crawlers
+
+    :param pool_size: int, query threads
+    :return: web.Application
+    """
+    app = web.Application()
+    app['executor'] = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='query')
+    app['responses'] = OrderedDict()  # ETag: body, least recently used first
+    app.on_cleanup.append(_close_executor)
+    app.router.add_get('/players/search', search)
+    app.router.add_get('/players/{league}/{id}', player)
+    app.router.add_get('/players/{league}/{id}/career', career)
+    app.router.add_get('/seasons/{league}', season_catalogue)
+    app.router.add_get('/seasons/{league}/{season}', season)
+    app.router.add_get('/leaders/{league}/{season}/{stat}', leaders)
+    app.router.add_get('/teams/{league}/{team}/{season}', roster)
+    app.router.add_get('/metrics/fetch', fetch_metrics)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the hockey stats databases read-only as JSON over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE, help='query threads')
+    parser.add_argument('--profile', action='store_true', help='profile the run, see common/profiling.py')
+    args = parser.parse_args()
+
+    with profile_run('server', args.profile):
+        web.run_app(make_app(args.pool_size), host=args.host, port=args.port, access_log=None)
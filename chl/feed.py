@@ -0,0 +1,239 @@
+import json
+import time
+import asyncio
+
+import aiohttp
+
+from common import throttle
+
+
+# The stats tables of the league sites are rendered from this feed. A local stand-in can be passed as base_url.
+FEED_URL = 'https://lscluster.hockeytech.com/feed/index.php'
+FEED_CLIENTS = {  # league: (key, client_code), as sent by the league sites themselves
+    'OHL': ('2976319eb44abe94', 'ohl'),
+    'WHL': ('41b145a848f4bd67', 'whl'),
+    'QMJHL': ('f322673b6bcae299', 'lhjmq'),
+}
+# How each league is crawled: 'browser' renders the site, 'feed' requests the JSON feed
+BACKENDS = {'OHL': 'browser', 'WHL': 'browser', 'QMJHL': 'browser'}
+MAX_CONNECTIONS = throttle.MAX_LIMIT  # Per client; how many are used is up to the controller of the feed's host
+PAGE_ROWS = 500  # Rows of a stats table requested at once
+MAX_ATTEMPTS = 3
+TIMEOUT_SECONDS = 30
+
+# Feed field of a skater row: header of the column of the stats table on the site holding the same statistic
+SEASON_FIELDS = [
+    ('jersey_number', '#'), ('active', 'Inactive'), ('rookie', 'Rookie'), ('name', 'Name'), ('position', 'Pos'),
+    ('team_code', 'Team'), ('games_played', 'GP'), ('goals', 'G'), ('assists', 'A'), ('points', 'PTS'),
+    ('plus_minus', '+/-'), ('penalty_minutes', 'PIM'), ('power_play_goals', 'PPG'), ('power_play_assists', 'PPA'),
+    ('short_handed_goals', 'SHG'), ('short_handed_assists', 'SHA'), ('shots', 'SOG'), ('game_winning_goals', 'GWG'),
+    ('overtime_goals', 'OTG'), ('first_goals', 'First'), ('insurance_goals', 'Insurance'),
+    ('shootout_games_played', 'SOGP'), ('shootout_goals', 'SO-G'), ('shootout_attempts', 'ATT'),
+    ('shootout_winning_goals', 'SOWG'), ('shootout_percentage', 'SO%'), ('faceoff_attempts', 'FOA'),
+    ('faceoff_wins', 'FOW'), ('faceoff_pct', 'FO%'), ('points_per_game', 'PTS/G'),
+    ('penalty_minutes_per_game', 'PIM/G'),
+]
+
+
+def backend(league):
+    """Return how the seasons and player pages of <league> are crawled
+
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
+    :return: 'browser' | 'feed'
+    """
+    return BACKENDS[league]
+
+
+def _decode(text):
+    """Return the JSON value of a feed response, which may come wrapped in parentheses (JSONP without a callback)
+
+    :param text: str
+    :return: dict | list
+    """
+    text = text.strip()
+    if text.startswith('(') and text.endswith(')'):
+        text = text[1:-1]
+    return json.loads(text)
+
+
+def season_row_texts(row):
+    """Return a skater row of the feed as the texts of a row of the stats table on the site, so it goes through the
+    same parser
+
+    :param row: dict
+    :return: str, [str], [str] (player id, texts, headers)
+    """
+    texts, headers = [], []
+    for field, header in SEASON_FIELDS:
+        value = row.get(field)
+        if value is None:
+            value = ''
+        elif field == 'active':
+            value = 'X' if str(value) == '1' else ''
+        elif field == 'rookie':
+            value = '*' if str(value) == '1' else ''
+        elif field == 'name':  # Shown as 'Last, First' on the site
+            if row.get('last_name') is not None:
+                value = row['last_name'] + ', ' + row.get('first_name', '')
+            else:
+                first_name, _, last_name = str(value).partition(' ')
+                value = last_name + ', ' + first_name
+        elif field == 'team_code' and value == '':
+            value = row.get('team_name', '')
+        texts.append(str(value))
+        headers.append(header)
+    return str(row['player_id']), texts, headers
+
+
+class FeedClient:
+    """Async client of the statviewfeed of one league, pooling its connections. Requests in flight are kept within
+    the limit of the adaptive controller of the feed's host (see common/throttle.py).
+
+        async with FeedClient('OHL') as client:
+            seasons = await client.seasons()
+            rows = await client.season_rows(seasons[0][1])
+    """
+
+    def __init__(self, league, base_url=None, max_connections=MAX_CONNECTIONS):
+        self.league = league
+        self.key, self.client_code = FEED_CLIENTS[league]
+        self.base_url = base_url or FEED_URL
+        self.max_connections = max_connections
+        self.request_counter = 0
+        self.throttle = throttle.controller(self.base_url)
+        self._session = None
+        self._slots = None  # Condition waited on for the number of requests in flight to drop below the limit
+        self._in_flight = 0
+
+    async def __aenter__(self):
+        self._slots = asyncio.Condition()
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=TIMEOUT_SECONDS))
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._session.close()
+
+    async def _get(self, params):
+        """Return the decoded response of the feed to <params>, retrying connection errors, timeouts and HTTP 429/5xx
+
+        :param params: dict
+        :return: dict | list
+        """
+        params = dict(params, key=self.key, client_code=self.client_code, lang='en', fmt='json')
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            async with self._slots:
+                await self._slots.wait_for(lambda: self._in_flight < self.throttle.window())
+                self._in_flight += 1
+            start_time = time.time()
+            outcome = 'error'
+            try:
+                async with self._session.get(self.base_url, params=params) as response:
+                    self.request_counter += 1
+                    outcome = throttle.status_outcome(response.status)
+                    if outcome not in throttle.BACKOFF_OUTCOMES or attempt == MAX_ATTEMPTS:
+                        response.raise_for_status()
+                        return _decode(await response.text())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                outcome = 'timeout' if throttle.is_timeout(e) else 'error'
+                if attempt == MAX_ATTEMPTS:
+                    raise
+            finally:
+                self.throttle.record(time.time() - start_time, outcome)
+                async with self._slots:
+                    self._in_flight -= 1
+                    self._slots.notify_all()
+            await asyncio.sleep(2 ** attempt)
+
+    async def seasons(self):
+        """Return the seasons of the league, like the season dropdown of the site
+
+        :return: [(str, str)] (season name, season id), latest first
+        """
+        data = await self._get({'feed': 'modulekit', 'view': 'seasons'})
+        return [(season['season_name'], str(season['season_id'])) for season in data['SiteKit']['Seasons']]
+
+    async def season_rows(self, season_id):
+        """Return the skater rows of the stats table of a season, requesting it a page at a time
+
+        :param season_id: str
+        :return: [dict]
+        """
+        rows = []
+        while True:
+            data = await self._get({
+                'feed': 'statviewfeed', 'view': 'players', 'season': season_id, 'team': 'all',
+                'position': 'skaters', 'rookies': '0', 'statsType': 'standard', 'sort': 'points',
+                'first': str(len(rows)), 'limit': str(PAGE_ROWS),
+            })
+            page = [item['row'] for item in data[0]['sections'][0]['data']] if len(data) > 0 else []
+            rows += page
+            if len(page) < PAGE_ROWS:
+                return rows
+
+    async def player(self, player_id):
+        """Return the profile of a player
+
+        :param player_id: str
+        :return: dict, the 'info' object of the feed
+        """
+        data = await self._get({'feed': 'statviewfeed', 'view': 'player', 'player_id': player_id})
+        return data['info']
+
+
+async def _gather(league, base_url, method_name, args):
+    """Call a request method of a FeedClient once per argument, all concurrently, and return the results of the calls
+    that succeeded; a failed call (an HTTP error, a malformed response) is logged and left out, so it does not cost
+    the others their results
+
+    :return: {str: dict | list} argument: result
+    """
+    async with FeedClient(league, base_url) as client:
+        method = getattr(client, method_name)
+        results = await asyncio.gather(*[method(arg) for arg in args], return_exceptions=True)
+    print(str(client.request_counter) + " feed requests")
+    succeeded = {}
+    for arg, result in zip(args, results):
+        if isinstance(result, Exception):
+            print(league + " " + method_name + " " + str(arg) + " failed: " + type(result).__name__ + " " + str(result))
+        else:
+            succeeded[arg] = result
+    return succeeded
+
+
+def fetch_seasons(league, base_url=None):
+    """Return the seasons of a league from the feed
+
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
+    :param base_url: str | None, defaults to FEED_URL
+    :return: [(str, str)] (season name, season id)
+    """
+    return asyncio.run(_fetch_seasons(league, base_url))
+
+
+async def _fetch_seasons(league, base_url):
+    async with FeedClient(league, base_url) as client:
+        return await client.seasons()
+
+
+def fetch_season_rows(league, season_ids, base_url=None):
+    """Return the skater rows of several seasons, requested concurrently over one connection pool
+
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
+    :param season_ids: [str]
+    :param base_url: str | None, defaults to FEED_URL
+    :return: {str: [dict]} season id: rows, of the seasons requested successfully
+    """
+    return asyncio.run(_gather(league, base_url, 'season_rows', season_ids))
+
+
+def fetch_players(league, player_ids, base_url=None):
+    """Return the profiles of several players, requested concurrently over one connection pool
+
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
+    :param player_ids: [str]
+    :param base_url: str | None, defaults to FEED_URL
+    :return: {str: dict} player id: 'info' object of the feed, of the players requested successfully
+    """
+    return asyncio.run(_gather(league, base_url, 'player', player_ids))
@@ -1,10 +1,23 @@
-import sqlite3
-import os
 import time
 import datetime
 
-from random import randint
-from selenium import webdriver
+from multiprocessing import Process
+
+from common.archive import save_snapshot
+from common.browser import acquire_driver, create_driver, get_page
+from common.db import CHL_LEAGUES, bump_generation, connect, rebuild_table, table_is_current
+from common.dims import draft_ids
+from common.profiling import profile_run
+from common.search import index_player_names
+from chl import feed, playerseason
+
+
+# Site of every league, player pages are at <url>/players/<id>
+LEAGUE_URLS = {
+    'OHL': 'http://ontariohockeyleague.com',
+    'WHL': 'http://whl.ca',
+    'QMJHL': 'http://theqmjhl.ca',
+}
 
 
 class Birthplace:
@@ -63,60 +76,171 @@ class PlayerPage:
                "{:<10}".format("|Born in  " + str(self.birthplace))
 
 
-def _create_player_pages_table():
+def _ensure_player_pages_table(db_cursor):
+    """Utility function for creating the chl_player_pages table in a shard, if it does not exist yet
+
+    :param db_cursor: database cursor
+    :return:
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS chl_player_pages
+                         (
+                         id TEXT, league TEXT, name TEXT, num TEXT, pos TEXT, height REAL, weight REAL, birth_date TEXT,
+                         birth_city TEXT, birth_state TEXT, birth_country TEXT, shoots TEXT,
+                         nhl_draft_year TEXT, nhl_draft_team TEXT, nhl_draft_round TEXT, nhl_draft_overall TEXT,
+                         chl_draft_year TEXT, chl_draft_league, chl_draft_team TEXT, chl_draft_round TEXT,
+                         chl_draft_overall TEXT, nhl_draft_id INTEGER, chl_draft_id INTEGER,
+                         PRIMARY KEY (id, league)
+                         )
+                         ''')
+    db_cursor.execute('CREATE INDEX IF NOT EXISTS chl_player_pages_nhl_draft ON chl_player_pages (nhl_draft_id)')
+    db_cursor.execute('CREATE INDEX IF NOT EXISTS chl_player_pages_chl_draft ON chl_player_pages (chl_draft_id)')
+
+
+def _create_player_pages_table(league):
     """Utility function for creating/initializing the player_page table
 
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
     :return:
     """
-    conn = sqlite3.connect('hockey-stats.db')
+    conn = connect(league)
     c = conn.cursor()
     c.execute('DROP TABLE IF EXISTS chl_player_pages')
-    c.execute('''CREATE TABLE chl_player_pages
-                 (
-                 id TEXT, league TEXT, name TEXT, num TEXT, pos TEXT, height REAL, weight REAL, birth_date TEXT,
-                 birth_city TEXT, birth_state TEXT, birth_country TEXT, shoots TEXT,
-                 nhl_draft_year TEXT, nhl_draft_team TEXT, nhl_draft_round TEXT, nhl_draft_overall TEXT,
-                 chl_draft_year TEXT, chl_draft_league, chl_draft_team TEXT, chl_draft_round TEXT,
-                 chl_draft_overall TEXT,
-                 PRIMARY KEY (id, league)
-                 )
-                 ''')
+    _ensure_player_pages_table(c)
     conn.commit()
     conn.close()
 
 
-def _save_player_page(db_cursor, player_page):
-    """ Save a list of PlayerSeason objects to a database
+def _draft_ids(db_cursor, shard_league, rows):
+    """Return the NHL and CHL draft ids of chl_player_pages rows
+
+    :param db_cursor: database cursor
+    :param shard_league: 'OHL' | 'WHL' | 'QMJHL'
+    :param rows: [tuple], as returned by _player_page_row
+    :return: [(int, int)] (nhl_draft_id, chl_draft_id), None for missing drafts
+    """
+    nhl_keys = [('NHL',) + tuple(row[12:16]) for row in rows]
+    chl_keys = [(row[17],) + tuple(row[16:17]) + tuple(row[18:21]) for row in rows]  # (league, year, team, ...)
+    drafts = draft_ids(db_cursor, shard_league, nhl_keys + chl_keys)
+    return [(drafts.get(nhl_key), drafts.get(chl_key)) for nhl_key, chl_key in zip(nhl_keys, chl_keys)]
+
+
+def _upgraded_player_page_rows(db_cursor, rows):
+    """Return chl_player_pages rows saved with an older definition of the table as rows of the current one
+
+    :param db_cursor: database cursor
+    :param rows: [dict]
+    :return: [dict]
+    """
+    columns = [
+        'id', 'league', 'name', 'num', 'pos', 'height', 'weight', 'birth_date', 'birth_city', 'birth_state',
+        'birth_country', 'shoots', 'nhl_draft_year', 'nhl_draft_team', 'nhl_draft_round', 'nhl_draft_overall',
+        'chl_draft_year', 'chl_draft_league', 'chl_draft_team', 'chl_draft_round', 'chl_draft_overall'
+    ]
+    for league in set(row['league'] for row in rows):
+        league_rows = [row for row in rows if row['league'] == league]
+        ids = _draft_ids(db_cursor, league, [tuple(row[column] for column in columns) for row in league_rows])
+        for row, (nhl_draft_id, chl_draft_id) in zip(league_rows, ids):
+            row['nhl_draft_id'] = nhl_draft_id
+            row['chl_draft_id'] = chl_draft_id
+    return rows
+
+
+def _upgrade_player_pages_table(conn):
+    """Rebuild the chl_player_pages table of a shard with its current definition (draft ids), if it was created with
+    an older one, and store the unknown birth dates saved as 'None' as NULL
+
+    :param conn: connection to a CHL league shard
+    :return: bool, whether the table was rebuilt
+    """
+    c = conn.cursor()
+    if 'chl_player_pages' in set(row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")):
+        c.execute("UPDATE chl_player_pages SET birth_date = NULL WHERE birth_date = 'None'")
+        if c.rowcount > 0:
+            bump_generation(c, 'chl_player_pages')
+        conn.commit()
+    if table_is_current(conn.cursor(), 'chl_player_pages', _ensure_player_pages_table):
+        return False
+    rebuild_table(conn, 'chl_player_pages', _ensure_player_pages_table, _upgraded_player_page_rows)
+    return True
+
+
+def _player_page_row(player_page):
+    """Return the chl_player_pages table row representing a PlayerPage object
 
-    :param c: database cursor
     :param player_page: PlayerPage
-    :return: None
+    :return: tuple
     """
-    temp_player_page = (
+    return (
         player_page.id, player_page.league, player_page.name, player_page.num, player_page.pos, player_page.height,
-        player_page.weight, str(player_page.birth_date), player_page.birthplace.city, player_page.birthplace.state,
+        player_page.weight, str(player_page.birthdate) if player_page.birthdate is not None else None,
+        player_page.birthplace.city, player_page.birthplace.state,
         player_page.birthplace.country, player_page.shoots,
         player_page.nhl_draft.year, player_page.nhl_draft.team, player_page.nhl_draft.round,
         player_page.nhl_draft.overall,
         player_page.chl_draft.year, player_page.chl_draft.league, player_page.chl_draft.team,
         player_page.chl_draft.round, player_page.chl_draft.overall
     )
-    db_cursor.execute(
-        'INSERT INTO chl_player_pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-        temp_player_page)
+
+
+def _row_to_player_page(row):
+    """Return the PlayerPage object represented by a chl_player_pages table row
+
+    :param row: tuple
+    :return: PlayerPage
+    """
+    birthplace = Birthplace(row[8], row[9], row[10])
+    nhl_draft = NHL_Draft(row[12], row[13], row[14], row[15])
+    chl_draft = CHL_Draft(row[16], row[17], row[18], row[19], row[20])
+    return PlayerPage(
+        row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], birthplace, row[11], nhl_draft, chl_draft)
+
+
+def _save_player_pages(db_cursor, player_pages, replace=False):
+    """ Save a list of PlayerPage objects to a database
+
+    :param db_cursor: database cursor
+    :param player_pages: [PlayerPage]
+    :param replace: bool, overwrite pages already saved instead of failing on them
+    :return: None
+    """
+    if replace:
+        statement = 'INSERT OR REPLACE INTO chl_player_pages VALUES ' \
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    else:
+        statement = 'INSERT INTO chl_player_pages VALUES ' \
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    rows = []
+    for league in set(player_page.league for player_page in player_pages):
+        league_rows = [_player_page_row(player_page) for player_page in player_pages if player_page.league == league]
+        rows += [row + ids for row, ids in zip(league_rows, _draft_ids(db_cursor, league, league_rows))]
+    db_cursor.executemany(statement, rows)
+    bump_generation(db_cursor, 'chl_player_pages')
+    index_player_names(
+        db_cursor, [(player_page.id, player_page.league, player_page.name) for player_page in player_pages])
+
+
+def _save_player_page(db_cursor, player_page):
+    """ Save a PlayerPage object to a database
+
+    :param db_cursor: database cursor
+    :param player_page: PlayerPage
+    :return: None
+    """
+    _save_player_pages(db_cursor, [player_page])
     print(" saved")
 
 
-def _player_exists(db_cursor, player_id):
-    """Return whether or not the given player has already been grabbed
+def _player_exists(db_cursor, player_id, league):
+    """Return whether or not the given player of the given league has already been grabbed
 
     :param db_cursor: database cursor
-    :param player_id:  int
+    :param player_id: str
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
     :return: bool
     """
     checker = db_cursor.execute(
-        'SELECT * FROM chl_player_pages WHERE id=?',
-        (player_id,))
+        'SELECT * FROM chl_player_pages WHERE id=? AND league=?',
+        (player_id, league))
     if len(checker.fetchmany()) == 0:
         return False
     else:  # len(checker) >= 1
@@ -140,13 +264,21 @@ def _parse_birthdate(birth_str_raw):
 
 
 def _parse_birthplace(birthplace_str):
+    """Return a birthplace of 'City', 'City, ON' (a state or province), 'City, Sweden' or 'City, ON, Canada'
+
+    :param birthplace_str: str
+    :return: Birthplace
+    """
     state, country = None, None  # Default values
-    birthplace_str = birthplace_str.strip()
-    city, territory = birthplace_str.split(', ')
-    if territory.isupper():
-        state = territory
-    else:
-        country = territory
+    parts = [part.strip() for part in birthplace_str.strip().split(',')]
+    city = parts[0] or None
+    if len(parts) == 2:
+        if parts[1].isupper():
+            state = parts[1]
+        else:
+            country = parts[1]
+    elif len(parts) >= 3:
+        state, country = parts[1], ', '.join(parts[2:])
     return Birthplace(city, state, country)
 
 
@@ -186,10 +318,10 @@ def _parse_primary_element(primary_element):
     :param primary_element: WebDriver
     :return: str, str, str
     """
-    name = primary_element.find_element_by_class_name('player-profile-info__full-name')
+    name = primary_element.find_element_by_class_name('player-profile-info__full-name').text
     num_raw = primary_element.find_element_by_class_name('player-profile-info__number')
     num = _parse_nums(num_raw.text)
-    pos = primary_element.find_element_by_class_name('player-profile-info__position')
+    pos = primary_element.find_element_by_class_name('player-profile-info__position').text
     return name, num, pos
 
 def _parse_secondary_element(secondary_element, league):
@@ -240,7 +372,20 @@ def _parse_player_page(league, url_prefix, id_, driver):
     """
     url_complete = url_prefix + "/players/" + id_
 
-    driver.get(url_complete)
+    get_page(driver, url_complete)
+    save_snapshot('chl_player', league + '_' + id_, {'league': league, 'id': id_}, driver.page_source)
+    return _parse_loaded_player_page(league, id_, driver)
+
+
+def _parse_loaded_player_page(league, id_, driver):
+    """ Given a WebDriver <driver> already pointing to the <league> player page of <id_>, return the PlayerPage
+    object.
+
+    :param league: str
+    :param id_: str
+    :param driver: WebDriver
+    :return: PlayerPage
+    """
     # Get WebDriver containing info
     primary_element = driver.find_element_by_class_name('player-profile-primary')
     secondary_element = driver.find_element_by_class_name('player-profile-secondary')
@@ -252,48 +397,154 @@ def _parse_player_page(league, url_prefix, id_, driver):
     return PlayerPage(id_, league, name, num, pos, height, weight, birthdate, birthplace, shoots, nhl_draft, chl_draft)
 
 
-def save_player_pages(cap):
-    driver = webdriver.Chrome(executable_path=os.path.join(os.getcwd(), "driver\chromedriver.exe"))
-    conn = sqlite3.connect('hockey-stats.db')
+def _parse_feed_height(height_raw):
+    """Return a height of the feed ('6-1', '6.01', "6'1\"") in cm, or None
+
+    :param height_raw: str
+    :return: float | None
+    """
+    numbers = [part for part in ''.join(c if c.isdigit() else ' ' for c in height_raw or '').split()]
+    if len(numbers) != 2:
+        return None
+    return _ft_to_cm(int(numbers[0]), int(numbers[1]))
+
+
+def _parse_feed_player(league, id_, info):
+    """Return the profile of a player requested from the feed as a PlayerPage object
+
+    :param league: str
+    :param id_: str
+    :param info: dict, from feed.fetch_players
+    :return: PlayerPage
+    """
+    name = ((info.get('firstName') or '') + ' ' + (info.get('lastName') or '')).strip()
+    num = _parse_nums(str(info.get('jerseyNumber') or ''))
+    weight = float(info['weight']) * 0.453592 if str(info.get('weight') or '').isdigit() else None
+    try:
+        birthdate = _parse_birthdate(info['birthDate']) if info.get('birthDate') else None
+    except ValueError:  # Not a date, e.g. 'unknown'
+        birthdate = None
+    birthplace = _parse_birthplace(info.get('birthPlace') or '')
+    nhl_draft, chl_draft = NHL_Draft(None, None, None, None), CHL_Draft(None, None, None, None, None)
+    for draft in info.get('drafts') or []:
+        draft_year, draft_team = draft.get('draft_year'), draft.get('draft_team')
+        draft_round, overall = draft.get('draft_round'), _parse_nums(str(draft.get('draft_rank') or ''))
+        if draft.get('draft_league') == 'NHL':
+            nhl_draft = NHL_Draft(draft_year, draft_team, draft_round, overall)
+        else:
+            chl_draft = CHL_Draft(draft_year, league, draft_team, draft_round, overall)
+    return PlayerPage(
+        id_, league, name, num, info.get('position'), _parse_feed_height(info.get('height')), weight, birthdate,
+        birthplace, info.get('shoots'), nhl_draft, chl_draft)
+
+
+def _grab_feed_player_pages(league, ids, feed_url=None):
+    """Request the profiles of players of <league> from the feed, concurrently, and return them as PlayerPage objects
+
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
+    :param ids: [str]
+    :param feed_url: str | None, base url of the feed, defaults to feed.FEED_URL
+    :return: [PlayerPage], of the players whose profile could be requested and parsed
+    """
+    infos = feed.fetch_players(league, ids, feed_url)
+    player_pages = []
+    for id_ in ids:
+        if id_ not in infos:
+            continue
+        try:
+            player_pages.append(_parse_feed_player(league, id_, infos[id_]))
+        except Exception as e:  # A profile with unexpected values must not sink the whole batch
+            print(league + " player " + id_ + " could not be parsed: " + repr(e))
+    return player_pages
+
+
+def _missing_player_pages(league):
+    """Return the ids of the players of <league> with a saved season but no saved page
+
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
+    :return: [str]
+    """
+    conn = connect(league)  # A league's seasons and pages are both in its shard
+    playerseason._upgrade_player_seasons_table(conn)  # Saved rows and indexes need the columns of the current ones
+    _upgrade_player_pages_table(conn)
     c = conn.cursor()
+    playerseason._ensure_player_seasons_table(c)
+    _ensure_player_pages_table(c)
     c.execute(
-        'SELECT * FROM player_seasons')
-    all_seasons = c.fetchall()
-    num_seasons = len(all_seasons)
+        'SELECT DISTINCT id FROM chl_player_seasons AS seasons WHERE league = ? AND NOT EXISTS '
+        '(SELECT 1 FROM chl_player_pages AS pages WHERE pages.id = seasons.id AND pages.league = seasons.league) '
+        'ORDER BY id',
+        (league,))
+    ids = [row[0] for row in c.fetchall()]
+    conn.close()
+    return ids
+
+
+def _crawl_league_pages(league, ids, worker_number, feed_url=None, batch_size=50):
+    """Worker of the pool of a league: grab the pages of players of <league> and save them in the league's shard
 
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
+    :param ids: [str]
+    :param worker_number: int, tells the browser profiles of the workers of a league apart
+    :param feed_url: str | None, base url of the feed, for leagues crawled from the feed
+    :param batch_size: int, pages requested from the feed at once
+    :return: None
+    """
+    conn = connect(league)
+    c = conn.cursor()
     start_time = time.time()
     page_counter = 0
-
-    counter = 0
-    while counter < cap and counter < num_seasons:
-        curr_player_season = all_seasons[counter]
-        curr_player_id = curr_player_season[0]
-        curr_player_name = curr_player_season[1]
-        print('{0:.<40}'.format('Examining ' + curr_player_id + " " + curr_player_name), end='')
-        if not _player_exists(c, curr_player_id):
-            temp_player_page = _parse_player_page(curr_player_id, driver)
-            _save_player_page(c, temp_player_page)
-            page_counter += 1
+    if feed.backend(league) == 'feed':
+        for i in range(0, len(ids), batch_size):
+            player_pages = _grab_feed_player_pages(league, ids[i:i + batch_size], feed_url)
+            _save_player_pages(c, player_pages, replace=True)
             conn.commit()
-            time.sleep(randint(1, 5))
-        counter += 1
+            page_counter += len(player_pages)
+    else:
+        driver = acquire_driver(profile_name=league.lower() + '-' + str(worker_number))
+        for player_id in ids:
+            print('{0:.<40}'.format('Examining ' + league + ' ' + player_id), end='')
+            if not _player_exists(c, player_id, league):
+                temp_player_page = _parse_player_page(league, LEAGUE_URLS[league], player_id, driver)
+                _save_player_page(c, temp_player_page)
+                page_counter += 1
+                conn.commit()
+        driver.close()
+    conn.close()
+    print(league + " worker " + str(worker_number) + ": " + str(page_counter) + " pages saved. That took " +
+          str(time.time() - start_time) + " seconds")
 
 
-    total_time = time.time() - start_time
-    if page_counter == 0:
-        time_per_page = 0
-    else:
-        time_per_page = total_time/page_counter
-    print("That took " + str(total_time) + " seconds")
-    print(str(page_counter) + " pages saved. " + str(time_per_page) + " seconds per page")
+def save_player_pages(cap, leagues=None, workers_per_league=1, feed_url=None):
+    """Grab the pages of the players of the chl leagues with a saved season but no saved page, every league by its
+    own pool of worker processes so the leagues are crawled in parallel
+
+    :param cap: int, pages grabbed per league at most
+    :param leagues: [str] | None, defaults to every chl league
+    :param workers_per_league: int
+    :param feed_url: str | None, base url of the feed, for leagues crawled from the feed
+    :return: None
+    """
+    start_time = time.time()
+    workers = []
+    for league in leagues or CHL_LEAGUES:
+        ids = _missing_player_pages(league)[:cap]
+        print(league + ": " + str(len(ids)) + " pages to grab")
+        for worker_number in range(min(workers_per_league, len(ids))):
+            workers.append(Process(
+                target=_crawl_league_pages,
+                args=(league, ids[worker_number::workers_per_league], worker_number, feed_url)))
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print("That took " + str(time.time() - start_time) + " seconds")
 
-    driver.close()
-    conn.close()
 
 if __name__ == '__main__':
     '''
-    driver = webdriver.Chrome(executable_path=os.path.join(os.getcwd(), "driver\chromedriver.exe"))
-    conn = sqlite3.connect('hockey-stats.db')
+    driver = create_driver()
+    conn = connect('OHL')
     c = conn.cursor()
     temp_player = _parse_player_page('8471215', driver)
     _save_player_page(c, temp_player)
@@ -301,9 +552,10 @@ if __name__ == '__main__':
     conn.close()
     driver.close()
     '''
-    #_create_player_pages_table()
+    #_create_player_pages_table('OHL')
     #save_player_pages(2479)
-    driver = webdriver.Chrome(executable_path=os.path.join(os.getcwd(), "driver\chromedriver.exe"))
-    temp_player = _parse_player_page('OHL', 'http://ontariohockeyleague.com', '1906', driver)
-    driver.close()
+    with profile_run('chl_playerpage'):
+        driver = create_driver()
+        temp_player = _parse_player_page('OHL', 'http://ontariohockeyleague.com', '1906', driver)
+        driver.close()
 
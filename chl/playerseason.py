@@ -1,11 +1,19 @@
-import sqlite3
-import os
 import time
 import pickle
+import datetime
 
-from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
 
+from common.archive import save_snapshot
+from common.browser import acquire_driver, get_page
+from common.db import STRICT, bump_generation, connect, rebuild_table, table_is_current
+from common.dims import team_ids
+from common.history import record_history
+from common.leaderboards import update_leaderboards
+from common.profiling import mark_phase, profile_run
+from common.search import index_player_names
+from chl import feed
+
 
 class PlayerSeason:
     """Object representing a single players season. season_type = '2' for regular season or '3' for playoffs
@@ -70,154 +78,174 @@ def _parse_player(league, season_year, season_name, stats_list, headers_list):
     :param stats_list: [WebDriver]
     :return: PlayerSeason
     """
+    headers = [header.text for header in headers_list]
+    texts = [stat.text for stat in stats_list]
+    id_ = _parse_id(stats_list[headers.index('Name')])
+    return _parse_player_texts(league, season_year, season_name, id_, texts, headers)
+
+
+def _parse_player_texts(league, season_year, season_name, id_, texts, headers):
+    """ Return a PlayerSeason object given the text of every cell of a row of the stats table and of its headers.
+    Shared by the page parser and the bulk loader, so rows from both go through the same conversions.
+
+    :param league: str
+    :param season_year: str
+    :param season_name: str
+    :param id_: str
+    :param texts: [str]
+    :param headers: [str]
+    :return: PlayerSeason
+    """
     # Default values for statistics not present in every season
     sho_gp, sho_g, sho_att, sho_wg, sho_per = None, None, None, None, None
     fo_att, fow, fow_per = None, None, None
     # Parsing individual statistics
-    for header, stat in zip(headers_list, stats_list):
-        if header.text == 'Pos':
-            pos = stat.text
-        elif header.text == '#':
-            num = stat.text
-        elif header.text == 'Inactive':
-            if stat.text == 'X':
+    for header, stat in zip(headers, texts):
+        if header == 'Pos':
+            pos = stat
+        elif header == '#':
+            try:
+                num = int(stat)
+            except ValueError:
+                num = None
+        elif header == 'Inactive':
+            if stat == 'X':
                 active = True
             else:
                 active = False
-        elif header.text == 'Rookie':
-            if stat.text == '*':
+        elif header == 'Rookie':
+            if stat == '*':
                 rookie = True
             else:
                 rookie = False
-        elif header.text == 'Name':
-            name_raw = stat.text.split(',')
+        elif header == 'Name':
+            name_raw = stat.split(',')
             name = name_raw[1] + " " + name_raw[0]
-            id_ = _parse_id(stat)
-        elif header.text == 'Team':
-            team = stat.text
-        elif header.text == 'GP':
+        elif header == 'Team':
+            team = stat
+        elif header == 'GP':
             try:
-                gp = int(stat.text)
+                gp = int(stat)
             except ValueError:
                 gp = None
-        elif header.text == 'G':
+        elif header == 'G':
             try:
-                goals = int(stat.text)
+                goals = int(stat)
             except ValueError:
                 goals = None
-        elif header.text == 'A':
+        elif header == 'A':
             try:
-                assists = int(stat.text)
+                assists = int(stat)
             except ValueError:
                 assists = None
-        elif header.text == 'PTS':
+        elif header == 'PTS':
             try:
-                points = int(stat.text)
+                points = int(stat)
             except ValueError:
                 points = None
-        elif header.text == '+/-':
+        elif header == '+/-':
             try:
-                plus_minus = int(stat.text)
+                plus_minus = int(stat)
             except ValueError:
                 plus_minus = None
-        elif header.text == 'PIM':
+        elif header == 'PIM':
             try:
-                pim = int(stat.text)
+                pim = int(stat)
             except ValueError:
                 pim = None
-        elif header.text == 'PPG':
+        elif header == 'PPG':
             try:
-                ppg = int(stat.text)
+                ppg = int(stat)
             except ValueError:
                 ppg = None
-        elif header.text == 'PPA':
+        elif header == 'PPA':
             try:
-                ppa = int(stat.text)
+                ppa = int(stat)
             except ValueError:
                 ppa = None
-        elif header.text == 'SHG':
+        elif header == 'SHG':
             try:
-                shg = int(stat.text)
+                shg = int(stat)
             except ValueError:
                 shg = None
-        elif header.text == 'SHA':
+        elif header == 'SHA':
             try:
-                sha = int(stat.text)
+                sha = int(stat)
             except ValueError:
                 sha = None
-        elif header.text == 'SOG':
+        elif header == 'SOG':
             try:
-                sog = int(stat.text)
+                sog = int(stat)
             except ValueError:
                 sog = None
-        elif header.text == 'GWG':
+        elif header == 'GWG':
             try:
-                gwg = int(stat.text)
+                gwg = int(stat)
             except ValueError:
                 gwg = None
-        elif header.text == 'OTG':
+        elif header == 'OTG':
             try:
-                otg = int(stat.text)
+                otg = int(stat)
             except ValueError:
                 otg = None
-        elif header.text == 'First':
+        elif header == 'First':
             try:
-                first_g = int(stat.text)
+                first_g = int(stat)
             except ValueError:
                 first_g = None
-        elif header.text == 'Insurance':
+        elif header == 'Insurance':
             try:
-                insurance = int(stat.text)
+                insurance = int(stat)
             except ValueError:
                 insurance = None
-        elif header.text == 'SOGP':
+        elif header == 'SOGP':
             try:
-                sho_gp = int(stat.text)
+                sho_gp = int(stat)
             except ValueError:
                 sho_gp = None
-        elif header.text == 'SO-G':
+        elif header == 'SO-G':
             try:
-                sho_g = int(stat.text)
+                sho_g = int(stat)
             except ValueError:
                 sho_g = None
-        elif header.text == 'ATT':
+        elif header == 'ATT':
             try:
-                sho_att = int(stat.text)
+                sho_att = int(stat)
             except ValueError:
                 sho_att = None
-        elif header.text == 'SOWG':
+        elif header == 'SOWG':
             try:
-                sho_wg = int(stat.text)
+                sho_wg = int(stat)
             except ValueError:
                 sho_wg = None
-        elif header.text == 'SO%':
+        elif header == 'SO%':
             try:
-                sho_per = float(stat.text)
+                sho_per = float(stat)
             except ValueError:
                 sho_per = None
-        elif header.text == 'FOA':
+        elif header == 'FOA':
             try:
-                fo_att = int(stat.text)
+                fo_att = int(stat)
             except ValueError:
                 fo_att = None
-        elif header.text == 'FOW':
+        elif header == 'FOW':
             try:
-                fow = int(stat.text)
+                fow = int(stat)
             except ValueError:
                 fow = None
-        elif header.text == 'FO%':
+        elif header == 'FO%':
             try:
-                fow_per = float(stat.text)
+                fow_per = float(stat)
             except ValueError:
                 fow_per = None
-        elif header.text == 'PTS/G':
+        elif header == 'PTS/G':
             try:
-                p_g = float(stat.text)
+                p_g = float(stat)
             except ValueError:
                 p_g = None
-        elif header.text == 'PIM/G':
+        elif header == 'PIM/G':
             try:
-                pim_g = float(stat.text)
+                pim_g = float(stat)
             except ValueError:
                 pim_g = None
         else:
@@ -244,23 +272,71 @@ def _parse_id(element):
     return id_
 
 
-def _create_player_seasons_table():
+def _ensure_player_seasons_table(db_cursor):
+    """Utility function for creating the chl_player_seasons table in a shard, if it does not exist yet
+
+    :param db_cursor: database cursor
+    :return:
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS chl_player_seasons
+                         (
+                         league TEXT, id TEXT, num INTEGER, active INTEGER, rookie INTEGER, name TEXT, year TEXT,
+                         season_name TEXT, team TEXT,
+                         pos TEXT, gp INTEGER, goals INTEGER, assists INTEGER, points INTEGER, plus_minus INTEGER,
+                         pim INTEGER, ppg INTEGER, ppa INTEGER, shg INTEGER, sha INTEGER, s INTEGER, gwg INTEGER,
+                         otg INTEGER, first_g INTEGER, insurance_g INTEGER, sho_gp INTEGER, sho_g INTEGER, sho_att INTEGER,
+                         sho_wg INTEGER, sho_per REAL, fo_att INTEGER, fow INTEGER, fow_per REAL, p_g REAL, pim_g REAL,
+                         team_id INTEGER,
+                         PRIMARY KEY (id, season_name)
+                         )''' + STRICT)
+    db_cursor.execute(
+        'CREATE INDEX IF NOT EXISTS chl_player_seasons_team ON chl_player_seasons (team_id, season_name)')
+
+
+def _upgraded_player_season_rows(db_cursor, rows):
+    """Return chl_player_seasons rows saved with an older definition of the table as rows of the current one
+
+    :param db_cursor: database cursor
+    :param rows: [dict]
+    :return: [dict]
+    """
+    teams = {}
+    for league in set(row['league'] for row in rows):
+        teams.update(team_ids(db_cursor, league, [(league, row['team']) for row in rows if row['league'] == league]))
+    for row in rows:
+        if isinstance(row['num'], str):  # Saved as the text of the stats table
+            try:
+                row['num'] = int(row['num'])
+            except ValueError:
+                row['num'] = None
+        for column in ['active', 'rookie']:
+            if row[column] is not None:
+                row[column] = int(row[column])
+        row['team_id'] = teams.get((row['league'], row['team']))
+    return rows
+
+
+def _upgrade_player_seasons_table(conn):
+    """Rebuild the chl_player_seasons table of a shard with its current definition (typed columns, team ids), if it
+    was created with an older one
+
+    :param conn: sqlite3.Connection
+    :return: None
+    """
+    if not table_is_current(conn.cursor(), 'chl_player_seasons', _ensure_player_seasons_table):
+        rebuild_table(conn, 'chl_player_seasons', _ensure_player_seasons_table, _upgraded_player_season_rows)
+
+
+def _create_player_seasons_table(league):
     """Utility function for creating/initializing the player_seasons table
 
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
     :return:
     """
-    conn = sqlite3.connect('hockey-stats.db')
+    conn = connect(league)
     c = conn.cursor()
     c.execute('DROP TABLE IF EXISTS chl_player_seasons')
-    c.execute('''CREATE TABLE chl_player_seasons
-                 (
-                 league TEXT, id TEXT, num INTEGER, active BOOLEAN, rookie BOOLEAN, name TEXT, year TEXT, season_name TEXT, team TEXT,
-                 pos TEXT, gp INTEGER, goals INTEGER, assists INTEGER, points INTEGER, plus_minus INTEGER,
-                 pim INTEGER, ppg INTEGER, ppa INTEGER, shg INTEGER, sha INTEGER, s INTEGER, gwg INTEGER, otg INTEGER,
-                 first_g INTEGER, insurance_g INTEGER, sho_gp INTEGER, sho_g INTEGER, sho_att INTEGER,
-                 sho_wg INTEGER, sho_per REAL, fo_att INTEGER, fow INTEGER, fow_per REAL, p_g REAL, pim_g REAL,
-                 PRIMARY KEY (id, season_name)
-                 )''')
+    _ensure_player_seasons_table(c)
     conn.commit()
     conn.close()
 
@@ -301,6 +377,33 @@ def _parse_season_yr(season_yr_raw):
     return season_yr
 
 
+def _parse_season_type(season_name):
+    """Given a season name, return the kind of season using nhl.com codes: '1' for pre-season, '2' for regular season
+    and '3' for playoffs
+
+    :param season_name: str
+    :return: '1' | '2' | '3'
+    """
+    season_name = season_name.lower()
+    if 'playoff' in season_name:
+        return '3'
+    elif 'pre' in season_name and 'season' in season_name:
+        return '1'
+    else:
+        return '2'
+
+
+def _find_rows_after(num_rows, driver):
+    """Return the rows of the stats table that come after the first <num_rows> rows, in table order
+
+    :param num_rows: int
+    :param driver: WebDriver
+    :return: [WebDriver]
+    """
+    return driver.find_elements_by_xpath(
+        "(//*[contains(concat(' ', normalize-space(@class), ' '), ' table__tr ')])[position() > {}]".format(num_rows))
+
+
 def _grab_single_season(league, season_name, url_frag, chl_url, driver):
     """Visit a page of a chl city representing a single season and grab and return the data
 
@@ -312,29 +415,66 @@ def _grab_single_season(league, season_name, url_frag, chl_url, driver):
     """
     player_seasons = []
     url_complete = chl_url + '/stats/players/' + url_frag
-    driver.get(url_complete)
-    time.sleep(5)  # Let the user actually see something!
-    # Expand view of player seasons until no more seasons are revealed
+    get_page(driver, url_complete)
+    time.sleep(5)  # Let the stats table render
+    season_year = _parse_season_yr(season_name)
     button_load_element = driver.find_element_by_class_name('button-load')
-    player_seasons_driver = driver.find_elements_by_class_name('table__tr')
-    prev_num_players = 0
-    curr_num_players = len(player_seasons_driver)
-    while curr_num_players != prev_num_players:
+    headers_list = None
+    num_rows = 0  # Rows of the table (headers row included) already parsed
+    # Parse the rows revealed by each expansion as they appear, until an expansion reveals no more rows
+    new_rows = _find_rows_after(num_rows, driver)
+    while len(new_rows) > 0:
+        for temp_row in new_rows:
+            if headers_list is None:  # First row of the table holds the headers
+                headers_list = temp_row.find_elements_by_tag_name('th')
+                continue
+            temp_stats = temp_row.find_elements_by_tag_name('td')
+            temp_player_season = _parse_player(league, season_year, season_name, temp_stats, headers_list)
+            player_seasons.append(temp_player_season)
+            print(temp_player_season)
+        num_rows += len(new_rows)
         button_load_element.click()
         time.sleep(5)
-        player_seasons_driver = driver.find_elements_by_class_name('table__tr')
-        prev_num_players = curr_num_players
-        curr_num_players = len(player_seasons_driver)
-    player_seasons_driver = iter(player_seasons_driver)
-    headers_list_raw = next(player_seasons_driver)  # Store headers row
-    headers_list = headers_list_raw.find_elements_by_tag_name('th')
+        new_rows = _find_rows_after(num_rows, driver)
+    meta = {'league': league, 'season_name': season_name, 'url_frag': url_frag}
+    save_snapshot('chl_season', league + '_' + url_frag, meta, driver.page_source)
+    return player_seasons
+
+
+def _parse_season_page(league, season_name, driver):
+    """Given a WebDriver <driver> pointing to a fully expanded season stats page, parse every row of the stats table
+    and return the data
+
+    :param league: str
+    :param season_name: str
+    :param driver: WebDriver
+    :return: [PlayerSeason]
+    """
+    player_seasons = []
+    rows = driver.find_elements_by_class_name('table__tr')
+    if len(rows) == 0:
+        return player_seasons
+    headers_list = rows[0].find_elements_by_tag_name('th')
     season_year = _parse_season_yr(season_name)
-    # Parse player statistics and save create PlayerSeason objects
-    for temp_row in player_seasons_driver:
+    for temp_row in rows[1:]:
         temp_stats = temp_row.find_elements_by_tag_name('td')
-        temp_player_season = _parse_player(league, season_year, season_name, temp_stats, headers_list)
-        player_seasons.append(temp_player_season)
-        print(temp_player_season)
+        player_seasons.append(_parse_player(league, season_year, season_name, temp_stats, headers_list))
+    return player_seasons
+
+
+def _parse_feed_season(league, season_name, rows):
+    """Return the skater rows of a season requested from the feed as PlayerSeason objects
+
+    :param league: str
+    :param season_name: str
+    :param rows: [dict], from feed.fetch_season_rows
+    :return: [PlayerSeason]
+    """
+    season_year = _parse_season_yr(season_name)
+    player_seasons = []
+    for row in rows:
+        id_, texts, headers = feed.season_row_texts(row)
+        player_seasons.append(_parse_player_texts(league, season_year, season_name, id_, texts, headers))
     return player_seasons
 
 
@@ -348,41 +488,136 @@ def _get_seasons_attr(url, driver):
     '''
     seasons_attr = []
     url_complete = url + '/stats/players/'
-    driver.get(url_complete)
-    season_types_menu = driver.find_element_by_class_name('full-scores__dropdown--season-select')
-    season_types_raw = season_types_menu.find_elements_by_class_name('filter-group__dropdown-option')
-    for item in season_types_raw:
-        url_frag_raw = item.get_attribute('data-reactid')
+    get_page(driver, url_complete)
+    # One script call rather than two driver round trips per season in the dropdown
+    options = driver.execute_script(
+        "return Array.prototype.map.call(document.querySelectorAll("
+        "'.full-scores__dropdown--season-select .filter-group__dropdown-option'), "
+        "function (option) { return [option.getAttribute('data-reactid'), option.innerText.trim()]; });")
+    for url_frag_raw, season_name in options:
         url_frag = url_frag_raw.split('$')[1]
-        season_name = item.text
         seasons_attr.append((season_name, url_frag))
     return seasons_attr
 
 
-def save_league_seasons(league, chl_url):
-    """Visit chl url, grab player season statistics from every season, and save them in a database
+def _ensure_seasons_table(db_cursor):
+    """Utility function for creating the chl_seasons catalogue in a shard, if it does not exist yet
 
-    :param start_year:
-    :param end_year:
+    :param db_cursor: database cursor
     :return:
     """
-    driver = webdriver.Chrome(executable_path=os.path.join(os.getcwd(), "driver\chromedriver.exe"))
-    conn = sqlite3.connect('hockey-stats.db')
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS chl_seasons
+                         (
+                         league TEXT, season_name TEXT, url_frag TEXT, year TEXT, season_type TEXT,
+                         complete BOOLEAN, num_rows INTEGER, first_seen TEXT, last_crawled TEXT,
+                         PRIMARY KEY (league, season_name)
+                         )''')
+
+
+def _sync_season_catalogue(db_cursor, league, seasons_attr):
+    """Bring the chl_seasons catalogue of <league> up to date with the site's season dropdown, and return the
+    seasons to crawl: those new to the catalogue and those not complete yet.
+
+    Seasons of the latest year are never complete, as they may still be under way. Seasons already saved before
+    the catalogue existed are entered as crawled.
+
+    :param db_cursor: database cursor
+    :param league: str
+    :param seasons_attr: [(str, str)] (season name, url frag), from _get_seasons_attr
+    :return: [(str, str)] (season name, url frag), in dropdown order
+    """
+    _ensure_seasons_table(db_cursor)
+    db_cursor.execute('SELECT season_name, url_frag FROM chl_seasons WHERE league = ?', (league,))
+    catalogue = dict(db_cursor.fetchall())
+    now = datetime.datetime.now().isoformat(' ', 'seconds')
+    new_counter = 0
+    saved_seasons = []
+    for season_name, url_frag in seasons_attr:
+        if season_name not in catalogue:
+            db_cursor.execute(
+                'INSERT INTO chl_seasons VALUES (?, ?, ?, ?, ?, 0, NULL, ?, NULL)',
+                (league, season_name, url_frag, _parse_season_yr(season_name), _parse_season_type(season_name), now))
+            if _season_exists(db_cursor, season_name):
+                saved_seasons.append(season_name)
+            else:
+                new_counter += 1
+        elif catalogue[season_name] != url_frag:
+            db_cursor.execute(
+                'UPDATE chl_seasons SET url_frag = ? WHERE league = ? AND season_name = ?',
+                (url_frag, league, season_name))
+    for season_name in saved_seasons:  # Once every season is in, so the latest year is known
+        _mark_season_crawled(db_cursor, league, season_name)
+    # A new year makes the seasons of the previous one complete once they are crawled again
+    db_cursor.execute(
+        'SELECT season_name FROM chl_seasons WHERE league = ? AND NOT complete', (league,))
+    incomplete = set(row[0] for row in db_cursor.fetchall())
+    bump_generation(db_cursor, 'chl_seasons')
+    print(str(new_counter) + " new seasons, " + str(len(incomplete)) + " seasons to crawl")
+    return [(season_name, url_frag) for season_name, url_frag in seasons_attr if season_name in incomplete]
+
+
+def _mark_season_crawled(db_cursor, league, season_name):
+    """Record in the catalogue that a season has just been saved, complete unless it is of the latest year
+
+    :param db_cursor: database cursor
+    :param league: str
+    :param season_name: str
+    :return: None
+    """
+    db_cursor.execute(
+        'UPDATE chl_seasons SET '
+        'complete = year < (SELECT max(year) FROM chl_seasons WHERE league = ?), '
+        'num_rows = (SELECT count(*) FROM chl_player_seasons WHERE league = ? AND season_name = ?), '
+        'last_crawled = ? '
+        'WHERE league = ? AND season_name = ?',
+        (league, league, season_name, datetime.datetime.now().isoformat(' ', 'seconds'), league, season_name))
+    bump_generation(db_cursor, 'chl_seasons')
+
+
+def save_league_seasons(league, chl_url, backend=None, feed_url=None):
+    """Visit chl url, grab player season statistics from every season new to the season catalogue or not complete
+    yet, and save them in a database
+
+    :param league: 'OHL' | 'WHL' | 'QMJHL'
+    :param chl_url: str
+    :param backend: 'browser' | 'feed' | None, defaults to the backend of the league in feed.BACKENDS
+    :param feed_url: str | None, base url of the feed, defaults to feed.FEED_URL
+    :return:
+    """
+    backend = backend or feed.backend(league)
+    conn = connect(league)
+    _upgrade_player_seasons_table(conn)  # Saved rows and indexes need the columns of the current definition
     c = conn.cursor()
+    _ensure_player_seasons_table(c)
 
     start_time = time.time()
     season_counter = 0
 
-    seasons_attr = _get_seasons_attr(chl_url, driver)  # [(season name, url frag)]
+    if backend == 'feed':
+        driver = None
+        seasons_attr = feed.fetch_seasons(league, feed_url)  # The feed's season ids are the site's url frags
+    else:
+        driver = acquire_driver()
+        seasons_attr = _get_seasons_attr(chl_url, driver)  # [(season name, url frag)]
+    to_crawl = _sync_season_catalogue(c, league, seasons_attr)
+    conn.commit()
 
-    for item in seasons_attr:
-        season_name, url_frag = item
-        if not _season_exists(c, season_name):
+    if backend == 'feed':  # Every season is requested at once over the connection pool
+        feed_rows = feed.fetch_season_rows(league, [url_frag for _, url_frag in to_crawl], feed_url)
+    for season_name, url_frag in to_crawl:
+        if backend == 'feed':
+            if url_frag not in feed_rows:  # Failed, left uncrawled in the catalogue for the next crawl
+                continue
+            temp_single_season = _parse_feed_season(league, season_name, feed_rows.pop(url_frag))
+        else:
             temp_single_season = _grab_single_season(league, season_name, url_frag, chl_url, driver)
-            _save_player_seasons(c, temp_single_season)
-            season_counter += 1
-            conn.commit()
-    driver.close()
+        _save_player_seasons(c, temp_single_season, replace=True)  # Incomplete seasons are saved again
+        _mark_season_crawled(c, league, season_name)
+        season_counter += 1
+        conn.commit()
+        mark_phase(season_name)
+    if driver is not None:
+        driver.close()
 
     total_time = time.time() - start_time
     if season_counter == 0:
@@ -395,37 +630,85 @@ def save_league_seasons(league, chl_url):
     conn.close()
 
 
-def _save_player_seasons(c, player_seasons):
+def _player_season_row(player_season):
+    """Return the chl_player_seasons table row representing a PlayerSeason object
+
+    :param player_season: PlayerSeason
+    :return: tuple
+    """
+    return (
+        player_season.league, player_season.id, player_season.num, player_season.active, player_season.rookie,
+        player_season.name, player_season.year, player_season.season_name, player_season.team,
+        player_season.pos, player_season.gp, player_season.goals, player_season.assists,
+        player_season.points, player_season.plus_minus, player_season.pim, player_season.ppg, player_season.ppa,
+        player_season.shg, player_season.sha, player_season.s, player_season.gwg, player_season.otg, player_season.first_g,
+        player_season.insurance_g, player_season.sho_gp, player_season.sho_g, player_season.sho_att,
+        player_season.sho_wg, player_season.sho_per, player_season.fo_att, player_season.fow,
+        player_season.fow_per, player_season.p_g, player_season.pim_g
+    )
+
+
+def _row_to_player_season(row):
+    """Return the PlayerSeason object represented by a chl_player_seasons table row
+
+    :param row: tuple
+    :return: PlayerSeason
+    """
+    player_season = PlayerSeason(*row[:35])
+    if player_season.active is not None:
+        player_season.active = bool(player_season.active)
+    if player_season.rookie is not None:
+        player_season.rookie = bool(player_season.rookie)
+    return player_season
+
+
+def _save_player_seasons(c, player_seasons, replace=False):
     """ Save a list of PlayerSeason objects to a database
 
     :param c: database cursor
     :param player_seasons: [PlayerSeason]
+    :param replace: bool, overwrite rows already saved instead of failing on them
     :return:
     """
-    for player_season in player_seasons:
-        temp_player = (
-            player_season.league, player_season.id, player_season.num, player_season.active, player_season.rookie,
-            player_season.name, player_season.year, player_season.season_name, player_season.team,
-            player_season.pos, player_season.gp, player_season.goals, player_season.assists,
-            player_season.points, player_season.plus_minus, player_season.pim, player_season.ppg, player_season.ppa,
-            player_season.shg, player_season.sha, player_season.s, player_season.gwg, player_season.otg, player_season.first_g,
-            player_season.insurance_g, player_season.sho_gp, player_season.sho_g, player_season.sho_att,
-            player_season.sho_wg, player_season.sho_per, player_season.fo_att, player_season.fow,
-            player_season.fow_per, player_season.p_g, player_season.pim_g
-        )
-        c.execute(
-            'INSERT INTO chl_player_seasons VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            temp_player)
-    try:
-        print(player_season.season_name + " saved")
-    except UnboundLocalError:
+    if replace:
+        statement = 'INSERT OR REPLACE INTO chl_player_seasons VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ' \
+                    '?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    else:
+        statement = 'INSERT INTO chl_player_seasons VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ' \
+                    '?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    teams = {}
+    for league in set(player_season.league for player_season in player_seasons):
+        teams.update(team_ids(
+            c, league, [(league, player_season.team) for player_season in player_seasons
+                        if player_season.league == league]))
+    rows = [
+        _player_season_row(player_season) + (teams.get((player_season.league, player_season.team)),)
+        for player_season in player_seasons
+    ]
+    record_history(c, 'chl_player_seasons', rows)
+    c.executemany(statement, rows)
+    update_leaderboards(c, 'chl_player_seasons', rows)
+    bump_generation(c, 'chl_player_seasons')
+    index_player_names(
+        c, [(player_season.id, player_season.league, player_season.name) for player_season in player_seasons])
+    if len(player_seasons) > 0:
+        print(player_seasons[0].season_name + " saved")
+    else:
         print('empty season visited')
 
 
-
 if __name__ == "__main__":
-    # _create_player_seasons_table()
-    save_league_seasons('OHL', 'http://ontariohockeyleague.com')
-
-    # driver = webdriver.Chrome(executable_path=os.path.join(os.getcwd(), "driver\chromedriver.exe"))
+    from analytics.comparables import update_comparables_index
+    from analytics.features import update_season_features
+    from analytics.seasonmatrix import update_season_matrix
+
+    # _create_player_seasons_table('OHL')
+    with profile_run('chl_playerseason') as profiler:
+        save_league_seasons('OHL', 'http://ontariohockeyleague.com')
+        profiler.phase('crawl')
+        update_comparables_index()
+        update_season_matrix()
+        update_season_features()
+
+    # driver = create_driver()
     # temp_single_season = _grab_single_season('OHL', '2005 Playoffs', '25', 'http://ontariohockeyleague.com', driver)
@@ -0,0 +1,68 @@
+import os
+import gzip
+import json
+
+
+ARCHIVE_DIR = os.path.join(os.getcwd(), 'archive')
+
+
+def _snapshot_path(kind, key):
+    """Return the path of the archived snapshot of kind <kind> and key <key>
+
+    :param kind: 'nhl_season' | 'nhl_player' | 'chl_season' | 'chl_player'
+    :param key: str
+    :return: str
+    """
+    return os.path.join(ARCHIVE_DIR, kind, key + '.html.gz')
+
+
+def save_snapshot(kind, key, meta, page_source):
+    """Archive the html of a page that has just been scraped, along with what is needed to parse it again
+
+    Snapshots are stored as archive/<kind>/<key>.html.gz, with <meta> written as json on the first line. A later
+    snapshot of the same page replaces the earlier one.
+
+    :param kind: 'nhl_season' | 'nhl_player' | 'chl_season' | 'chl_player'
+    :param key: str
+    :param meta: dict
+    :param page_source: str
+    :return: None
+    """
+    path = _snapshot_path(kind, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(meta) + '\n')
+        f.write(page_source)
+    os.replace(path + '.tmp', path)
+
+
+def load_snapshot(path):
+    """Return the kind, meta and html of the archived snapshot at <path>
+
+    :param path: str
+    :return: str, dict, str
+    """
+    kind = os.path.basename(os.path.dirname(path))
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        meta = json.loads(f.readline())
+        page_source = f.read()
+    return kind, meta, page_source
+
+
+def list_snapshots(kinds=None):
+    """Return the paths of every archived snapshot, optionally restricted to the given kinds
+
+    :param kinds: [str] | None
+    :return: [str]
+    """
+    paths = []
+    if not os.path.isdir(ARCHIVE_DIR):
+        return paths
+    for kind in sorted(os.listdir(ARCHIVE_DIR)):
+        if kinds is not None and kind not in kinds:
+            continue
+        kind_dir = os.path.join(ARCHIVE_DIR, kind)
+        for file_name in sorted(os.listdir(kind_dir)):
+            if file_name.endswith('.html.gz'):
+                paths.append(os.path.join(kind_dir, file_name))
+    return paths
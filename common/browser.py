@@ -0,0 +1,396 @@
+import os
+import time
+import atexit
+import threading
+
+from collections import deque
+
+from selenium import webdriver
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+
+from common import throttle
+from common.profiling import profile_run
+
+try:
+    import psutil
+except ImportError:  # Without psutil, pooled sessions are recycled by page count only
+    psutil = None
+
+
+CHROMEDRIVER_PATH = os.path.join(os.getcwd(), "driver\chromedriver.exe")
+PROFILES_DIR = os.path.join(os.getcwd(), "driver\profiles")
+
+# Content settings understood by Chrome: 1 = allow, 2 = block
+BLOCKED_CONTENT_PREFS = {
+    'profile.managed_default_content_settings.images': 2,
+    'profile.managed_default_content_settings.stylesheets': 2,
+    'profile.managed_default_content_settings.fonts': 2,
+    'profile.managed_default_content_settings.media_stream': 2,
+    'profile.managed_default_content_settings.plugins': 2,
+    'profile.managed_default_content_settings.popups': 2,
+    'profile.managed_default_content_settings.notifications': 2,
+    'profile.managed_default_content_settings.geolocation': 2,
+}
+
+# Requests dropped by the browser before they leave the machine (Network.setBlockedURLs patterns)
+BLOCKED_URL_PATTERNS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.webp', '*.ico',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*.css',
+    '*.mp4', '*.webm', '*.m3u8', '*.mp3',
+    '*google-analytics.com*', '*googletagmanager.com*', '*googletagservices.com*', '*doubleclick.net*',
+    '*googlesyndication.com*', '*facebook.net*', '*facebook.com/tr*', '*scorecardresearch.com*',
+    '*omtrdc.net*', '*adobedtm.com*', '*demdex.net*', '*chartbeat.com*', '*chartbeat.net*',
+    '*quantserve.com*', '*krxd.net*', '*amazon-adsystem.com*', '*adsrvr.org*', '*twitter.com/i/*',
+    '*bam.nr-data.net*', '*optimizely.com*', '*hotjar.com*',
+]
+PAGE_LOAD_TIMEOUT_SECONDS = 60  # A page taking longer raises a TimeoutException, which slows the crawl of its host
+RECYCLE_PAGES = 500  # Pages a pooled session loads before it is replaced by a fresh one
+RECYCLE_RSS_MB = 1500  # Memory of a pooled session's chromedriver and browser processes that gets it replaced
+RSS_CHECK_PAGES = 20  # Pages between two measures of a session's memory
+SPARE_SESSIONS = 1  # Sessions kept started and idle, so a recycled or crashed one is replaced without waiting
+
+
+def create_driver(headless=True, lean=True, profile_name='default'):
+    """Return a Chrome WebDriver shared by every scraper.
+
+    A lean driver blocks images, stylesheets, fonts, media and third-party trackers, stops waiting for a page once
+    its DOM is ready (page load strategy 'eager') and keeps its profile in driver/profiles/<profile_name> so the
+    browser cache survives between runs. Two drivers running at the same time need different profile names.
+
+    :param headless: bool
+    :param lean: bool
+    :param profile_name: str
+    :return: WebDriver
+    """
+    options = webdriver.ChromeOptions()
+    capabilities = DesiredCapabilities.CHROME.copy()
+    if headless:
+        options.add_argument('--headless')
+        options.add_argument('--disable-gpu')
+        options.add_argument('--window-size=1920,1080')
+    if lean:
+        options.add_argument('--user-data-dir=' + os.path.join(PROFILES_DIR, profile_name))
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_argument('--disable-extensions')
+        options.add_argument('--mute-audio')
+        options.add_experimental_option('prefs', BLOCKED_CONTENT_PREFS)
+        capabilities['pageLoadStrategy'] = 'eager'
+
+    driver = webdriver.Chrome(
+        executable_path=CHROMEDRIVER_PATH, options=options, desired_capabilities=capabilities)
+    driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT_SECONDS)
+    if lean:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URL_PATTERNS})
+    return driver
+
+
+def get_page(driver, url):
+    """Point <driver> to <url>, paced by the adaptive controller of the url's host (see common/throttle.py): after
+    a pause that shortens while the host answers fast and without errors, and recording how long the page took
+
+    :param driver: WebDriver
+    :param url: str
+    :return: None
+    """
+    host_controller = throttle.controller(url)
+    host_controller.pause()
+    with host_controller.timed():
+        driver.get(url)
+
+
+
+def _session_rss_mb(driver):
+    """Return the resident memory of <driver>'s chromedriver and of every browser process under it, in MB, or None
+    without psutil
+
+    :param driver: WebDriver
+    :return: float | None
+    """
+    if psutil is None:
+        return None
+    try:
+        service_process = psutil.Process(driver.service.process.pid)
+        processes = [service_process] + service_process.children(recursive=True)
+        rss = 0
+        for process in processes:
+            try:
+                rss += process.memory_info().rss
+            except psutil.NoSuchProcess:  # Exited while measured
+                pass
+        return rss / 2**20
+    except (AttributeError, psutil.Error):
+        return None
+
+
+def _is_alive(driver):
+    """Return whether the browser of <driver> still answers"""
+    try:
+        driver.current_window_handle
+        return True
+    except Exception:
+        return False
+
+
+class PooledDriver:
+    """WebDriver borrowed from a BrowserPool. It is used like the driver it wraps, but a session that has loaded
+    RECYCLE_PAGES pages or grown past RECYCLE_RSS_MB is swapped for a warm one before the next page, and a session
+    whose browser crashed is swapped and the page loaded again. close() and quit() give it back to the pool.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._session = pool._take()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):  # Not set yet, if borrowing the session failed
+            raise AttributeError(name)
+        return getattr(self._session.driver, name)
+
+    def get(self, url):
+        session = self._session
+        if session.pages >= RECYCLE_PAGES:
+            self._swap(str(session.pages) + ' pages')
+        elif session.pages > 0 and session.pages % RSS_CHECK_PAGES == 0:
+            rss = _session_rss_mb(session.driver)
+            if rss is not None and rss > RECYCLE_RSS_MB:
+                self._swap('{:.0f} MB'.format(rss))
+        try:
+            self._session.driver.get(url)
+        except Exception as e:
+            if _is_alive(self._session.driver):
+                raise  # A timeout or an error of the page, not of the browser
+            self._pool.crashes += 1
+            self._swap('crashed: ' + type(e).__name__)
+            self._session.driver.get(url)
+        self._session.pages += 1
+
+    def _swap(self, reason):
+        print(' [' + self._session.profile_name + ' recycled, ' + reason + '] ', end='')
+        old_session = self._session
+        self._session = self._pool._take()
+        self._pool._retire(old_session)
+
+    def close(self):
+        if self._session is not None:
+            self._pool._give_back(self._session)
+            self._session = None
+
+    quit = close
+
+
+class _Session:
+
+    def __init__(self, driver, profile_name):
+        self.driver = driver
+        self.profile_name = profile_name
+        self.pages = 0
+
+
+class BrowserPool:
+    """Warm Chrome sessions of one process, shared by every crawl it runs.
+
+    Sessions are started ahead of need in background threads, so borrowing one rarely waits for a browser to start;
+    a session given back stays open for the next borrower, and is replaced once it is worn (see PooledDriver). Every
+    open session has its own profile, <profile_name>, <profile_name>-1, ..., so their caches survive between runs.
+    close() quits every open session, borrowed ones included.
+    """
+
+    def __init__(self, profile_name='default', headless=True, lean=True, spares=SPARE_SESSIONS):
+        self.profile_name = profile_name
+        self.headless = headless
+        self.lean = lean
+        self.spares = spares
+        self.started = 0
+        self.recycled = 0
+        self.crashes = 0
+        self._idle = deque()
+        self._sessions = set()  # Every session started and not quit yet, idle or borrowed
+        self._starting = 0
+        self._profiles_in_use = set()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._start_error = None  # Of the last session that failed to start, raised to a borrower waiting for one
+
+    def acquire(self):
+        """Borrow a warm session
+
+        :return: PooledDriver
+        """
+        return PooledDriver(self)
+
+    def _take(self):
+        with self._condition:
+            while len(self._idle) == 0:
+                if self._closed:
+                    raise RuntimeError('Browser pool ' + self.profile_name + ' is closed')
+                if self._starting == 0:
+                    if self._start_error is not None:
+                        error, self._start_error = self._start_error, None
+                        raise error
+                    self._start_session()
+                self._condition.wait()
+            session = self._idle.popleft()
+            self._fill_spares()
+            return session
+
+    def _give_back(self, session):
+        if not self._closed and session.pages < RECYCLE_PAGES and _is_alive(session.driver):
+            with self._condition:
+                if not self._closed:
+                    self._idle.append(session)
+                    self._condition.notify()
+                    return
+        self._retire(session)  # Worn, crashed, or given back after close()
+
+    def _retire(self, session):
+        with self._condition:
+            if session not in self._sessions:  # Already quit by close()
+                return
+            self._sessions.discard(session)
+            if not self._closed:
+                self.recycled += 1
+        try:
+            session.driver.quit()
+        except Exception:  # Already gone with a crashed browser
+            pass
+        with self._condition:
+            self._profiles_in_use.discard(session.profile_name)  # Only once its browser let go of the profile
+            self._fill_spares()
+
+    def _fill_spares(self):
+        """Start sessions until <spares> are idle or starting. The condition is held."""
+        while not self._closed and len(self._idle) + self._starting < self.spares:
+            self._start_session()
+
+    def _start_session(self):
+        """Start a session in a background thread. The condition is held."""
+        index = 0
+        while self._profile(index) in self._profiles_in_use:
+            index += 1
+        profile_name = self._profile(index)
+        self._profiles_in_use.add(profile_name)
+        self._starting += 1
+        threading.Thread(target=self._run_start, args=(profile_name,), daemon=True).start()
+
+    def _profile(self, index):
+        return self.profile_name if index == 0 else self.profile_name + '-' + str(index)
+
+    def _run_start(self, profile_name):
+        driver, error = None, None
+        try:
+            driver = create_driver(self.headless, self.lean, profile_name)
+        except Exception as e:
+            error = e
+        with self._condition:
+            self._starting -= 1
+            if driver is None:
+                self._profiles_in_use.discard(profile_name)
+                self._start_error = error
+            elif self._closed:
+                driver.quit()
+            else:
+                self.started += 1
+                session = _Session(driver, profile_name)
+                self._sessions.add(session)
+                self._idle.append(session)
+            self._condition.notify_all()
+
+    def close(self):
+        """Quit every open session, idle or borrowed, and the sessions still starting once they have started. A
+        borrowed session is unusable afterwards; giving it back is harmless.
+
+        :return: None
+        """
+        with self._condition:
+            self._closed = True
+            sessions = list(self._sessions)
+            self._sessions.clear()
+            self._idle.clear()
+            self._condition.notify_all()
+        for session in sessions:
+            try:
+                session.driver.quit()
+            except Exception:  # Already gone with a crashed browser
+                pass
+        if self.started > 0:
+            print("Browser pool " + self.profile_name + ": " + str(self.started) + " sessions started, " +
+                  str(self.recycled) + " recycled, " + str(self.crashes) + " crashes")
+
+
+_pools = {}  # (profile_name, headless, lean): BrowserPool of this process
+_pools_lock = threading.Lock()
+
+
+def acquire_driver(profile_name='default', headless=True, lean=True):
+    """Borrow a warm session from this process' pool of sessions with these settings, in place of create_driver for
+    long crawls: close() gives it back instead of quitting the browser. The pools are closed when the process exits.
+
+    :param profile_name: str, prefix of the profiles of the pool's sessions
+    :param headless: bool
+    :param lean: bool
+    :return: PooledDriver
+    """
+    key = (profile_name, headless, lean)
+    with _pools_lock:
+        if key not in _pools:
+            if len(_pools) == 0:
+                atexit.register(close_pools)
+            _pools[key] = BrowserPool(profile_name, headless, lean)
+        pool = _pools[key]
+    return pool.acquire()
+
+
+def close_pools():
+    """Quit the sessions of every pool of this process
+
+    :return: None
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def _time_page_loads(urls, driver):
+    """Visit every url in <urls> with <driver> and return the total number of seconds spent loading them
+
+    :param urls: [str]
+    :param driver: WebDriver
+    :return: float
+    """
+    start_time = time.time()
+    for url in urls:
+        driver.get(url)
+    return time.time() - start_time
+
+
+def compare_page_loads(urls, rounds=3):
+    """Load <urls> with the old visible, full browser setup and with the lean headless one and print the timings
+
+    :param urls: [str]
+    :param rounds: int
+    :return: None
+    """
+    for label, headless, lean in [('full', False, False), ('lean', True, True)]:
+        driver = create_driver(headless=headless, lean=lean, profile_name='benchmark')
+        _time_page_loads(urls[:1], driver)  # Warm up the browser and, for the lean profile, its cache
+        total_time = 0
+        for _ in range(rounds):
+            total_time += _time_page_loads(urls, driver)
+        driver.quit()
+        time_per_page = total_time/(rounds*len(urls))
+        print("{:<6}".format(label) + str(time_per_page) + " seconds per page")
+
+
+if __name__ == '__main__':
+    with profile_run('browser'):
+        compare_page_loads([
+            "http://www.nhl.com/stats/player?aggregate=0&gameType=2&report=skatersummary&pos=S&reportType=season"
+            "&seasonFrom=20152016&seasonTo=20152016&filter=gamesPlayed,gte,1&sort=points,goals,gamesPlayed",
+            "https://www.nhl.com/player/8471215",
+            "http://ontariohockeyleague.com/stats/players/",
+            "http://ontariohockeyleague.com/players/1906",
+        ])
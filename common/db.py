@@ -0,0 +1,334 @@
+import os
+import sqlite3
+
+from urllib.request import pathname2url
+
+from common.profiling import profile_run
+
+
+DB_DIR = os.getcwd()
+# Derived tables (relative stats, ...) live in the main database; everything scraped lives in its league's shard
+MAIN_DB = 'hockey-stats.db'
+SHARDS = {
+    'NHL': 'hockey-stats-nhl.db',
+    'OHL': 'hockey-stats-ohl.db',
+    'WHL': 'hockey-stats-whl.db',
+    'QMJHL': 'hockey-stats-qmjhl.db',
+}
+CHL_LEAGUES = ['OHL', 'WHL', 'QMJHL']
+# Appended to the definition of tables whose column types are enforced, where SQLite supports it
+STRICT = ' STRICT' if sqlite3.sqlite_version_info >= (3, 37, 0) else ''
+# Tables presented by a federated connection as one view over every shard holding them
+FEDERATED_TABLES = [
+    'player_seasons', 'player_pages', 'chl_player_seasons', 'chl_player_pages', 'chl_seasons', 'player_names',
+    'teams', 'drafts', 'stat_history', 'leaderboards'
+]
+
+
+def shard_path(league):
+    """Return the path of the database file holding the data scraped for <league>
+
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :return: str
+    """
+    return os.path.join(DB_DIR, SHARDS[league])
+
+
+def shard_schema(league):
+    """Return the schema name a shard is attached under in a federated connection
+
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :return: str
+    """
+    return 'shard_' + league.lower()
+
+
+def connect(league):
+    """Return a connection to the shard of <league>, for writing what is scraped for it.
+
+    Shards are in WAL mode, so crawls of different leagues never contend for a lock and federated readers are not
+    blocked by a crawl.
+
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :return: sqlite3.Connection
+    """
+    conn = sqlite3.connect(shard_path(league), timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def _read_only_uri(path):
+    return 'file:' + pathname2url(os.path.abspath(path)) + '?mode=ro'
+
+
+def connect_federated(read_only=False, mmap_size=None, **kwargs):
+    """Return a connection to the main database with every existing shard attached, and each of FEDERATED_TABLES
+    (plus table_generations, summed over shards) presented as a temporary view over the shards holding it.
+
+    Views are created when connecting: a shard or a table created afterwards is only seen by later connections (see
+    federated_layout).
+
+    :param read_only: bool, open every database with mode=ro: readers never take a write lock, and read the shards
+        alongside a crawl writing to them through their WAL
+    :param mmap_size: int | None, bytes of every database read through memory mapping rather than read calls
+    :param kwargs: passed on to sqlite3.connect
+    :return: sqlite3.Connection
+    """
+    main_path = os.path.join(DB_DIR, MAIN_DB)
+    if not read_only:
+        conn = sqlite3.connect(main_path, timeout=60, **kwargs)
+    elif os.path.exists(main_path):
+        conn = sqlite3.connect(_read_only_uri(main_path), timeout=60, uri=True, **kwargs)
+    else:  # Nothing derived saved yet, and a read-only connection can not create the main database
+        conn = sqlite3.connect('file::memory:', timeout=60, uri=True, **kwargs)
+    for league in sorted(SHARDS):
+        if os.path.exists(shard_path(league)):
+            path = _read_only_uri(shard_path(league)) if read_only else shard_path(league)
+            conn.execute('ATTACH DATABASE ? AS ' + shard_schema(league), (path,))
+    if mmap_size is not None:
+        for schema in ['main'] + [schema for _, schema in attached_shards(conn)]:
+            conn.execute('PRAGMA ' + schema + '.mmap_size = ' + str(int(mmap_size)))
+    _create_federated_views(conn)
+    if read_only:
+        conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+def attached_shards(conn):
+    """Return the leagues and schema names of the shards attached to a federated connection
+
+    :param conn: sqlite3.Connection
+    :return: [(str, str)] (league, schema)
+    """
+    schemas = set(row[1] for row in conn.execute('PRAGMA database_list'))
+    shards = []
+    for league in sorted(SHARDS):
+        if shard_schema(league) in schemas:
+            shards.append((league, shard_schema(league)))
+    return shards
+
+
+def federated_layout(conn):
+    """Return the shards on disk and the schema version of every shard attached to a federated connection. Once it
+    differs from when the connection was made, a shard or a table is missing from its views.
+
+    :param conn: sqlite3.Connection
+    :return: tuple
+    """
+    on_disk = tuple(league for league in sorted(SHARDS) if os.path.exists(shard_path(league)))
+    schema_versions = tuple(
+        conn.execute('PRAGMA ' + schema + '.schema_version').fetchone()[0] for _, schema in attached_shards(conn))
+    return on_disk, schema_versions
+
+
+def _shard_tables(conn, schema):
+    """Return the names of the tables of an attached schema
+
+    :param conn: sqlite3.Connection
+    :param schema: str
+    :return: {str}
+    """
+    return set(row[0] for row in conn.execute('SELECT name FROM ' + schema + ".sqlite_master WHERE type = 'table'"))
+
+
+def _create_federated_views(conn):
+    tables_by_schema = dict((schema, _shard_tables(conn, schema)) for _, schema in attached_shards(conn))
+    for table in FEDERATED_TABLES:
+        selects = []
+        for schema, tables in sorted(tables_by_schema.items()):
+            if table in tables:
+                selects.append('SELECT * FROM ' + schema + '.' + table)
+        if len(selects) > 0:
+            conn.execute('CREATE TEMP VIEW ' + table + ' AS ' + ' UNION ALL '.join(selects))
+    selects = []
+    for schema, tables in sorted(tables_by_schema.items()):
+        if 'table_generations' in tables:
+            selects.append('SELECT table_name, generation FROM ' + schema + '.table_generations')
+    if len(selects) > 0:
+        conn.execute(
+            'CREATE TEMP VIEW table_generations AS SELECT table_name, sum(generation) AS generation FROM (' +
+            ' UNION ALL '.join(selects) + ') GROUP BY table_name')
+
+
+def shard_monolith():
+    """Move the scraped tables of a database from before sharding into the league shards.
+
+    Every table is recreated in each shard with its original definition and filled with that league's rows (NHL
+    tables all go to the NHL shard), then dropped from the main database. The name index and write generations are
+    dropped as well: rebuild the name index with common.search.rebuild_name_index afterwards.
+
+    :return: None
+    """
+    conn = sqlite3.connect(os.path.join(DB_DIR, MAIN_DB))
+    c = conn.cursor()
+    c.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'")
+    main_tables = dict(c.fetchall())
+    routes = [
+        ('player_seasons', ['NHL']), ('player_pages', ['NHL']),
+        ('chl_player_seasons', CHL_LEAGUES), ('chl_player_pages', CHL_LEAGUES),
+    ]
+    for table, leagues in routes:
+        if table not in main_tables:
+            continue
+        for league in leagues:
+            connect(league).close()  # Creates the shard in WAL mode
+            schema = shard_schema(league)
+            c.execute('ATTACH DATABASE ? AS ' + schema, (shard_path(league),))
+            c.execute('DROP TABLE IF EXISTS ' + schema + '.' + table)
+            c.execute(main_tables[table].replace('CREATE TABLE ' + table, 'CREATE TABLE ' + schema + '.' + table, 1))
+            if league == 'NHL':
+                c.execute('INSERT INTO ' + schema + '.' + table + ' SELECT * FROM main.' + table)
+            else:
+                c.execute('INSERT INTO ' + schema + '.' + table + ' SELECT * FROM main.' + table + ' WHERE league = ?',
+                          (league,))
+            print(str(c.rowcount) + " rows of " + table + " moved to the " + league + " shard")
+            conn.commit()
+            c.execute('DETACH DATABASE ' + schema)
+        c.execute('DROP TABLE main.' + table)
+        conn.commit()
+    for table in ['player_names_fts', 'player_names', 'table_generations']:
+        c.execute('DROP TABLE IF EXISTS main.' + table)
+    conn.commit()
+    c.execute('VACUUM')
+    conn.close()
+
+
+def table_is_current(db_cursor, table, ensure_func):
+    """Return whether <table> has the definition <ensure_func> creates it with today, or does not exist yet
+
+    :param db_cursor: database cursor
+    :param table: str
+    :param ensure_func: function creating the table if it does not exist, given a cursor
+    :return: bool
+    """
+    db_cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    row = db_cursor.fetchone()
+    if row is None:
+        return True
+    scratch = sqlite3.connect(':memory:')
+    ensure_func(scratch.cursor())
+    current = scratch.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    scratch.close()
+    return ' '.join(row[0].split()) == ' '.join(current[0].split())
+
+
+def check_table_is_current(db_cursor, table, ensure_func):
+    """Raise if <table> was created with an older definition than <ensure_func> creates it with: the indexes and rows
+    of the current one need columns it lacks. For the tools writing to tables in bulk, which leave rebuilding them to
+    python -m tools.upgradetables.
+
+    :param db_cursor: database cursor
+    :param table: str
+    :param ensure_func: function creating the table if it does not exist, given a cursor
+    :return: None
+    """
+    if not table_is_current(db_cursor, table, ensure_func):
+        raise RuntimeError(table + ' was created with an older definition, upgrade it first with: '
+                           'python -m tools.upgradetables')
+
+
+def rebuild_table(conn, table, ensure_func, convert_rows, batch_rows=20000):
+    """Move the rows of <table> into a table created with its current definition, <batch_rows> at a time.
+
+    The old table is renamed <table>_old and emptied into the new one in rowid order, keeping rowids, with a commit
+    after every batch: an interrupted rebuild picks up where it stopped when run again.
+
+    :param conn: sqlite3.Connection
+    :param table: str
+    :param ensure_func: function creating the table if it does not exist, given a cursor
+    :param convert_rows: function given a cursor and a batch of rows of the old table as dicts of column values,
+        returning them as dicts of the columns of the new table (missing columns are left empty)
+    :param batch_rows: int
+    :return: int, number of rows moved
+    """
+    c = conn.cursor()
+    old_table = table + '_old'
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (old_table,))
+    if c.fetchone() is None:
+        c.execute('ALTER TABLE ' + table + ' RENAME TO ' + old_table)
+        # Indexes follow the renamed table, and would keep the new table from getting its own
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                  (old_table,))
+        for (index_name,) in c.fetchall():
+            c.execute('DROP INDEX ' + index_name)
+    ensure_func(c)
+    conn.commit()
+
+    c.execute('SELECT * FROM ' + table + ' LIMIT 0')
+    columns = [description[0] for description in c.description]
+    insert = 'INSERT INTO ' + table + ' (rowid, ' + ', '.join(columns) + ') VALUES (' + \
+             ', '.join('?' * (len(columns) + 1)) + ')'
+    c.execute('SELECT coalesce(max(rowid), 0) FROM ' + table)
+    last_rowid = c.fetchone()[0]
+    row_counter = 0
+    while True:
+        c.execute('SELECT rowid AS rowid_, * FROM ' + old_table + ' WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                  (last_rowid, batch_rows))
+        old_columns = [description[0] for description in c.description]
+        rows = [dict(zip(old_columns, row)) for row in c.fetchall()]
+        if len(rows) == 0:
+            break
+        new_rows = convert_rows(c, rows)
+        c.executemany(insert, [
+            (row['rowid_'],) + tuple(new_row.get(column) for column in columns)
+            for row, new_row in zip(rows, new_rows)
+        ])
+        conn.commit()
+        last_rowid = rows[-1]['rowid_']
+        row_counter += len(rows)
+        print(str(row_counter) + " rows of " + table + " moved")
+    c.execute('DROP TABLE ' + old_table)
+    bump_generation(c, table)
+    conn.commit()
+    return row_counter
+
+
+def _create_table_generations_table(db_cursor):
+    """Utility function for creating the table_generations table, if it does not exist yet
+
+    :param db_cursor: database cursor
+    :return:
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS table_generations
+                         (
+                         table_name TEXT PRIMARY KEY, generation INTEGER
+                         )''')
+
+
+def bump_generation(db_cursor, table_name):
+    """Record that <table_name> has been written to, so results read from it before are known to be stale.
+
+    Called by every save function, within the same transaction as the write.
+
+    :param db_cursor: database cursor
+    :param table_name: str
+    :return: None
+    """
+    _create_table_generations_table(db_cursor)
+    db_cursor.execute(
+        'INSERT INTO table_generations VALUES (?, 1) '
+        'ON CONFLICT (table_name) DO UPDATE SET generation = generation + 1',
+        (table_name,))
+
+
+def get_generation(db_cursor, table_names):
+    """Return the write generations of <table_names>; the result changes whenever any of the tables is written to
+
+    :param db_cursor: database cursor
+    :param table_names: [str]
+    :return: tuple
+    """
+    try:
+        db_cursor.execute(
+            'SELECT table_name, generation FROM table_generations WHERE table_name IN (' +
+            ', '.join('?' * len(table_names)) + ')',
+            tuple(table_names))
+    except sqlite3.OperationalError:  # Nothing saved since generations were introduced
+        return tuple(0 for _ in table_names)
+    generations = dict(db_cursor.fetchall())
+    return tuple(generations.get(table_name, 0) for table_name in table_names)
+
+
+if __name__ == '__main__':
+    with profile_run('db'):
+        shard_monolith()
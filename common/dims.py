@@ -0,0 +1,113 @@
+from common.db import STRICT
+
+
+# Every shard allocates the ids of its dimension rows in its own block, so ids stay unique in federated queries
+SHARD_NUMBERS = {'NHL': 1, 'OHL': 2, 'WHL': 3, 'QMJHL': 4}
+ID_BLOCK = 1 << 32
+
+
+def _ensure_dimension_tables(db_cursor):
+    """Utility function for creating the teams and drafts dimension tables in a shard, if they do not exist yet
+
+    :param db_cursor: database cursor
+    :return:
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS teams
+                         (
+                         team_id INTEGER PRIMARY KEY, league TEXT NOT NULL, name TEXT NOT NULL,
+                         UNIQUE (league, name)
+                         )''' + STRICT)
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS drafts
+                         (
+                         draft_id INTEGER PRIMARY KEY, league TEXT NOT NULL, year INTEGER, team_id INTEGER,
+                         round INTEGER, overall INTEGER,
+                         UNIQUE (league, year, team_id, round, overall)
+                         )''' + STRICT)
+    db_cursor.execute('CREATE INDEX IF NOT EXISTS drafts_year_round ON drafts (league, year, round)')
+    db_cursor.execute('CREATE INDEX IF NOT EXISTS drafts_team ON drafts (team_id, year)')
+
+
+def _to_int(text):
+    """Return the number in a draft year, round or overall pick ('1', '1st', '(2015)'), or None
+
+    :param text: str | int | None
+    :return: int | None
+    """
+    if text is None:
+        return None
+    digits = ''.join(character for character in str(text) if character.isdigit())
+    if digits == '':
+        return None
+    return int(digits)
+
+
+def _next_id_sql(table, id_column, shard_league):
+    """Return the SQL expression of the next unused id of the shard's block of <table>. Evaluated inside the INSERT
+    itself, so workers writing to the same shard at once can not be handed the same id."""
+    base = SHARD_NUMBERS[shard_league] * ID_BLOCK
+    return '(SELECT coalesce(max({0}), {1}) + 1 FROM {2} WHERE {0} > {1} AND {0} < {3})'.format(
+        id_column, base, table, base + ID_BLOCK)
+
+
+def team_ids(db_cursor, shard_league, teams):
+    """Return the ids of teams, adding the ones not seen before to the teams table of the shard
+
+    :param db_cursor: database cursor
+    :param shard_league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL', shard the cursor writes to
+    :param teams: iterable of (str, str) (league, team name)
+    :return: {(str, str): int}, without teams with no name
+    """
+    _ensure_dimension_tables(db_cursor)
+    wanted = set(team for team in teams if team[0] is not None and team[1] not in (None, ''))
+    if len(wanted) == 0:
+        return {}
+    db_cursor.execute('SELECT league, name, team_id FROM teams')
+    ids = dict(((league, name), team_id) for league, name, team_id in db_cursor.fetchall())
+    new_teams = sorted(wanted - set(ids))
+    if len(new_teams) > 0:
+        db_cursor.executemany(  # Ignored if another worker added the team in the meantime
+            'INSERT OR IGNORE INTO teams SELECT ' + _next_id_sql('teams', 'team_id', shard_league) + ', ?, ?',
+            new_teams)
+        db_cursor.execute('SELECT league, name, team_id FROM teams')
+        ids = dict(((league, name), team_id) for league, name, team_id in db_cursor.fetchall())
+    return dict((team, ids[team]) for team in wanted)
+
+
+def draft_ids(db_cursor, shard_league, drafts):
+    """Return the ids of draft picks, adding the ones not seen before to the drafts table of the shard
+
+    :param db_cursor: database cursor
+    :param shard_league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL', shard the cursor writes to
+    :param drafts: iterable of (str, str, str, str, str) (league, year, team name, round, overall) as saved in the
+        player page tables
+    :return: {tuple: int}, keyed by the given tuples, without drafts with no year
+    """
+    wanted = set(draft for draft in drafts if draft[0] is not None and _to_int(draft[1]) is not None)
+    if len(wanted) == 0:
+        return {}
+    teams = team_ids(db_cursor, shard_league, [(league, team) for league, _, team, _, _ in wanted])
+    keys = {}  # (league, year, team_id, round, overall): given tuples
+    for draft in wanted:
+        league, year, team, draft_round, overall = draft
+        key = (league, _to_int(year), teams.get((league, team)), _to_int(draft_round), _to_int(overall))
+        keys.setdefault(key, []).append(draft)
+    find = 'SELECT draft_id FROM drafts WHERE league = ? AND year IS ? AND team_id IS ? AND round IS ? AND overall IS ?'
+    ids = {}
+    for key in keys:
+        row = db_cursor.execute(find, key).fetchone()
+        if row is not None:
+            ids[key] = row[0]
+    new_keys = sorted(set(keys) - set(ids), key=str)
+    if len(new_keys) > 0:
+        # NULLs never collide in the UNIQUE constraint, so the check for a pick added by another worker is explicit
+        db_cursor.executemany(
+            'INSERT INTO drafts SELECT ' + _next_id_sql('drafts', 'draft_id', shard_league) +
+            ', ?, ?, ?, ?, ? WHERE NOT EXISTS (' + find.replace('draft_id', '1', 1) + ')',
+            [key + key for key in new_keys])
+        for key in new_keys:
+            ids[key] = db_cursor.execute(find, key).fetchone()[0]
+    result = {}
+    for key, given in keys.items():
+        for draft in given:
+            result[draft] = ids[key]
+    return result
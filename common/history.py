@@ -0,0 +1,180 @@
+import json
+import datetime
+
+from common.db import bump_generation
+
+
+# table: (key columns, season columns). The season columns pick the rows an as-of query reconstructs.
+HISTORY_TABLES = {
+    'player_seasons': (['id', 'year', 'season_type'], ['year', 'season_type']),
+    # Player ids and season names repeat across the chl leagues, whose histories a federated cursor reads together
+    'chl_player_seasons': (['league', 'id', 'season_name'], ['league', 'season_name']),
+}
+KEYFRAME_INTERVAL = 16  # Versions of a row between full copies, so reconstructing a row reads at most this many
+KEY_SEPARATOR = '\x1f'
+
+_columns = {}  # table: column names, as the table is defined in the shards
+
+
+def _ensure_history_table(db_cursor):
+    """Utility function for creating the stat_history table in a shard, if it does not exist yet.
+
+    Every version of a row is one entry: a keyframe holds all of its columns that are not null, the entries in between
+    only the columns that changed since the previous version.
+
+    :param db_cursor: database cursor
+    :return:
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS stat_history
+                         (
+                         table_name TEXT NOT NULL, row_key TEXT NOT NULL, crawled TEXT NOT NULL, season TEXT NOT NULL,
+                         seq INTEGER NOT NULL, delta TEXT NOT NULL,
+                         PRIMARY KEY (table_name, row_key, crawled)
+                         ) WITHOUT ROWID''')
+    db_cursor.execute(
+        'CREATE INDEX IF NOT EXISTS stat_history_season ON stat_history (table_name, season, crawled)')
+
+
+def _table_columns(db_cursor, table):
+    if table not in _columns:
+        db_cursor.execute('SELECT * FROM ' + table + ' LIMIT 0')
+        _columns[table] = [description[0] for description in db_cursor.description]
+    return _columns[table]
+
+
+def _join_key(values):
+    return KEY_SEPARATOR.join(str(value) for value in values)
+
+
+def record_history(db_cursor, table, rows, crawled=None, ignore_saved=False):
+    """Record the rows about to be saved to <table> that differ from the saved ones as new versions in stat_history.
+    Call before writing the rows, in the same transaction.
+
+    :param db_cursor: database cursor
+    :param table: 'player_seasons' | 'chl_player_seasons'
+    :param rows: [tuple], complete rows of the table
+    :param crawled: str | None, when the rows were crawled ('YYYY-MM-DD HH:MM:SS'), defaults to now
+    :param ignore_saved: bool, skip the rows already saved, as they are about to be written with INSERT OR IGNORE
+    :return: int, number of versions recorded
+    """
+    _ensure_history_table(db_cursor)
+    crawled = crawled or datetime.datetime.now().isoformat(' ', 'seconds')
+    key_columns, season_columns = HISTORY_TABLES[table]
+    columns = _table_columns(db_cursor, table)
+    key_indices = [columns.index(column) for column in key_columns]
+    season_indices = [columns.index(column) for column in season_columns]
+    select_row = 'SELECT * FROM ' + table + ' WHERE ' + ' AND '.join(column + ' = ?' for column in key_columns)
+
+    entries = []
+    for row in rows:
+        key = tuple(row[i] for i in key_indices)
+        row_key = _join_key(key)
+        if ignore_saved and db_cursor.execute(select_row, key).fetchone() is not None:
+            continue
+        last = db_cursor.execute(
+            'SELECT seq, crawled FROM stat_history WHERE table_name = ? AND row_key = ? ORDER BY crawled DESC LIMIT 1',
+            (table, row_key)).fetchone()
+        saved_row = db_cursor.execute(select_row, key).fetchone() if last is not None else None
+        # A full copy for the first version, every KEYFRAME_INTERVAL versions, and when a version of the same crawl
+        # time is replaced (a delta from it would then have no base)
+        if saved_row is None or last[0] + 1 >= KEYFRAME_INTERVAL or last[1] == crawled:
+            delta = dict((column, value) for column, value in zip(columns, row) if value is not None)
+            seq = 0
+        else:
+            delta = dict((column, value) for column, old_value, value in zip(columns, saved_row, row)
+                         if old_value != value)
+            if len(delta) == 0:
+                continue
+            seq = last[0] + 1
+        entries.append((table, row_key, crawled, _join_key(row[i] for i in season_indices), seq,
+                        json.dumps(delta, separators=(',', ':'))))
+    db_cursor.executemany('INSERT OR REPLACE INTO stat_history VALUES (?, ?, ?, ?, ?, ?)', entries)
+    if len(entries) > 0:
+        bump_generation(db_cursor, 'stat_history')
+    return len(entries)
+
+
+def _reconstruct(entries, columns):
+    """Return the row described by the entries of one row key since its latest keyframe, oldest first"""
+    values = {}
+    for seq, delta in entries:
+        if seq == 0:
+            values = {}
+        values.update(json.loads(delta))
+    return tuple(values.get(column) for column in columns)
+
+
+def season_as_of(db_cursor, table, season, as_of):
+    """Return the rows of a season of <table> as they were saved at <as_of>
+
+    :param db_cursor: database cursor, to a shard or federated
+    :param table: 'player_seasons' | 'chl_player_seasons'
+    :param season: tuple, values of the season columns of the table, e.g. ('20152016', '2') or
+        ('OHL', '2015-16 Regular Season')
+    :param as_of: str, 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'
+    :return: [tuple], rows with the current columns of the table, in row key order
+    """
+    if len(as_of) == 10:  # A whole day
+        as_of += ' 23:59:59'
+    columns = _table_columns(db_cursor, table)
+    # Only the entries since the latest keyframe at <as_of> of every row are read
+    db_cursor.execute(
+        'SELECT row_key, seq, delta FROM stat_history AS history '
+        'WHERE table_name = ? AND season = ? AND crawled <= ? AND crawled >= ('
+        'SELECT max(crawled) FROM stat_history AS keyframe WHERE keyframe.table_name = history.table_name AND '
+        'keyframe.row_key = history.row_key AND keyframe.crawled <= ? AND keyframe.seq = 0) '
+        'ORDER BY row_key, crawled',
+        (table, _join_key(season), as_of, as_of))
+    rows = []
+    entries = []
+    last_key = None
+    for row_key, seq, delta in db_cursor.fetchall():
+        if row_key != last_key and len(entries) > 0:
+            rows.append(_reconstruct(entries, columns))
+            entries = []
+        entries.append((seq, delta))
+        last_key = row_key
+    if len(entries) > 0:
+        rows.append(_reconstruct(entries, columns))
+    return rows
+
+
+def row_history(db_cursor, table, key):
+    """Return every version of one row, oldest first
+
+    :param db_cursor: database cursor, to a shard or federated
+    :param table: 'player_seasons' | 'chl_player_seasons'
+    :param key: tuple, values of the key columns of the table
+    :return: [(str, tuple)] (crawled, row)
+    """
+    columns = _table_columns(db_cursor, table)
+    db_cursor.execute(
+        'SELECT crawled, seq, delta FROM stat_history WHERE table_name = ? AND row_key = ? ORDER BY crawled',
+        (table, _join_key(key)))
+    versions = []
+    entries = []
+    for crawled, seq, delta in db_cursor.fetchall():
+        if seq == 0:
+            entries = []
+        entries.append((seq, delta))
+        versions.append((crawled, _reconstruct(entries, columns)))
+    return versions
+
+
+def upgrade_history_keys(db_cursor, league):
+    """Add the league to the row keys and seasons of the chl_player_seasons history of a chl shard recorded before
+    they included it
+
+    :param db_cursor: database cursor, to the shard of <league>
+    :param league: str
+    :return: int, number of entries upgraded
+    """
+    _ensure_history_table(db_cursor)
+    prefix = league + KEY_SEPARATOR
+    db_cursor.execute(
+        'UPDATE stat_history SET row_key = ? || row_key, season = ? || season '
+        "WHERE table_name = 'chl_player_seasons' AND substr(season, 1, ?) != ?",
+        (prefix, prefix, len(prefix), prefix))
+    if db_cursor.rowcount > 0:
+        bump_generation(db_cursor, 'stat_history')
+    return db_cursor.rowcount
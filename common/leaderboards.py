@@ -0,0 +1,228 @@
+import os
+import time
+import heapq
+import sqlite3
+
+from common.db import CHL_LEAGUES, bump_generation, connect, shard_path
+from common.profiling import profile_run
+
+
+TOP_N = 100  # Entries kept per leaderboard; longer lists are sorted from the season table
+# table: (league column or league, season columns, stats with a leaderboard)
+LEADERBOARD_TABLES = {
+    'player_seasons': (
+        'NHL', ['year', 'season_type'],
+        ['goals', 'assists', 'points', 'plus_minus', 'pim', 'p_gp', 'ppg', 'ppp', 's', 'toi_gp']),
+    'chl_player_seasons': (
+        'league', ['season_name'],
+        ['goals', 'assists', 'points', 'plus_minus', 'pim', 'p_g', 'ppg', 's']),
+}
+SEASON_SEPARATOR = '|'
+
+_columns = {}  # table: column names, as the table is defined in the shards
+
+
+def _ensure_leaderboards_table(db_cursor):
+    """Utility function for creating the leaderboards table in a shard, if it does not exist yet
+
+    :param db_cursor: database cursor
+    :return:
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS leaderboards
+                         (
+                         league TEXT NOT NULL, season TEXT NOT NULL, stat TEXT NOT NULL, rank INTEGER NOT NULL,
+                         id TEXT NOT NULL, value REAL NOT NULL,
+                         PRIMARY KEY (league, season, stat, rank)
+                         ) WITHOUT ROWID''')
+
+
+def _table_columns(db_cursor, table):
+    if table not in _columns:
+        db_cursor.execute('SELECT * FROM ' + table + ' LIMIT 0')
+        _columns[table] = [description[0] for description in db_cursor.description]
+    return _columns[table]
+
+
+def season_key(season):
+    """Return the season of a leaderboard as stored in the leaderboards table
+
+    :param season: tuple, values of the season columns of the table, e.g. ('20152016', '2')
+    :return: str
+    """
+    return SEASON_SEPARATOR.join(season)
+
+
+def _group_rows(db_cursor, table, rows):
+    """Return the leaderboard group, id and stat values of every row
+
+    :return: [((str, str), str, [float | None])] ((league, season), id, values in the order of the stats)
+    """
+    league_column, season_columns, stats = LEADERBOARD_TABLES[table]
+    columns = _table_columns(db_cursor, table)
+    id_index = columns.index('id')
+    season_indices = [columns.index(column) for column in season_columns]
+    stat_indices = [columns.index(stat) for stat in stats]
+    league_index = columns.index(league_column) if league_column in columns else None
+    grouped = []
+    for row in rows:
+        league = league_column if league_index is None else row[league_index]
+        group = (league, season_key([row[i] for i in season_indices]))
+        grouped.append((group, row[id_index], [row[i] for i in stat_indices]))
+    return grouped
+
+
+def _write_board(db_cursor, group, stat, entries):
+    """Replace a leaderboard with <entries>, [(value, id)] best first"""
+    league, season = group
+    db_cursor.execute('DELETE FROM leaderboards WHERE league = ? AND season = ? AND stat = ?', (league, season, stat))
+    db_cursor.executemany(
+        'INSERT INTO leaderboards VALUES (?, ?, ?, ?, ?, ?)',
+        [(league, season, stat, rank, id_, value) for rank, (value, id_) in enumerate(entries, 1)])
+
+
+def _top(entries):
+    """Return the TOP_N best (value, id) entries, best first; ties go to the lowest id, as in a full sort"""
+    return heapq.nsmallest(TOP_N, entries, key=lambda entry: (-entry[0], entry[1]))
+
+
+class _Reversed:
+    """Wraps a value so that it sorts in reverse order"""
+
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def rebuild_leaderboards(db_cursor, table):
+    """Rebuild every leaderboard of <table> in a shard in one pass over the table, keeping a bounded heap per
+    leaderboard
+
+    :param db_cursor: database cursor
+    :param table: 'player_seasons' | 'chl_player_seasons'
+    :return: int, number of leaderboards written
+    """
+    _ensure_leaderboards_table(db_cursor)
+    stats = LEADERBOARD_TABLES[table][2]
+    heaps = {}  # (group, stat): min-heap of the best TOP_N (value, reversed id), worst on top
+    _table_columns(db_cursor, table)  # Before the cursor starts iterating over the table
+    db_cursor.execute('SELECT * FROM ' + table)
+    while True:
+        rows = db_cursor.fetchmany(10000)
+        if len(rows) == 0:
+            break
+        for group, id_, values in _group_rows(db_cursor, table, rows):
+            for stat, value in zip(stats, values):
+                if value is None:
+                    continue
+                heap = heaps.setdefault((group, stat), [])
+                item = (value, _Reversed(id_))  # Of equal values, the highest id is the worst
+                if len(heap) < TOP_N:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+    league_column = LEADERBOARD_TABLES[table][0]
+    if league_column == 'NHL':
+        db_cursor.execute("DELETE FROM leaderboards WHERE league = 'NHL'")
+    else:
+        db_cursor.execute("DELETE FROM leaderboards WHERE league != 'NHL'")
+    for (group, stat), heap in heaps.items():
+        _write_board(db_cursor, group, stat, [(value, id_.value) for value, id_ in sorted(heap, reverse=True)])
+    bump_generation(db_cursor, 'leaderboards')
+    return len(heaps)
+
+
+def update_leaderboards(db_cursor, table, rows):
+    """Bring the leaderboards of <table> up to date with rows just saved to it.
+
+    Rows entering a leaderboard or improving on it are merged in with a bounded heap. A leaderboard one of whose
+    entries got worse, or lost its value, may now be missing a row that was never on it, so it is built again from
+    the season's rows instead, as is one that is still empty.
+
+    :param db_cursor: database cursor
+    :param table: 'player_seasons' | 'chl_player_seasons'
+    :param rows: [tuple], complete rows of the table, as saved
+    :return: None
+    """
+    if len(rows) == 0:
+        return
+    _ensure_leaderboards_table(db_cursor)
+    league_column, season_columns, stats = LEADERBOARD_TABLES[table]
+    batches = {}  # group: {id: values}
+    for group, id_, values in _group_rows(db_cursor, table, rows):
+        batches.setdefault(group, {})[id_] = values
+    for group, batch in batches.items():
+        for stat_index, stat in enumerate(stats):
+            db_cursor.execute(
+                'SELECT id, value FROM leaderboards WHERE league = ? AND season = ? AND stat = ? ORDER BY rank',
+                group + (stat,))
+            board = dict(db_cursor.fetchall())
+            needs_rebuild = len(board) == 0  # Never built, e.g. for a season saved before leaderboards existed
+            for id_, values in batch.items():
+                value = values[stat_index]
+                if id_ in board and (value is None or value < board[id_]):
+                    needs_rebuild = True
+                    break
+            if needs_rebuild:
+                entries = _season_entries(db_cursor, table, group, stat)
+            else:
+                candidates = dict(board)
+                for id_, values in batch.items():
+                    if values[stat_index] is not None:
+                        candidates[id_] = values[stat_index]
+                entries = [(value, id_) for id_, value in candidates.items()]
+            top = _top(entries)
+            if top != [(value, id_) for id_, value in board.items()]:
+                _write_board(db_cursor, group, stat, top)
+    bump_generation(db_cursor, 'leaderboards')
+
+
+def _season_entries(db_cursor, table, group, stat):
+    """Return the (value, id) of <stat> of every row of a leaderboard group that has a value"""
+    league_column, season_columns, _ = LEADERBOARD_TABLES[table]
+    league, season = group
+    conditions = [column + ' = ?' for column in season_columns]
+    params = season.split(SEASON_SEPARATOR)
+    if league_column != 'NHL':
+        conditions.append(league_column + ' = ?')
+        params.append(league)
+    db_cursor.execute(
+        'SELECT ' + stat + ', id FROM ' + table + ' WHERE ' + ' AND '.join(conditions) + ' AND ' + stat +
+        ' IS NOT NULL', params)
+    return db_cursor.fetchall()
+
+
+def rebuild_all_leaderboards():
+    """Rebuild the leaderboards of every shard
+
+    :return: None
+    """
+    start_time = time.time()
+    for league, table in [('NHL', 'player_seasons')] + [(league, 'chl_player_seasons') for league in CHL_LEAGUES]:
+        if not os.path.exists(shard_path(league)):
+            continue
+        conn = connect(league)
+        c = conn.cursor()
+        try:
+            num_boards = rebuild_leaderboards(c, table)
+        except sqlite3.OperationalError:  # No seasons saved in the shard
+            continue
+        finally:
+            conn.commit()
+            conn.close()
+        print(league + ": " + str(num_boards) + " leaderboards")
+    print("That took " + str(time.time() - start_time) + " seconds")
+
+
+if __name__ == '__main__':
+    with profile_run('leaderboards'):
+        rebuild_all_leaderboards()
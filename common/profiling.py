@@ -0,0 +1,196 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import tracemalloc
+
+
+PROFILE_DIR = os.path.join(os.getcwd(), 'profiles')
+TOP_FUNCTIONS = 20
+TOP_ALLOCATIONS = 20
+MAX_STACK_DEPTH = 64
+
+_active = None  # Profiler of the run in progress, if any
+
+
+class Profiler:
+    """cProfile and tracemalloc over a whole run, with memory snapshots at phase boundaries.
+
+    When the run ends, writes to PROFILE_DIR:
+        <run>.pstats, the cProfile stats (snakeviz, gprof2dot, pstats)
+        <run>.collapsed, the same stats as collapsed stacks (flamegraph.pl, speedscope, inferno)
+        <run>.tracemalloc.txt, the top allocations at every phase boundary and what grew since the previous one
+    and prints the TOP_FUNCTIONS functions the most time was spent in.
+    """
+
+    def __init__(self, name, out_dir=PROFILE_DIR):
+        self.name = name
+        self.run_name = name + '-' + time.strftime('%Y%m%d-%H%M%S')
+        self.out_dir = out_dir
+        self.profile = cProfile.Profile()
+        self.phase_counter = 0
+        self._last_snapshot = None
+        self._phase_start = None
+        self._report = None
+
+    def start(self):
+        global _active
+        os.makedirs(self.out_dir, exist_ok=True)
+        self._report = open(self._path('.tracemalloc.txt'), 'w')
+        tracemalloc.start(25)
+        self._phase_start = time.time()
+        _active = self
+        self.profile.enable()
+
+    def phase(self, phase_name):
+        """Mark the end of a phase of the run: record the allocations live at this point
+
+        :param phase_name: str
+        :return: None
+        """
+        self.profile.disable()
+        self.phase_counter += 1
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        report = self._report
+        report.write('=== phase ' + str(self.phase_counter) + ': ' + phase_name + ' (' +
+                     '{0:.1f}'.format(time.time() - self._phase_start) + ' s, ' + _format_size(current) +
+                     ' traced, ' + _format_size(peak) + ' peak)\n')
+        report.write('--- top allocations\n')
+        for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+            report.write(str(stat) + '\n')
+        if self._last_snapshot is not None:
+            report.write('--- grown since the previous phase\n')
+            for stat in snapshot.compare_to(self._last_snapshot, 'lineno')[:TOP_ALLOCATIONS]:
+                if stat.size_diff > 0:
+                    report.write(str(stat) + '\n')
+        report.write('\n')
+        report.flush()
+        self._last_snapshot = snapshot
+        self._phase_start = time.time()
+        self.profile.enable()
+
+    def stop(self):
+        global _active
+        _active = None
+        self.phase('end')
+        self.profile.disable()
+        self._report.close()
+        tracemalloc.stop()
+
+        self.profile.dump_stats(self._path('.pstats'))
+        stats = pstats.Stats(self.profile)
+        with open(self._path('.collapsed'), 'w') as f:
+            for stack, weight in _collapsed_stacks(stats):
+                f.write(stack + ' ' + str(weight) + '\n')
+        print("Profile written to " + self._path('.*'))
+        stats.sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+
+    def _path(self, extension):
+        return os.path.join(self.out_dir, self.run_name + extension)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class _NoProfiler:
+    """Stands in for a Profiler when a run is not profiled"""
+
+    def phase(self, phase_name):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def profile_run(name, enabled=None):
+    """Return a context manager profiling the run of an entry point, if profiling was asked for.
+
+        with profile_run('nhl_playerseason') as profiler:
+            save_player_seasons(1917, 2016)
+            profiler.phase('crawl')
+
+    :param name: str, name of the entry point, used in the file names
+    :param enabled: bool | None, defaults to whether --profile was passed on the command line
+    :return: Profiler | _NoProfiler
+    """
+    if enabled is None:
+        enabled = '--profile' in sys.argv
+    if enabled:
+        return Profiler(name)
+    return _NoProfiler()
+
+
+def mark_phase(phase_name):
+    """Mark a phase boundary of the profiled run in progress, if any. Cheap enough to call in crawl loops.
+
+    :param phase_name: str
+    :return: None
+    """
+    if _active is not None:
+        _active.phase(phase_name)
+
+
+def _format_size(size):
+    for unit in ['B', 'KiB', 'MiB']:
+        if abs(size) < 1024:
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024
+    return '{0:.1f} GiB'.format(size)
+
+
+def _function_label(func):
+    filename, line, function_name = func
+    if filename == '~':  # Built-in
+        return function_name.replace(';', ',')
+    return (function_name + ' (' + os.path.basename(filename) + ':' + str(line) + ')').replace(';', ',')
+
+
+def _collapsed_stacks(stats):
+    """Return the call graph of pstats <stats> as collapsed stacks, weighted in microseconds of own time.
+
+    cProfile only records caller -> callee edges, so a function called from several places has its time split over
+    its stacks in proportion to the time spent in it from each caller.
+
+    :param stats: pstats.Stats
+    :return: [(str, int)] ('root;caller;callee', microseconds)
+    """
+    callees = {}
+    roots = []
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if len(callers) == 0:
+            roots.append(func)
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, []).append((func, caller_stats[3]))
+
+    stacks = {}
+    stack = [(root, (_function_label(root),), 1.0) for root in roots]
+    while stack:
+        func, path, fraction = stack.pop()
+        own_time = stats.stats[func][2] * fraction
+        weight = int(own_time * 1000000)
+        if weight > 0:
+            key = ';'.join(path)
+            stacks[key] = stacks.get(key, 0) + weight
+        if len(path) >= MAX_STACK_DEPTH:
+            continue
+        for callee, edge_time in callees.get(func, []):
+            callee_time = stats.stats[callee][3]
+            if callee_time <= 0 or _function_label(callee) in path:  # Nothing spent in it, or recursion
+                continue
+            callee_fraction = fraction * edge_time / callee_time
+            if callee_fraction * callee_time < 1e-6:
+                continue
+            stack.append((callee, path + (_function_label(callee),), callee_fraction))
+    return sorted(stacks.items())
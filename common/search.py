@@ -0,0 +1,217 @@
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from common.db import SHARDS, attached_shards, connect, connect_federated, federated_layout, shard_path
+from common.profiling import profile_run
+
+
+CANDIDATES = 200  # Names pulled from the trigram index before re-ranking
+
+
+def _create_player_names_table(db_cursor):
+    """Utility function for creating the player_names table and its trigram index, if they do not exist yet
+
+    :param db_cursor: database cursor
+    :return:
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS player_names
+                         (
+                         rowid INTEGER PRIMARY KEY, id TEXT, league TEXT, name TEXT, norm_name TEXT, norm_last TEXT,
+                         UNIQUE (id, league)
+                         )''')
+    db_cursor.execute('CREATE INDEX IF NOT EXISTS player_names_norm_name ON player_names (norm_name)')
+    db_cursor.execute('CREATE INDEX IF NOT EXISTS player_names_norm_last ON player_names (norm_last)')
+    db_cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS player_names_fts USING fts5
+                         (
+                         norm_name, content='player_names', content_rowid='rowid', tokenize='trigram'
+                         )''')
+    # Keep the trigram index in step with player_names
+    db_cursor.execute('''CREATE TRIGGER IF NOT EXISTS player_names_ai AFTER INSERT ON player_names BEGIN
+                         INSERT INTO player_names_fts (rowid, norm_name) VALUES (new.rowid, new.norm_name);
+                         END''')
+    db_cursor.execute('''CREATE TRIGGER IF NOT EXISTS player_names_ad AFTER DELETE ON player_names BEGIN
+                         INSERT INTO player_names_fts (player_names_fts, rowid, norm_name)
+                         VALUES ('delete', old.rowid, old.norm_name);
+                         END''')
+    db_cursor.execute('''CREATE TRIGGER IF NOT EXISTS player_names_au AFTER UPDATE ON player_names BEGIN
+                         INSERT INTO player_names_fts (player_names_fts, rowid, norm_name)
+                         VALUES ('delete', old.rowid, old.norm_name);
+                         INSERT INTO player_names_fts (rowid, norm_name) VALUES (new.rowid, new.norm_name);
+                         END''')
+
+
+def normalize_name(name):
+    """Return a name as lower case 'first last' words without accents or punctuation
+
+    For example, 'Giguère, Jean-Sébastien' (the CHL's 'Last, First') becomes 'jean sebastien giguere' and
+    "Ryan O'Reilly" becomes 'ryan oreilly'.
+
+    :param name: str
+    :return: str
+    """
+    if ',' in name:  # 'Last, First'
+        last, first = name.split(',', 1)
+        name = first + ' ' + last
+    decomposed = unicodedata.normalize('NFKD', name)
+    characters = []
+    for character in decomposed:
+        if unicodedata.combining(character):
+            continue
+        elif character.isalnum():
+            characters.append(character.lower())
+        elif character in "'.`’":
+            continue  # O'Reilly, P.K.
+        else:
+            characters.append(' ')
+    return ' '.join(''.join(characters).split())
+
+
+def _trigrams(norm_name):
+    """Return the set of trigrams of every word of a normalized name, words padded so short ones still count
+
+    :param norm_name: str
+    :return: {str}
+    """
+    trigrams = set()
+    for word in norm_name.split():
+        padded = ' ' + word + ' '
+        for i in range(len(padded) - 2):
+            trigrams.add(padded[i:i + 3])
+    return trigrams
+
+
+def index_player_names(db_cursor, names):
+    """Add or update players in the name index. Called by the save functions as pages and seasons are saved.
+
+    :param db_cursor: database cursor
+    :param names: [(str, str, str)] (id, league, name)
+    :return: None
+    """
+    _create_player_names_table(db_cursor)
+    rows = []
+    for id_, league, name in names:
+        if name is None:
+            continue
+        norm_name = normalize_name(name)
+        words = norm_name.split()
+        norm_last = words[-1] if len(words) > 0 else ''
+        rows.append((id_, league, name.strip(), norm_name, norm_last))
+    db_cursor.executemany(
+        'INSERT INTO player_names (id, league, name, norm_name, norm_last) VALUES (?, ?, ?, ?, ?) '
+        'ON CONFLICT (id, league) DO UPDATE SET name = excluded.name, norm_name = excluded.norm_name, '
+        'norm_last = excluded.norm_last WHERE norm_name IS NOT excluded.norm_name',
+        rows)
+
+
+def rebuild_name_index():
+    """Rebuild the name index of every shard from the player pages and seasons saved in it
+
+    :return: None
+    """
+    start_time = time.time()
+    num_indexed = 0
+    for league in sorted(SHARDS):
+        if not os.path.exists(shard_path(league)):
+            continue
+        conn = connect(league)
+        c = conn.cursor()
+        c.execute('DROP TABLE IF EXISTS player_names_fts')
+        c.execute('DROP TABLE IF EXISTS player_names')
+        _create_player_names_table(c)
+        # Seasons first, so names from player pages win
+        sources = [
+            "SELECT DISTINCT id, 'NHL', name FROM player_seasons",
+            'SELECT DISTINCT id, league, name FROM chl_player_seasons',
+            "SELECT id, 'NHL', name FROM player_pages",
+            'SELECT id, league, name FROM chl_player_pages',
+        ]
+        for source in sources:
+            try:
+                c.execute(source)
+            except sqlite3.OperationalError:  # Table not in this shard
+                continue
+            index_player_names(conn.cursor(), c.fetchall())
+        conn.commit()
+        c.execute('SELECT count(*) FROM player_names')
+        num_indexed += c.fetchone()[0]
+        conn.close()
+    print(str(num_indexed) + " players indexed. That took " + str(time.time() - start_time) + " seconds")
+
+
+_local = threading.local()
+
+
+def _get_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and federated_layout(conn) != _local.layout:  # A league was crawled since
+        conn.close()
+        conn = None
+    if conn is None:
+        conn = connect_federated(read_only=True)
+        _local.conn = conn
+        _local.layout = federated_layout(conn)
+    return conn
+
+
+def search_players(query, limit=10, leagues=None):
+    """Return the players whose name best matches <query>, tolerating accents, word order, punctuation and typos
+
+    Candidates sharing trigrams with the query are pulled from the trigram index (or, for queries with words too
+    short to have trigrams, by name prefix), then ranked by trigram similarity with a bonus for names starting with
+    the query.
+
+    :param query: str
+    :param limit: int
+    :param leagues: [str] | None
+    :return: [(str, str, str)] (id, league, name), best match first
+    """
+    c = _get_connection().cursor()
+    norm_query = normalize_name(query)
+    if norm_query == '':
+        return []
+    query_trigrams = _trigrams(norm_query)
+    # The trigram index covers the whole name, so only trigrams within a word can be looked up in it
+    indexed_trigrams = sorted(trigram for trigram in query_trigrams if ' ' not in trigram)
+    # Every shard has its own index: the external content table of an FTS index can not be a view
+    candidates = []
+    for league, schema in attached_shards(c.connection):
+        if leagues is not None and league not in leagues:
+            continue
+        try:
+            if len(indexed_trigrams) == 0:
+                upper = norm_query[:-1] + chr(ord(norm_query[-1]) + 1)
+                c.execute(
+                    'SELECT id, league, name, norm_name FROM ' + schema + '.player_names '
+                    'WHERE (norm_name >= ? AND norm_name < ?) OR (norm_last >= ? AND norm_last < ?) LIMIT ?',
+                    (norm_query, upper, norm_query, upper, CANDIDATES))
+            else:
+                match = ' OR '.join('"' + trigram + '"' for trigram in indexed_trigrams)
+                c.execute(
+                    'SELECT names.id, names.league, names.name, names.norm_name '
+                    'FROM ' + schema + '.player_names_fts '
+                    'JOIN ' + schema + '.player_names AS names ON names.rowid = player_names_fts.rowid '
+                    'WHERE player_names_fts MATCH ? ORDER BY player_names_fts.rank LIMIT ?',
+                    (match, CANDIDATES))
+        except sqlite3.OperationalError:  # Nothing indexed in this shard yet
+            continue
+        candidates += c.fetchall()
+
+    scored = []
+    for id_, league, name, norm_name in candidates:
+        name_trigrams = _trigrams(norm_name)
+        score = len(query_trigrams & name_trigrams) / len(query_trigrams | name_trigrams)
+        for word in [norm_name] + norm_name.split():
+            if word.startswith(norm_query):
+                score += 0.5
+                break
+        scored.append((-score, name, id_, league))
+    scored.sort()
+    return [(id_, league, name) for _, name, id_, league in scored[:limit]]
+
+
+if __name__ == '__main__':
+    with profile_run('search'):
+        rebuild_name_index()
@@ -0,0 +1,133 @@
+from html.parser import HTMLParser
+
+
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'
+}
+# Elements whose rendered text starts on a new line, as with WebElement.text
+BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'dd', 'div', 'dl', 'dt', 'fieldset', 'figcaption', 'figure',
+    'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol', 'option',
+    'p', 'pre', 'section', 'table', 'tbody', 'thead', 'tfoot', 'tr', 'ul', 'select', 'caption',
+}
+HIDDEN_TAGS = {'head', 'script', 'style', 'noscript', 'template'}
+
+
+class SnapshotElement:
+    """Read-only stand-in for a WebDriver element, backed by the static html of an archived page.
+
+    Supports the subset of the WebDriver API the parsers use, so they can run over snapshots without a browser.
+    """
+
+    def __init__(self, tag, attrs, parent=None):
+        self.tag_name = tag
+        self.attrs = attrs
+        self.parent = parent
+        self.children = []  # SnapshotElement or str
+
+    @property
+    def text(self):
+        pieces = []
+        self._collect_text(pieces)
+        lines = []
+        for line in ''.join(pieces).split('\n'):
+            line = ' '.join(line.split())
+            if line != '':
+                lines.append(line)
+        return '\n'.join(lines)
+
+    def _collect_text(self, pieces):
+        if self.tag_name in HIDDEN_TAGS:
+            return
+        if self.tag_name in BLOCK_TAGS:
+            pieces.append('\n')
+        for child in self.children:
+            if isinstance(child, str):
+                pieces.append(child.replace('\n', ' '))
+            elif child.tag_name == 'br':
+                pieces.append('\n')
+            else:
+                child._collect_text(pieces)
+        if self.tag_name in BLOCK_TAGS:
+            pieces.append('\n')
+
+    def get_attribute(self, name):
+        return self.attrs.get(name)
+
+    def _iter_descendants(self):
+        for child in self.children:
+            if not isinstance(child, str):
+                yield child
+                for descendant in child._iter_descendants():
+                    yield descendant
+
+    def find_elements_by_class_name(self, name):
+        elements = []
+        for element in self._iter_descendants():
+            if name in (element.attrs.get('class') or '').split():
+                elements.append(element)
+        return elements
+
+    def find_elements_by_tag_name(self, name):
+        elements = []
+        for element in self._iter_descendants():
+            if element.tag_name == name:
+                elements.append(element)
+        return elements
+
+    def find_element_by_class_name(self, name):
+        return _first(self.find_elements_by_class_name(name), 'class name', name)
+
+    def find_element_by_tag_name(self, name):
+        return _first(self.find_elements_by_tag_name(name), 'tag name', name)
+
+
+class NoSuchSnapshotElement(Exception):
+    pass
+
+
+def _first(elements, by, value):
+    if len(elements) == 0:
+        raise NoSuchSnapshotElement('Unable to locate element by {} {!r}'.format(by, value))
+    return elements[0]
+
+
+class _TreeBuilder(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = SnapshotElement('#document', {})
+        self.stack = [self.root]
+
+    def handle_starttag(self, tag, attrs):
+        element = SnapshotElement(tag, dict((name, value or '') for name, value in attrs), self.stack[-1])
+        self.stack[-1].children.append(element)
+        if tag not in VOID_TAGS:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.stack.pop()
+
+    def handle_endtag(self, tag):
+        # Close the nearest open element with this tag, implicitly closing anything left open inside it
+        for index in range(len(self.stack) - 1, 0, -1):
+            if self.stack[index].tag_name == tag:
+                del self.stack[index:]
+                return
+
+    def handle_data(self, data):
+        self.stack[-1].children.append(data)
+
+
+def parse_snapshot(page_source):
+    """Return the document element of an archived page, searchable like a WebDriver pointed at that page
+
+    :param page_source: str
+    :return: SnapshotElement
+    """
+    builder = _TreeBuilder()
+    builder.feed(page_source)
+    builder.close()
+    return builder.root
@@ -0,0 +1,366 @@
+import os
+import time
+import atexit
+import random
+import socket
+import sqlite3
+import asyncio
+import threading
+
+from collections import deque
+from urllib.parse import urlparse
+
+from common.db import DB_DIR, MAIN_DB
+from common.profiling import profile_run
+
+
+MIN_LIMIT = 1
+MAX_LIMIT = 16
+INITIAL_LIMIT = 2  # For a host never crawled before; otherwise its last persisted limit
+WINDOW = 50  # Latest requests the p95 latency and the error rate are measured over
+DECISION_REQUESTS = 10  # Requests completed between two decisions
+MAX_ERROR_RATE = 0.05
+LATENCY_FACTOR = 2.0  # A p95 latency this many times the baseline counts as a slowdown
+BASELINE_DRIFT = 1.05  # The baseline rises this much per decision, so a lasting slowdown becomes the new normal
+DECREASE_FACTOR = 0.5
+PAUSE_SECONDS = 3.0  # Pause between the requests of a sequential fetcher at limit 1, shorter as the limit rises
+# Outcomes that cut the limit right away, rather than at the next decision
+BACKOFF_OUTCOMES = ('throttled', 'server_error', 'timeout')
+PERSIST_SECONDS = 5.0  # A process writes its metrics to the main database at most this often
+
+_controllers = {}  # host: AIMDController of this process
+_controllers_lock = threading.Lock()
+_unpersisted = {}  # host: fetch_metrics row of the latest decision not written yet
+_unpersisted_lock = threading.Lock()
+_flush_lock = threading.Lock()  # Flushes are serialized, so an older row never overwrites a newer one
+_persister_wakeup = threading.Event()
+_persister_pid = None  # Of the process the background writer was started in; a forked child starts its own
+
+
+def _ensure_fetch_metrics_table(db_cursor):
+    """Utility function for creating the fetch_metrics table, if it does not exist yet. Every process crawling a host
+    keeps its row up to date with its controller's limit and decisions.
+
+    :param db_cursor: database cursor
+    :return:
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS fetch_metrics
+                         (
+                         host TEXT, worker TEXT, concurrency_limit REAL, p95_seconds REAL, error_rate REAL,
+                         requests INTEGER, errors INTEGER, increases INTEGER, decreases INTEGER, last_decision TEXT,
+                         updated REAL,
+                         PRIMARY KEY (host, worker)
+                         )''')
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class AIMDController:
+    """Concurrency limit of one host, tuned from the latency and the outcome of the requests made to it.
+
+    The limit rises by one every DECISION_REQUESTS requests while the p95 latency stays within LATENCY_FACTOR of
+    the host's baseline and the error rate within MAX_ERROR_RATE, and is halved on a slowdown, on a burst of errors
+    and right away on HTTP 429/5xx or a timeout (at most once per <limit> requests, like TCP once per round trip).
+
+    Concurrent fetchers (the feed) keep at most <limit> requests in flight; sequential ones (a browser) pause between
+    requests, for less the higher the limit is. Every process has its own controller per host.
+    """
+
+    def __init__(self, host, limit=INITIAL_LIMIT):
+        self.host = host
+        self.limit = float(limit)
+        self.baseline = None  # Lowest p95 latency seen, in seconds
+        self.requests = 0
+        self.errors = 0
+        self.increases = 0
+        self.decreases = 0
+        self.last_decision = None
+        self._samples = deque(maxlen=WINDOW)  # (seconds, failed)
+        self._since_decision = 0
+        self._since_decrease = 0
+        self._decreased_at = 0
+        self._lock = threading.Lock()
+
+    def window(self):
+        """Return the number of requests to keep in flight
+
+        :return: int
+        """
+        return int(self.limit)
+
+    def record(self, seconds, outcome='ok'):
+        """Record a completed request and adjust the limit if it is time to
+
+        :param seconds: float, latency of the request
+        :param outcome: 'ok' | 'throttled' | 'server_error' | 'timeout' | 'error'
+        :return: None
+        """
+        with self._lock:
+            failed = outcome != 'ok'
+            self.requests += 1
+            self.errors += failed
+            if time.time() - seconds < self._decreased_at:
+                return  # Made at the limit before the last decrease, it says nothing about the current one
+            self._samples.append((seconds, failed))
+            self._since_decision += 1
+            self._since_decrease += 1
+            if outcome in BACKOFF_OUTCOMES:
+                if self._since_decrease >= self.limit:
+                    self._decrease(outcome)
+                return
+            if self._since_decision < DECISION_REQUESTS:
+                return
+            p95, error_rate = self._measure()
+            if p95 is not None:
+                self.baseline = p95 if self.baseline is None else min(p95, self.baseline * BASELINE_DRIFT)
+            if error_rate > MAX_ERROR_RATE:
+                self._decrease('errors')
+            elif p95 is not None and p95 > LATENCY_FACTOR * self.baseline:
+                self._decrease('slow')
+            else:
+                self._increase()
+
+    def _measure(self):
+        """Return the p95 latency of the successful requests of the window, and its error rate"""
+        latencies = [seconds for seconds, failed in self._samples if not failed]
+        p95 = _percentile(latencies, 0.95) if len(latencies) > 0 else None
+        return p95, sum(failed for _, failed in self._samples) / len(self._samples)
+
+    def _increase(self):
+        self.increases += 1
+        self._decide(min(MAX_LIMIT, self.limit + 1), 'increase')
+
+    def _decrease(self, reason):
+        self.decreases += 1
+        self._since_decrease = 0
+        self._decreased_at = time.time()
+        self._decide(max(MIN_LIMIT, self.limit * DECREASE_FACTOR), 'decrease: ' + reason)
+        self._samples.clear()
+
+    def _decide(self, limit, decision):
+        if int(limit) != int(self.limit):
+            print(self.host + ": limit " + str(int(self.limit)) + " -> " + str(int(limit)) + " (" + decision + ")")
+        self.limit = limit
+        self.last_decision = decision
+        self._since_decision = 0
+        _persist(self)
+
+    def metrics(self):
+        """Return the current limit, latency, error rate and decision counters
+
+        :return: dict
+        """
+        with self._lock:
+            p95, error_rate = self._measure() if len(self._samples) > 0 else (None, 0.0)
+            return {
+                'host': self.host, 'limit': self.window(), 'p95_seconds': p95, 'error_rate': error_rate,
+                'requests': self.requests, 'errors': self.errors, 'increases': self.increases,
+                'decreases': self.decreases, 'last_decision': self.last_decision,
+            }
+
+    def pause(self):
+        """Wait before the next request of a sequential fetcher, less the higher the limit is
+
+        :return: None
+        """
+        time.sleep(PAUSE_SECONDS / self.limit * random.uniform(0.5, 1.5))
+
+    def timed(self):
+        """Return a context manager recording the latency and the outcome of the request made within it.
+        An exception raised within it is recorded as a timeout or an error, and passed on.
+
+            with controller.timed():
+                driver.get(url)
+        """
+        return _Timed(self)
+
+
+class _Timed:
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        outcome = 'ok'
+        if exc_type is not None:
+            outcome = 'timeout' if is_timeout(exc_value) else 'error'
+        self.controller.record(time.time() - self.start_time, outcome)
+        return False
+
+
+def is_timeout(error):
+    """Return whether an exception is a timeout, of a socket, of asyncio or of WebDriver
+
+    :param error: Exception
+    :return: bool
+    """
+    # Matched by name, so this module does not depend on selenium
+    return isinstance(error, (socket.timeout, asyncio.TimeoutError)) or type(error).__name__ == 'TimeoutException'
+
+
+def status_outcome(status):
+    """Return the outcome of a request answered with HTTP <status>
+
+    :param status: int
+    :return: 'ok' | 'throttled' | 'server_error' | 'error'
+    """
+    if status == 429:
+        return 'throttled'
+    if status >= 500:
+        return 'server_error'
+    if status >= 400:
+        return 'error'
+    return 'ok'
+
+
+def host_of(url):
+    """Return the host a url is throttled as, without 'www.'
+
+    :param url: str
+    :return: str
+    """
+    host = urlparse(url).netloc.lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+def controller(url):
+    """Return this process' controller of the host of <url>, starting from the host's last persisted limit
+
+    :param url: str, or a host
+    :return: AIMDController
+    """
+    host = host_of(url) if '/' in url else url
+    with _controllers_lock:
+        if host not in _controllers:
+            _controllers[host] = AIMDController(host, _last_limit(host) or INITIAL_LIMIT)
+        return _controllers[host]
+
+
+def metrics():
+    """Return the metrics of every controller of this process
+
+    :return: [dict]
+    """
+    with _controllers_lock:
+        controllers = list(_controllers.values())
+    return [controller.metrics() for controller in controllers]
+
+
+def _connect_metrics(timeout=60):
+    return sqlite3.connect(os.path.join(DB_DIR, MAIN_DB), timeout=timeout)
+
+
+def _persist(aimd_controller):
+    """Queue the metrics of a controller for fetch_metrics, where the server and print_metrics read them. The lock of
+    the controller is held, and for the feed this runs on its event loop: only a snapshot is taken here, and a
+    background thread writes it, so a busy main database never holds up a request.
+    """
+    global _persister_pid
+    p95, error_rate = aimd_controller._measure()
+    row = (aimd_controller.host, socket.gethostname() + ':' + str(os.getpid()), aimd_controller.limit, p95,
+           error_rate, aimd_controller.requests, aimd_controller.errors, aimd_controller.increases,
+           aimd_controller.decreases, aimd_controller.last_decision, time.time())
+    with _unpersisted_lock:
+        _unpersisted[aimd_controller.host] = row
+        if _persister_pid != os.getpid():
+            if _persister_pid is None:
+                atexit.register(flush_metrics)
+            _persister_pid = os.getpid()
+            threading.Thread(target=_run_persister, daemon=True).start()
+    _persister_wakeup.set()
+
+
+def _run_persister():
+    """Background writer of the metrics of this process, at most once every PERSIST_SECONDS"""
+    while True:
+        _persister_wakeup.wait()
+        _persister_wakeup.clear()
+        flush_metrics()
+        time.sleep(PERSIST_SECONDS)
+
+
+def flush_metrics():
+    """Write the metrics queued by the controllers of this process to fetch_metrics now. A database error is printed
+    and the rows are kept for the next flush: persisting metrics must never fail a fetch.
+
+    :return: None
+    """
+    with _flush_lock:
+        with _unpersisted_lock:
+            rows = list(_unpersisted.values())
+            _unpersisted.clear()
+        if len(rows) == 0:
+            return
+        try:
+            conn = _connect_metrics(PERSIST_SECONDS)  # Rather than wait long on a busy database, retry next time
+            try:
+                c = conn.cursor()
+                _ensure_fetch_metrics_table(c)
+                c.executemany('INSERT OR REPLACE INTO fetch_metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print("Fetch metrics could not be saved: " + repr(e))
+            with _unpersisted_lock:
+                for row in rows:
+                    _unpersisted.setdefault(row[0], row)  # Unless a newer decision was queued meanwhile
+
+
+def _last_limit(host):
+    """Return the limit last persisted for <host> by any process, or None"""
+    if not os.path.exists(os.path.join(DB_DIR, MAIN_DB)):
+        return None
+    conn = _connect_metrics()
+    try:
+        row = conn.execute(
+            'SELECT concurrency_limit FROM fetch_metrics WHERE host = ? ORDER BY updated DESC LIMIT 1',
+            (host,)).fetchone()
+    except sqlite3.OperationalError:  # Nothing persisted yet
+        row = None
+    conn.close()
+    return row[0] if row is not None else None
+
+
+def persisted_metrics():
+    """Return the metrics last persisted by every process for every host, most recently updated first per host
+
+    :return: [dict]
+    """
+    if not os.path.exists(os.path.join(DB_DIR, MAIN_DB)):
+        return []
+    conn = _connect_metrics()
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute('SELECT * FROM fetch_metrics ORDER BY host, updated DESC').fetchall()
+    except sqlite3.OperationalError:  # Nothing persisted yet
+        rows = []
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def print_metrics():
+    """Print the persisted metrics of every host and process
+
+    :return: None
+    """
+    line = '{0:<28}{1:<24}{2:>6}{3:>9}{4:>8}{5:>9}{6:>6}{7:>6}  {8}'
+    print(line.format('host', 'worker', 'limit', 'p95', 'errors', 'requests', 'up', 'down', 'last decision'))
+    for row in persisted_metrics():
+        p95 = '-' if row['p95_seconds'] is None else '{:.2f}s'.format(row['p95_seconds'])
+        print(line.format(
+            row['host'], row['worker'], int(row['concurrency_limit']), p95, '{:.1%}'.format(row['error_rate']),
+            row['requests'], row['increases'], row['decreases'], row['last_decision']))
+
+
+if __name__ == '__main__':
+    with profile_run('throttle'):
+        print_metrics()
@@ -0,0 +1,199 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from common.db import DB_DIR
+
+
+# Every worker, on any machine, must open the same file. No WAL: it does not work over network file systems.
+QUEUE_PATH = os.path.join(DB_DIR, 'hockey-stats-queue.db')
+LEASE_SECONDS = 300  # Keep well above the clock skew between machines
+MAX_ATTEMPTS = 3
+
+
+def connect_queue(path=None):
+    """Return a connection to the work queue database, creating the work_queue table if needed
+
+    :param path: str | None, defaults to QUEUE_PATH
+    :return: sqlite3.Connection
+    """
+    conn = sqlite3.connect(path or QUEUE_PATH, timeout=60, isolation_level=None)  # Transactions are explicit
+    conn.execute('''CREATE TABLE IF NOT EXISTS work_queue
+                    (
+                    player_id TEXT, league TEXT, state TEXT, worker TEXT, lease_expires REAL, attempts INTEGER,
+                    updated REAL, error TEXT,
+                    PRIMARY KEY (player_id, league)
+                    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS work_queue_claimable ON work_queue (state, lease_expires)')
+    return conn
+
+
+def worker_name():
+    """Return a name identifying this process across machines
+
+    :return: str
+    """
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+def enqueue(conn, items):
+    """Add (player_id, league) items to the queue. Items already in it, whatever their state, are left alone.
+
+    :param conn: queue connection
+    :param items: [(str, str)]
+    :return: int, number of items added
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    before = conn.total_changes
+    conn.executemany(
+        "INSERT OR IGNORE INTO work_queue VALUES (?, ?, 'pending', NULL, NULL, 0, ?, NULL)",
+        [(player_id, league, now) for player_id, league in items])
+    added = conn.total_changes - before
+    conn.execute('COMMIT')
+    return added
+
+
+def claim(conn, worker, num_items=1, leagues=None, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    """Lease up to <num_items> items to <worker>: pending ones, or leased ones whose lease has expired.
+
+    Selecting and leasing happen in one write transaction, so two workers can never claim the same item. An item
+    whose lease expired after <max_attempts> attempts is marked failed instead: its page hangs or kills the worker
+    fetching it, and would never reach fail().
+
+    :param conn: queue connection
+    :param worker: str
+    :param num_items: int
+    :param leagues: [str] | None, only claim items of these leagues
+    :param lease_seconds: float
+    :param max_attempts: int
+    :return: [(str, str)] (player_id, league)
+    """
+    now = time.time()
+    sql = ("SELECT player_id, league FROM work_queue "
+           "WHERE (state = 'pending' OR (state = 'leased' AND lease_expires < ? AND attempts < ?))")
+    params = [now, max_attempts]
+    if leagues is not None:
+        sql += ' AND league IN (' + ', '.join('?' * len(leagues)) + ')'
+        params += list(leagues)
+    sql += ' LIMIT ?'
+    params.append(num_items)
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(
+            "UPDATE work_queue SET state = 'failed', worker = NULL, lease_expires = NULL, updated = ?, "
+            "error = 'expired lease' WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (now, now, max_attempts))
+        items = conn.execute(sql, params).fetchall()
+        conn.executemany(
+            "UPDATE work_queue SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+            "updated = ? WHERE player_id = ? AND league = ?",
+            [(worker, now + lease_seconds, now, player_id, league) for player_id, league in items])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return items
+
+
+def heartbeat(conn, worker, items, lease_seconds=LEASE_SECONDS):
+    """Extend the leases <worker> still holds on <items>
+
+    :param conn: queue connection
+    :param worker: str
+    :param items: [(str, str)]
+    :param lease_seconds: float
+    :return: int, number of leases extended; fewer than len(items) means some were lost to expiry
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    before = conn.total_changes
+    conn.executemany(
+        "UPDATE work_queue SET lease_expires = ?, updated = ? "
+        "WHERE player_id = ? AND league = ? AND state = 'leased' AND worker = ?",
+        [(now + lease_seconds, now, player_id, league, worker) for player_id, league in items])
+    extended = conn.total_changes - before
+    conn.execute('COMMIT')
+    return extended
+
+
+def complete(conn, worker, item):
+    """Mark an item leased by <worker> as done
+
+    :param conn: queue connection
+    :param worker: str
+    :param item: (str, str)
+    :return: bool, False if the lease had been lost (the item was then reclaimed by another worker)
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    cursor = conn.execute(
+        "UPDATE work_queue SET state = 'done', lease_expires = NULL, updated = ?, error = NULL "
+        "WHERE player_id = ? AND league = ? AND state = 'leased' AND worker = ?",
+        (time.time(), item[0], item[1], worker))
+    conn.execute('COMMIT')
+    return cursor.rowcount == 1
+
+
+def fail(conn, worker, item, error, max_attempts=MAX_ATTEMPTS):
+    """Give back an item leased by <worker> that could not be done: it is retried by whichever worker claims it next,
+    unless it has already been attempted <max_attempts> times
+
+    :param conn: queue connection
+    :param worker: str
+    :param item: (str, str)
+    :param error: str
+    :param max_attempts: int
+    :return: None
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute(
+        "UPDATE work_queue SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, "
+        "lease_expires = NULL, updated = ?, error = ? "
+        "WHERE player_id = ? AND league = ? AND state = 'leased' AND worker = ?",
+        (max_attempts, time.time(), error, item[0], item[1], worker))
+    conn.execute('COMMIT')
+
+
+def queue_status(conn):
+    """Return the number of items of every league in every state
+
+    :param conn: queue connection
+    :return: {(str, str): int} (league, state): count
+    """
+    rows = conn.execute('SELECT league, state, count(*) FROM work_queue GROUP BY league, state').fetchall()
+    return dict(((league, state), count) for league, state, count in rows)
+
+
+class Heartbeat:
+    """Background thread extending a worker's leases every third of the lease duration while it works on them.
+
+        with Heartbeat(worker, items):
+            ... fetch the items ...
+    """
+
+    def __init__(self, worker, items, lease_seconds=LEASE_SECONDS, path=None):
+        self.worker = worker
+        self.items = items
+        self.lease_seconds = lease_seconds
+        self.path = path
+        self.lost = False  # Whether a lease expired before it could be extended
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        conn = connect_queue(self.path)  # Connections can not be shared between threads
+        while not self._stop.wait(self.lease_seconds / 3):
+            if heartbeat(conn, self.worker, self.items, self.lease_seconds) < len(self.items):
+                self.lost = True
+        conn.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
@@ -1,10 +1,12 @@
-import sqlite3
-import os
 import time
 import datetime
 
-from random import randint
-from selenium import webdriver
+from common.archive import save_snapshot
+from common.browser import acquire_driver, get_page
+from common.db import bump_generation, connect, rebuild_table, table_is_current
+from common.dims import draft_ids
+from common.profiling import profile_run
+from common.search import index_player_names
 
 
 class Birthplace:
@@ -52,41 +54,122 @@ class PlayerPage:
                "{:<10}".format("|Born in  " + str(self.birthplace))
 
 
+def _ensure_player_pages_table(db_cursor):
+    """Utility function for creating the player_pages table in a shard, if it does not exist yet
+
+    :param db_cursor: database cursor
+    :return:
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS player_pages
+                         (
+                         id text PRIMARY KEY, name text, num text, pos text, height real, weight real, birth_date text,
+                         birth_city text, birth_state text, birth_country text, shoots text,
+                         draft_year text, draft_team text, draft_round text, draft_overall text, draft_id integer
+                         )
+                         ''')
+    db_cursor.execute('CREATE INDEX IF NOT EXISTS player_pages_draft ON player_pages (draft_id)')
+
+
 def _create_player_pages_table():
     """Utility function for creating/initializing the player_page table
 
     :return:
     """
-    conn = sqlite3.connect('hockey-stats.db')
+    conn = connect('NHL')
     c = conn.cursor()
     c.execute('DROP TABLE IF EXISTS player_pages')
-    c.execute('''CREATE TABLE player_pages
-                 (
-                 id text PRIMARY KEY, name text, num text, pos text, height real, weight real, birth_date text,
-                 birth_city text, birth_state text, birth_country text, shoots text,
-                 draft_year text, draft_team text, draft_round text, draft_overall text
-                 )
-                 ''')
+    _ensure_player_pages_table(c)
     conn.commit()
     conn.close()
 
 
-def _save_player_page(db_cursor, player_page):
-    """ Save a list of PlayerSeason objects to a database
+def _upgraded_player_page_rows(db_cursor, rows):
+    """Return player_pages rows saved with an older definition of the table as rows of the current one
+
+    :param db_cursor: database cursor
+    :param rows: [dict]
+    :return: [dict]
+    """
+    def draft_key(row):
+        return 'NHL', row['draft_year'], row['draft_team'], row['draft_round'], row['draft_overall']
+
+    drafts = draft_ids(db_cursor, 'NHL', [draft_key(row) for row in rows])
+    for row in rows:
+        row['draft_id'] = drafts.get(draft_key(row))
+    return rows
+
+
+def _upgrade_player_pages_table(conn):
+    """Rebuild the player_pages table of a shard with its current definition (draft ids), if it was created with an
+    older one, and store the unknown birth dates saved as 'None' as NULL
+
+    :param conn: connection to the NHL shard
+    :return: bool, whether the table was rebuilt
+    """
+    c = conn.cursor()
+    if 'player_pages' in set(row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")):
+        c.execute("UPDATE player_pages SET birth_date = NULL WHERE birth_date = 'None'")
+        if c.rowcount > 0:
+            bump_generation(c, 'player_pages')
+        conn.commit()
+    if table_is_current(conn.cursor(), 'player_pages', _ensure_player_pages_table):
+        return False
+    rebuild_table(conn, 'player_pages', _ensure_player_pages_table, _upgraded_player_page_rows)
+    return True
+
+
+def _player_page_row(player_page):
+    """Return the player_pages table row representing a PlayerPage object
 
-    :param c: database cursor
     :param player_page: PlayerPage
-    :return: None
+    :return: tuple
     """
-    temp_player_page = (
+    return (
         player_page.id, player_page.name, player_page.num, player_page.pos, player_page.height, player_page.weight,
-        str(player_page.birth_date), player_page.birthplace.city, player_page.birthplace.state,
-        player_page.birthplace.country, player_page.shoots,
+        str(player_page.birth_date) if player_page.birth_date is not None else None,
+        player_page.birthplace.city, player_page.birthplace.state, player_page.birthplace.country, player_page.shoots,
         player_page.draft.year, player_page.draft.team, player_page.draft.round, player_page.draft.overall
     )
-    db_cursor.execute(
-        'INSERT INTO player_pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-        temp_player_page)
+
+
+def _row_to_player_page(row):
+    """Return the PlayerPage object represented by a player_pages table row
+
+    :param row: tuple
+    :return: PlayerPage
+    """
+    birthplace = Birthplace(row[7], row[8], row[9])
+    draft = Draft(row[11], row[12], row[13], row[14])
+    return PlayerPage(row[0], row[1], row[2], row[3], row[4], row[5], row[6], birthplace, row[10], draft)
+
+
+def _save_player_pages(db_cursor, player_pages, replace=False):
+    """ Save a list of PlayerPage objects to a database
+
+    :param db_cursor: database cursor
+    :param player_pages: [PlayerPage]
+    :param replace: bool, overwrite pages already saved instead of failing on them
+    :return: None
+    """
+    if replace:
+        statement = 'INSERT OR REPLACE INTO player_pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    else:
+        statement = 'INSERT INTO player_pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    rows = [_player_page_row(player_page) for player_page in player_pages]
+    drafts = draft_ids(db_cursor, 'NHL', [('NHL',) + row[11:15] for row in rows])
+    db_cursor.executemany(statement, [row + (drafts.get(('NHL',) + row[11:15]),) for row in rows])
+    bump_generation(db_cursor, 'player_pages')
+    index_player_names(db_cursor, [(player_page.id, 'NHL', player_page.name) for player_page in player_pages])
+
+
+def _save_player_page(db_cursor, player_page):
+    """ Save a PlayerPage object to a database
+
+    :param db_cursor: database cursor
+    :param player_page: PlayerPage
+    :return: None
+    """
+    _save_player_pages(db_cursor, [player_page])
     print(" saved")
 
 
@@ -169,7 +252,18 @@ def _parse_player_page(id_, driver):
     url_frag = "https://www.nhl.com/player/"
     url_complete = url_frag + id_
 
-    driver.get(url_complete)
+    get_page(driver, url_complete)
+    save_snapshot('nhl_player', id_, {'id': id_}, driver.page_source)
+    return _parse_loaded_player_page(id_, driver)
+
+
+def _parse_loaded_player_page(id_, driver):
+    """ Given a WebDriver <driver> already pointing to the nhl.com player page of <id_>, return the PlayerPage object.
+
+    :param id_:
+    :param driver:
+    :return: PlayerPage
+    """
     # Get WebDriver containing info
     name_num_element = driver.find_element_by_class_name('player-jumbotron-vitals__name-num')
     attributes_element = driver.find_element_by_class_name('player-jumbotron-vitals__attributes')
@@ -214,9 +308,11 @@ def _parse_player_page(id_, driver):
 
 
 def save_player_pages(cap):
-    driver = webdriver.Chrome(executable_path=os.path.join(os.getcwd(), "driver\chromedriver.exe"))
-    conn = sqlite3.connect('hockey-stats.db')
+    driver = acquire_driver()
+    conn = connect('NHL')
+    _upgrade_player_pages_table(conn)  # Saved rows and indexes need the columns of the current definition
     c = conn.cursor()
+    _ensure_player_pages_table(c)
     c.execute(
         'SELECT * FROM player_seasons')
     all_seasons = c.fetchall()
@@ -237,7 +333,6 @@ def save_player_pages(cap):
             _save_player_page(c, temp_player_page)
             page_counter += 1
             conn.commit()
-            time.sleep(randint(1, 5))
         counter += 1
 
 
@@ -254,8 +349,8 @@ def save_player_pages(cap):
 
 if __name__ == '__main__':
     '''
-    driver = webdriver.Chrome(executable_path=os.path.join(os.getcwd(), "driver\chromedriver.exe"))
-    conn = sqlite3.connect('hockey-stats.db')
+    driver = create_driver()
+    conn = connect('NHL')
     c = conn.cursor()
     temp_player = _parse_player_page('8471215', driver)
     _save_player_page(c, temp_player)
@@ -264,4 +359,9 @@ if __name__ == '__main__':
     driver.close()
     '''
     #_create_player_pages_table()
-    save_player_pages(65000)
+    from analytics.features import update_season_features
+
+    with profile_run('nhl_playerpage') as profiler:
+        save_player_pages(65000)
+        profiler.phase('crawl')
+        update_season_features()
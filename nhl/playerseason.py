@@ -1,10 +1,17 @@
-import sqlite3
-import os
 import time
 
-from selenium import webdriver
+from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver.common.keys import Keys
 
+from common.archive import save_snapshot
+from common.browser import acquire_driver, get_page
+from common.db import STRICT, bump_generation, connect, rebuild_table, table_is_current
+from common.dims import team_ids
+from common.history import record_history
+from common.leaderboards import update_leaderboards
+from common.profiling import mark_phase, profile_run
+from common.search import index_player_names
+
 
 class PlayerSeason:
     """Object representing a single players season. season_type = '2' for regular season or '3' for playoffs
@@ -35,7 +42,7 @@ class PlayerSeason:
         self.otg = otg
         self.s = s
         self.s_per = s_per
-        self.toi_gp = toi_gp
+        self.toi_gp = toi_gp  # seconds
         self.shifts_gp = shifts_gp
         self.fow_per = fow_per
 
@@ -57,80 +64,90 @@ def _parse_player(season_year, season_type, stats_list):
     :param stats_list: [WebDriver]
     :return: PlayerSeason
     """
-    name = stats_list[1].text
-    id_ = _parse_id(stats_list[1])
-    team = stats_list[3].text
-    pos = stats_list[4].text
+    texts = [stat.text for stat in stats_list]
+    return _parse_player_texts(season_year, season_type, _parse_id(stats_list[1]), texts)
+
+
+def _parse_player_texts(season_year, season_type, id_, texts):
+    """ Return a PlayerSeason object given the text of every cell of a row of the stats table. Shared by the page
+    parser and the bulk loader, so rows from both go through the same conversions.
+
+    :param season_year: str
+    :param season_type: str
+    :param id_: str
+    :param texts: [str], in the order of the stats table's columns
+    :return: PlayerSeason
+    """
+    name = texts[1]
+    team = texts[3]
+    pos = texts[4]
     try:
-        gp = int(stats_list[5].text)
+        gp = int(texts[5])
     except ValueError:
         gp = None
     try:
-        goals = int(stats_list[6].text)
+        goals = int(texts[6])
     except ValueError:
         goals = None
     try:
-        assists = int(stats_list[7].text)
+        assists = int(texts[7])
     except ValueError:
         assists = None
     try:
-        points = int(stats_list[8].text)
+        points = int(texts[8])
     except ValueError:
         points = None
     try:
-        plus_minus = int(stats_list[9].text)
+        plus_minus = int(texts[9])
     except ValueError:
         plus_minus = None
     try:
-        pim = int(stats_list[10].text)
+        pim = int(texts[10])
     except ValueError:
         pim = None
     try:
-        p_gp = float(stats_list[11].text)
+        p_gp = float(texts[11])
     except ValueError:
         p_gp = None
     try:
-        ppg = int(stats_list[12].text)
+        ppg = int(texts[12])
     except ValueError:
         ppg = None
     try:
-        ppp = int(stats_list[13].text)
+        ppp = int(texts[13])
     except ValueError:
         ppp = None
     try:
-        shg = int(stats_list[14].text)
+        shg = int(texts[14])
     except ValueError:
         shg = None
     try:
-        shp = int(stats_list[15].text)
+        shp = int(texts[15])
     except ValueError:
         shp = None
     try:
-        gwg = int(stats_list[16].text)
+        gwg = int(texts[16])
     except ValueError:
         gwg = None
     try:
-        otg = int(stats_list[17].text)
+        otg = int(texts[17])
     except ValueError:
         otg = None
     try:
-        s = int(stats_list[18].text)
+        s = int(texts[18])
     except ValueError:
         s = None
     try:
-        s_per = float(stats_list[19].text)
+        s_per = float(texts[19])
     except ValueError:
         s_per = None
-    if stats_list[20].text == '':
-        toi_gp = None
-    else:
-        toi_gp = stats_list[20].text
+    toi_gp = _parse_toi(texts[20])
     try:
-        shifts_gp = float(stats_list[21].text)
+        shifts_gp = float(texts[21])
     except ValueError:
         shifts_gp = None
     try:
-        fow_per = float(stats_list[22].text)
+        fow_per = float(texts[22])
     except ValueError:
         fow_per = None
     return PlayerSeason(
@@ -139,6 +156,23 @@ def _parse_player(season_year, season_type, stats_list):
     )
 
 
+def _parse_toi(toi_raw):
+    """Given a time on ice as 'MM:SS' (or as a number of seconds), return it as a number of seconds
+
+    :param toi_raw: str
+    :return: int | None
+    """
+    if toi_raw is None:
+        return None
+    try:
+        if ':' in toi_raw:
+            minutes, seconds = toi_raw.split(':')
+            return int(minutes) * 60 + int(seconds)
+        return int(round(float(toi_raw)))
+    except ValueError:
+        return None
+
+
 def _parse_id(element):
     """Given an WebDriver <element> containing a url to a player page, parse and return the player id
 
@@ -151,22 +185,61 @@ def _parse_id(element):
     return id_
 
 
+def _ensure_player_seasons_table(db_cursor):
+    """Utility function for creating the player_seasons table in a shard, if it does not exist yet
+
+    :param db_cursor: database cursor
+    :return:
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS player_seasons
+                         (
+                         id text, name text, year text, season_type text, team text,
+                         pos text, gp integer, goals integer, assists integer, points integer, plus_minus integer,
+                         pim integer, p_gp real, ppg integer, ppp integer, shg integer, shp integer, otg integer,
+                         s integer, s_per real, toi_gp integer, shifts_gp real, fow_per real, team_id integer,
+                         PRIMARY KEY (id, year, season_type)
+                         )''' + STRICT)
+    db_cursor.execute(
+        'CREATE INDEX IF NOT EXISTS player_seasons_toi_gp ON player_seasons (year, season_type, toi_gp)')
+    db_cursor.execute(
+        'CREATE INDEX IF NOT EXISTS player_seasons_team ON player_seasons (team_id, year, season_type)')
+
+
+def _upgraded_player_season_rows(db_cursor, rows):
+    """Return player_seasons rows saved with an older definition of the table as rows of the current one
+
+    :param db_cursor: database cursor
+    :param rows: [dict]
+    :return: [dict]
+    """
+    teams = team_ids(db_cursor, 'NHL', [('NHL', row['team']) for row in rows])
+    for row in rows:
+        if isinstance(row['toi_gp'], str):  # Saved as 'MM:SS'
+            row['toi_gp'] = _parse_toi(row['toi_gp'])
+        row['team_id'] = teams.get(('NHL', row['team']))
+    return rows
+
+
+def _upgrade_player_seasons_table(conn):
+    """Rebuild the player_seasons table of a shard with its current definition (typed columns, time on ice in
+    seconds, team ids), if it was created with an older one
+
+    :param conn: sqlite3.Connection
+    :return: None
+    """
+    if not table_is_current(conn.cursor(), 'player_seasons', _ensure_player_seasons_table):
+        rebuild_table(conn, 'player_seasons', _ensure_player_seasons_table, _upgraded_player_season_rows)
+
+
 def _create_player_seasons_table():
     """Utility function for creating/initializing the player_seasons table
 
     :return:
     """
-    conn = sqlite3.connect('hockey-stats.db')
+    conn = connect('NHL')
     c = conn.cursor()
     c.execute('DROP TABLE IF EXISTS player_seasons')
-    c.execute('''CREATE TABLE player_seasons
-                 (
-                 id text, name text, year text, season_type text, team text,
-                 pos text, gp integer, goals integer, assists integer, points integer, plus_minus integer,
-                 pim integer, p_gp real, ppg integer, ppp integer, shg integer, shp integer, otg integer,
-                 s integer, s_per real, toi_gp text, shifts_gp real, fow_per real,
-                 PRIMARY KEY (id, year, season_type)
-                 )''')
+    _ensure_player_seasons_table(c)
     conn.commit()
     conn.close()
 
@@ -191,7 +264,7 @@ def _create_seasons_list(start_year, end_year):
     return seasons_list
 
 
-def _grab_single_page(season_year, season_type, driver):
+def _parse_single_page(season_year, season_type, driver):
     """Given a WebDriver <driver> that points to a nhl.com url with season statistics for players, parse and return a
       list of PlayerSeason objects representing the data on the single page.
 
@@ -201,7 +274,6 @@ def _grab_single_page(season_year, season_type, driver):
     :return: [PlayerSeason}
     """
     player_seasons = []
-    time.sleep(1)  # Let the user actually see something!
     test_element = driver.find_elements_by_class_name('standard-row')
     for temp_player in test_element:
         temp_stats = temp_player.find_elements_by_tag_name('td')
@@ -210,6 +282,23 @@ def _grab_single_page(season_year, season_type, driver):
     return player_seasons
 
 
+def _grab_single_page(season_year, season_type, page_num, driver):
+    """Wait for the page <page_num> of a nhl.com season statistics url to render in <driver>, archive it, and return
+    the list of PlayerSeason objects representing the data on it.
+
+    :param season_year: str
+    :param season_type: str
+    :param page_num: int
+    :param driver: WebDriver
+    :return: [PlayerSeason}
+    """
+    time.sleep(1)  # Let the stats table render
+    meta = {'season_year': season_year, 'season_type': season_type, 'page_num': page_num}
+    key = season_year + '_' + season_type + '_' + str(page_num)
+    save_snapshot('nhl_season', key, meta, driver.page_source)
+    return _parse_single_page(season_year, season_type, driver)
+
+
 def _grab_player_seasons(season_year, season_type, driver):
     """ Given a WebDriver <driver>, point the driver to a nhl.com url with season statistics for players in
     year <season_year> and of <season_type> and navigate the driver to all possible pages and return the list of
@@ -226,7 +315,7 @@ def _grab_player_seasons(season_year, season_type, driver):
     url_frag4 = "&filter=gamesPlayed,gte,1&sort=points,goals,gamesPlayed"
     url_complete = url_frag1 + season_type + url_frag2 + season_year + url_frag3 + season_year + url_frag4
 
-    driver.get(url_complete)
+    get_page(driver, url_complete)
     player_seasons = []
     curr_page = 1
 
@@ -235,11 +324,11 @@ def _grab_player_seasons(season_year, season_type, driver):
         page_nums = page_select_element.text.split('\n')
         last_page = int(page_nums[-1])
         while curr_page <= last_page:
-            player_seasons += _grab_single_page(season_year, season_type, driver)
+            player_seasons += _grab_single_page(season_year, season_type, curr_page, driver)
             page_select_element.send_keys(Keys.ARROW_DOWN)
             curr_page += 1
-    except selenium.common.exceptions.NoSuchElementException:  # Only 1 page of stats available
-        player_seasons += _grab_single_page(season_year, season_type, driver)
+    except NoSuchElementException:  # Only 1 page of stats available
+        player_seasons += _grab_single_page(season_year, season_type, curr_page, driver)
 
     return player_seasons
 
@@ -269,9 +358,11 @@ def save_player_seasons(start_year, end_year):
     :param end_year:
     :return:
     """
-    driver = webdriver.Chrome(executable_path=os.path.join(os.getcwd(), "driver\chromedriver.exe"))
-    conn = sqlite3.connect('hockey-stats.db')
+    driver = acquire_driver()
+    conn = connect('NHL')
+    _upgrade_player_seasons_table(conn)  # Saved rows and indexes need the columns of the current definition
     c = conn.cursor()
+    _ensure_player_seasons_table(c)
 
     start_time = time.time()
     season_counter = 0
@@ -283,11 +374,13 @@ def save_player_seasons(start_year, end_year):
             _save_single_player_seasons(c, temp_reg_seasons)
             season_counter += 1
             conn.commit()
+            mark_phase(year + ' regular season')
         if not _season_exists(c, year, '3'):
             temp_playoff_seasons = _grab_player_seasons(year, '3', driver)
             _save_single_player_seasons(c, temp_playoff_seasons)
             season_counter += 1
             conn.commit()
+            mark_phase(year + ' playoffs')
 
     driver.close()
 
@@ -302,26 +395,67 @@ def save_player_seasons(start_year, end_year):
     conn.close()
 
 
-def _save_single_player_seasons(c, player_seasons):
+def _player_season_row(player_season):
+    """Return the player_seasons table row representing a PlayerSeason object
+
+    :param player_season: PlayerSeason
+    :return: tuple
+    """
+    return (
+        player_season.id, player_season.name, player_season.year, player_season.type, player_season.team,
+        player_season.pos, player_season.gp, player_season.goals, player_season.assists, player_season.points,
+        player_season.plus_minus, player_season.pim, player_season.p_gp, player_season.ppg, player_season.ppp,
+        player_season.shg, player_season.shp, player_season.otg, player_season.s, player_season.s_per,
+        player_season.toi_gp, player_season.shifts_gp, player_season.fow_per
+    )
+
+
+def _row_to_player_season(row):
+    """Return the PlayerSeason object represented by a player_seasons table row
+
+    :param row: tuple
+    :return: PlayerSeason
+    """
+    gwg = None  # Not stored in player_seasons
+    return PlayerSeason(*(tuple(row[:17]) + (gwg,) + tuple(row[17:23])))
+
+
+def _save_single_player_seasons(c, player_seasons, replace=False):
     """ Save a list of PlayerSeason objects to a database
 
     :param c: database cursor
     :param player_seasons: [PlayerSeason]
+    :param replace: bool, overwrite rows already saved instead of failing on them
     :return:
     """
-    for player_season in player_seasons:
-        temp_player = (
-            player_season.id, player_season.name, player_season.year, player_season.type, player_season.team,
-            player_season.pos, player_season.gp, player_season.goals, player_season.assists, player_season.points,
-            player_season.plus_minus, player_season.pim, player_season.p_gp, player_season.ppg, player_season.ppp,
-            player_season.shg, player_season.shp, player_season.otg, player_season.s, player_season.s_per,
-            player_season.toi_gp, player_season.shifts_gp, player_season.fow_per
-        )
-        c.execute(
-            'INSERT INTO player_seasons VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            temp_player)
-    print(player_season.year + " season, type " + player_season.type + " saved")
+    if replace:
+        statement = 'INSERT OR REPLACE INTO player_seasons VALUES ' \
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    else:
+        statement = 'INSERT INTO player_seasons VALUES ' \
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    teams = team_ids(c, 'NHL', [('NHL', player_season.team) for player_season in player_seasons])
+    rows = [
+        _player_season_row(player_season) + (teams.get(('NHL', player_season.team)),)
+        for player_season in player_seasons
+    ]
+    record_history(c, 'player_seasons', rows)
+    c.executemany(statement, rows)
+    update_leaderboards(c, 'player_seasons', rows)
+    bump_generation(c, 'player_seasons')
+    index_player_names(c, [(player_season.id, 'NHL', player_season.name) for player_season in player_seasons])
+    if len(player_seasons) > 0:
+        print(player_seasons[0].year + " season, type " + player_seasons[0].type + " saved")
 
 
 if __name__ == "__main__":
-    save_player_seasons(1917, 2016)
+    from analytics.comparables import update_comparables_index
+    from analytics.features import update_season_features
+    from analytics.seasonmatrix import update_season_matrix
+
+    with profile_run('nhl_playerseason') as profiler:
+        save_player_seasons(1917, 2016)
+        profiler.phase('crawl')
+        update_comparables_index()
+        update_season_matrix()
+        update_season_features()
@@ -0,0 +1,84 @@
+import os
+import json
+import asyncio
+import threading
+
+from aiohttp import web
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'feed')
+
+
+class FeedStandIn:
+    """Local stand-in for the statviewfeed, answering from the feed responses recorded under
+    fixtures/feed/<client_code>/: seasons.json, season-<season id>.json (served a page at a time, by first and limit)
+    and player-<player id>.json. A request without a recorded response gets a 404.
+
+        with FeedStandIn() as stand_in:
+            feed.fetch_seasons('OHL', stand_in.url)
+    """
+
+    def __init__(self, fixtures_dir=FIXTURES_DIR):
+        self.fixtures_dir = fixtures_dir
+        self.url = None
+        self.requests = []  # Query of every request, in the order they came
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def _fixture(self, client_code, name):
+        path = os.path.join(self.fixtures_dir, client_code, name)
+        if not os.path.exists(path):
+            raise web.HTTPNotFound()
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    async def _handle(self, request):
+        query = dict(request.query)
+        self.requests.append(query)
+        client_code = query.get('client_code', '')
+        if query.get('feed') == 'modulekit' and query.get('view') == 'seasons':
+            text = self._fixture(client_code, 'seasons.json')
+        elif query.get('view') == 'players':
+            text = self._page(self._fixture(client_code, 'season-' + query['season'] + '.json'),
+                              int(query.get('first', 0)), int(query.get('limit', 500)))
+        elif query.get('view') == 'player':
+            text = self._fixture(client_code, 'player-' + query['player_id'] + '.json')
+        else:
+            raise web.HTTPNotFound()
+        return web.Response(text=text, content_type='application/json')
+
+    @staticmethod
+    def _page(text, first, limit):
+        data = json.loads(text)
+        section = data[0]['sections'][0]
+        section['data'] = section['data'][first:first + limit]
+        return json.dumps(data)
+
+    def _run(self, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_get('/feed/index.php', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        self._loop.run_until_complete(site.start())
+        host, port = self._runner.addresses[0][:2]
+        self.url = 'http://' + host + ':' + str(port) + '/feed/index.php'
+        ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def __enter__(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        return False
@@ -0,0 +1,75 @@
+import pytest
+
+from common import browser
+
+
+class _FakeDriver:
+    """Stand-in for a Chrome session: current_window_handle fails once it has quit, like a dead browser"""
+
+    def __init__(self, profile_name):
+        self.profile_name = profile_name
+        self.quit_count = 0
+        self.urls = []
+
+    @property
+    def current_window_handle(self):
+        if self.quit_count > 0:
+            raise RuntimeError('browser has quit')
+        return 'window'
+
+    def get(self, url):
+        self.urls.append(url)
+
+    def quit(self):
+        self.quit_count += 1
+
+
+@pytest.fixture
+def drivers(monkeypatch):
+    """Every fake driver started by the pools of a test"""
+    started = []
+
+    def create_driver(headless, lean, profile_name):
+        started.append(_FakeDriver(profile_name))
+        return started[-1]
+    monkeypatch.setattr(browser, 'create_driver', create_driver)
+    return started
+
+
+def test_close_quits_borrowed_sessions(drivers):
+    pool = browser.BrowserPool('test', spares=0)
+    borrowed = pool.acquire()
+    borrowed.get('http://example.com/1')
+    given_back = pool.acquire()
+    given_back.close()
+    assert len(drivers) == 2
+
+    pool.close()
+    assert [driver.quit_count for driver in drivers] == [1, 1]
+    borrowed.close()  # Given back after close(): not quit twice, nor kept
+    assert [driver.quit_count for driver in drivers] == [1, 1]
+    assert len(pool._idle) == 0 and len(pool._sessions) == 0
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+
+
+def test_sessions_are_reused_and_recycled(drivers, monkeypatch):
+    monkeypatch.setattr(browser, 'RECYCLE_PAGES', 2)
+    pool = browser.BrowserPool('test', spares=0)
+    driver = pool.acquire()
+    for page in range(3):
+        driver.get('http://example.com/' + str(page))
+    driver.close()
+    assert driver._session is None
+    assert [len(fake.urls) for fake in drivers] == [2, 1]
+    assert (drivers[0].quit_count, pool.recycled) == (1, 1)
+    # The replacement starts while the worn session is still open, so it gets a profile of its own
+    assert (drivers[0].profile_name, drivers[1].profile_name) == ('test', 'test-1')
+    assert pool._profiles_in_use == {'test-1'}
+
+    again = pool.acquire()
+    assert again._session.driver is drivers[1]
+    again.close()
+    pool.close()
+    assert [fake.quit_count for fake in drivers] == [1, 1]
+    assert pool.recycled == 1
@@ -0,0 +1,43 @@
+import csv
+import json
+
+import pytest
+
+from common import db
+from tools import export
+
+
+@pytest.fixture
+def pages(tmp_path, monkeypatch):
+    """An NHL shard under tmp_path holding 110 player pages
+
+    :return: [tuple] the rows
+    """
+    monkeypatch.setattr(db, 'DB_DIR', str(tmp_path))
+    rows = [(str(player_id), 'Player ' + str(player_id)) for player_id in range(110)]
+    conn = db.connect('NHL')
+    conn.execute('CREATE TABLE player_pages (id TEXT PRIMARY KEY, name TEXT)')
+    conn.executemany('INSERT INTO player_pages VALUES (?, ?)', rows)
+    conn.commit()
+    conn.close()
+    return rows
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('shard_rows, chunk_rows', [(50, 20), (40, 20), (30, 50)])
+def test_every_csv_shard_starts_with_one_header(pages, tmp_path, workers, shard_rows, chunk_rows):
+    out_dir = str(tmp_path / 'export')
+    manifest = export.export_table('player_pages', 'csv', 'none', shard_rows, out_dir, chunk_rows, workers)
+
+    exported = []
+    for shard in manifest['shards']:
+        with open(out_dir + '/' + shard['file'], newline='') as f:
+            lines = list(csv.reader(f))
+        assert lines[0] == ['id', 'name']
+        assert ['id', 'name'] not in lines[1:]
+        assert len(lines) - 1 == shard['rows']
+        exported += [tuple(line) for line in lines[1:]]
+    assert sorted(exported) == sorted(pages)
+    assert manifest['rows'] == len(pages)
+    with open(out_dir + '/manifest.json') as f:
+        assert json.load(f)['shards'] == manifest['shards']
@@ -0,0 +1,107 @@
+import datetime
+
+import pytest
+
+from chl import feed
+from chl import playerpage as chl_playerpage
+from chl import playerseason as chl_playerseason
+from common import db, throttle
+from tests.feedstandin import FeedStandIn
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    """Feed stand-in serving the recorded responses, with the fetch metrics of the throttle persisted under tmp_path
+    rather than the working directory
+    """
+    monkeypatch.setattr(throttle, 'DB_DIR', str(tmp_path))
+    monkeypatch.setattr(throttle, '_controllers', {})
+    monkeypatch.setattr(throttle, '_unpersisted', {})
+    with FeedStandIn() as server:
+        yield server
+    throttle.flush_metrics()  # While the metrics still go under tmp_path
+
+
+def test_fetch_seasons_decodes_jsonp(stand_in):
+    assert feed.fetch_seasons('OHL', stand_in.url) == [('2019-20 Regular Season', '68'), ('2019 Playoffs', '66')]
+    query = stand_in.requests[0]
+    assert (query['key'], query['client_code']) == feed.FEED_CLIENTS['OHL']
+    assert (query['lang'], query['fmt']) == ('en', 'json')
+
+
+def test_fetch_season_rows_follows_pages(stand_in, monkeypatch):
+    monkeypatch.setattr(feed, 'PAGE_ROWS', 2)
+    rows = feed.fetch_season_rows('OHL', ['68'], stand_in.url)
+    assert list(rows) == ['68']
+    assert [row['player_id'] for row in rows['68']] == ['1', '2', '3']
+    assert [(query['first'], query['limit']) for query in stand_in.requests] == [('0', '2'), ('2', '2')]
+
+
+def test_fetch_season_rows_leaves_out_failed_seasons(stand_in):
+    rows = feed.fetch_season_rows('OHL', ['68', '66'], stand_in.url)  # 66 was not recorded, so it gets a 404
+    assert list(rows) == ['68']
+    assert len(rows['68']) == 3
+
+
+def _cells(row):
+    _, texts, headers = feed.season_row_texts(row)
+    return dict(zip(headers, texts))
+
+
+def test_season_row_texts_match_the_site_table(stand_in):
+    rows = feed.fetch_season_rows('OHL', ['68'], stand_in.url)['68']
+    id_, _, headers = feed.season_row_texts(rows[0])
+    assert id_ == '1'
+    assert headers == [header for _, header in feed.SEASON_FIELDS]
+    assert (_cells(rows[0])['Name'], _cells(rows[0])['Inactive']) == ('Example, Connor', 'X')
+    assert (_cells(rows[1])['Name'], _cells(rows[1])['Team'], _cells(rows[1])['Rookie']) == \
+        ('Sample, Sam', 'London Knights', '*')
+    assert (_cells(rows[2])['#'], _cells(rows[2])['SOGP'], _cells(rows[2])['FO%']) == ('', '', '')
+
+
+def test_parse_feed_season(stand_in):
+    rows = feed.fetch_season_rows('OHL', ['68'], stand_in.url)['68']
+    player_seasons = chl_playerseason._parse_feed_season('OHL', '2019-20 Regular Season', rows)
+    connor, sam, alex = player_seasons
+    assert (connor.id, connor.name, connor.team, connor.num) == ('1', ' Connor Example', 'ER', 91)
+    assert (connor.gp, connor.goals, connor.assists, connor.points) == (62, 50, 70, 120)
+    assert (connor.sho_per, connor.fow_per, connor.p_g) == (40.0, 55.0, 1.94)
+    assert (sam.name, sam.team, sam.active, sam.rookie) == (' Sam Sample', 'London Knights', False, True)
+    assert (alex.num, alex.sho_gp, alex.fo_att, alex.fow_per) == (None, None, None, None)
+    assert {player_season.season_name for player_season in player_seasons} == {'2019-20 Regular Season'}
+
+
+def test_grab_feed_player_pages(stand_in):
+    # 3 was not recorded (a 404) and the response of 4 is cut short; both are left out, the others are kept
+    player_pages = chl_playerpage._grab_feed_player_pages('OHL', ['1', '2', '3', '4'], stand_in.url)
+    assert [player_page.id for player_page in player_pages] == ['1', '2']
+    connor, sam = player_pages
+
+    assert (connor.name, connor.num, connor.pos, connor.shoots) == ('Connor Example', '91', 'C', 'L')
+    assert connor.height == pytest.approx(chl_playerpage._ft_to_cm(6, 1))
+    assert connor.weight == pytest.approx(196 * 0.453592)
+    assert connor.birthdate == datetime.date(1997, 1, 13)
+    assert (connor.birthplace.city, connor.birthplace.state, connor.birthplace.country) == ('Richmond Hill', 'ON', None)
+    assert (connor.nhl_draft.year, connor.nhl_draft.team, connor.nhl_draft.round, connor.nhl_draft.overall) == \
+        ('2015', 'Edmonton Oilers', '1', '1')
+    assert (connor.chl_draft.year, connor.chl_draft.league, connor.chl_draft.team) == ('2012', 'OHL', 'Erie Otters')
+
+    assert (sam.num, sam.height, sam.weight, sam.birthdate) == ('4', None, None, None)
+    assert (sam.birthplace.city, sam.birthplace.state, sam.birthplace.country) == ('Stockholm', None, None)
+    assert sam.nhl_draft.year is None and sam.chl_draft.year is None
+    assert chl_playerpage._player_page_row(sam)[7] is None  # Birth date saved as NULL, not 'None'
+
+
+def test_unexpected_profile_values_keep_the_batch(stand_in, tmp_path, monkeypatch):
+    # 5 has a null first name, 'unknown' birth date and a three part birthplace; 6 has a null draft, which fails
+    monkeypatch.setattr(db, 'DB_DIR', str(tmp_path))
+    monkeypatch.setitem(feed.BACKENDS, 'OHL', 'feed')
+    chl_playerpage._create_player_pages_table('OHL')
+    chl_playerpage._crawl_league_pages('OHL', ['1', '2', '3', '4', '5', '6'], 0, stand_in.url)
+
+    conn = db.connect('OHL')
+    rows = conn.execute('SELECT id, name, birth_date, birth_city, birth_state, birth_country '
+                        'FROM chl_player_pages ORDER BY id').fetchall()
+    conn.close()
+    assert [row[0] for row in rows] == ['1', '2', '5']
+    assert rows[2][1:] == ('Nullname', None, 'Kitchener', 'ON', 'Canada')
@@ -0,0 +1,62 @@
+import os
+import time
+import sqlite3
+
+import pytest
+
+from common import throttle
+from common.db import MAIN_DB
+
+
+@pytest.fixture
+def metrics_db(tmp_path, monkeypatch):
+    """Main database under tmp_path, with no controller or queued metrics of earlier tests
+
+    :return: str, its path
+    """
+    monkeypatch.setattr(throttle, 'DB_DIR', str(tmp_path))
+    monkeypatch.setattr(throttle, '_controllers', {})
+    monkeypatch.setattr(throttle, '_unpersisted', {})
+    yield os.path.join(str(tmp_path), MAIN_DB)
+    throttle.flush_metrics()
+
+
+def _decide(controller, decisions=1):
+    for _ in range(decisions * throttle.DECISION_REQUESTS):
+        controller.record(0.1)
+
+
+def test_decisions_do_not_wait_on_a_locked_database(metrics_db):
+    controller = throttle.controller('http://example.com/feed')
+    _decide(controller)
+    throttle.flush_metrics()
+    locker = sqlite3.connect(metrics_db, isolation_level=None)
+    locker.execute('BEGIN EXCLUSIVE')
+
+    start_time = time.time()
+    _decide(controller, 3)
+    assert time.time() - start_time < 1.0
+    assert controller.window() == throttle.INITIAL_LIMIT + 4
+
+    locker.execute('ROLLBACK')
+    locker.close()
+    throttle.flush_metrics()
+    assert [row['concurrency_limit'] for row in throttle.persisted_metrics()] == [throttle.INITIAL_LIMIT + 4]
+
+
+def test_database_errors_never_fail_a_fetch(metrics_db, monkeypatch, capsys):
+    connect_metrics = throttle._connect_metrics
+
+    def broken(timeout=60):
+        raise sqlite3.OperationalError('disk I/O error')
+    monkeypatch.setattr(throttle, '_connect_metrics', broken)
+    controller = throttle.controller('example.com')
+    _decide(controller, 2)
+    throttle.flush_metrics()
+    assert 'Fetch metrics could not be saved' in capsys.readouterr().out
+
+    monkeypatch.setattr(throttle, '_connect_metrics', connect_metrics)  # Back up: the rows kept are written now
+    throttle.flush_metrics()
+    rows = throttle.persisted_metrics()
+    assert [(row['host'], row['concurrency_limit'], row['increases']) for row in rows] == \
+        [('example.com', throttle.INITIAL_LIMIT + 2, 2)]
@@ -0,0 +1,99 @@
+import pytest
+
+from common import db
+from chl import playerpage as chl_playerpage
+from chl import playerseason as chl_playerseason
+from nhl import playerpage as nhl_playerpage
+from nhl import playerseason as nhl_playerseason
+
+
+# The season tables as the first crawls created them, without typed columns or team ids
+OLD_NHL_SEASONS = '''CREATE TABLE player_seasons
+                     (
+                     id text, name text, year text, season_type text, team text,
+                     pos text, gp integer, goals integer, assists integer, points integer, plus_minus integer,
+                     pim integer, p_gp real, ppg integer, ppp integer, shg integer, shp integer, otg integer,
+                     s integer, s_per real, toi_gp text, shifts_gp real, fow_per real,
+                     PRIMARY KEY (id, year, season_type)
+                     )'''
+OLD_CHL_SEASONS = '''CREATE TABLE chl_player_seasons
+                     (
+                     league TEXT, id TEXT, num INTEGER, active BOOLEAN, rookie BOOLEAN, name TEXT, year TEXT,
+                     season_name TEXT, team TEXT,
+                     pos TEXT, gp INTEGER, goals INTEGER, assists INTEGER, points INTEGER, plus_minus INTEGER,
+                     pim INTEGER, ppg INTEGER, ppa INTEGER, shg INTEGER, sha INTEGER, s INTEGER, gwg INTEGER,
+                     otg INTEGER, first_g INTEGER, insurance_g INTEGER, sho_gp INTEGER, sho_g INTEGER, sho_att INTEGER,
+                     sho_wg INTEGER, sho_per REAL, fo_att INTEGER, fow INTEGER, fow_per REAL, p_g REAL, pim_g REAL,
+                     PRIMARY KEY (id, season_name)
+                     )'''
+
+
+class _StubDriver:
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'DB_DIR', str(tmp_path))
+
+
+def _old_table(league, sql, row):
+    conn = db.connect(league)
+    conn.execute(sql)
+    conn.execute('INSERT INTO ' + sql.split()[2] + ' VALUES (' + ', '.join('?' * len(row)) + ')', row)
+    conn.commit()
+    conn.close()
+
+
+def test_nhl_crawl_upgrades_an_old_season_table(shards, monkeypatch):
+    _old_table('NHL', OLD_NHL_SEASONS, ('8471215', 'Evgeni Malkin', '20152016', '2', 'PIT', 'C', 57, 27, 31, 58, 2,
+                                        52, 1.02, 7, 19, 0, 0, 1, 188, 14.4, '18:30', 22.1, 48.2))
+    monkeypatch.setattr(nhl_playerseason, 'acquire_driver', _StubDriver)
+    nhl_playerseason.save_player_seasons(2016, 2015)  # No seasons to grab: only the start-up
+
+    conn = db.connect('NHL')
+    assert db.table_is_current(conn.cursor(), 'player_seasons', nhl_playerseason._ensure_player_seasons_table)
+    assert conn.execute('SELECT id, toi_gp, team_id IS NOT NULL FROM player_seasons').fetchall() == \
+        [('8471215', 1110, 1)]
+    conn.close()
+
+
+def test_chl_page_crawl_upgrades_an_old_season_table(shards):
+    _old_table('OHL', OLD_CHL_SEASONS, ('OHL', '1', 91, 1, 0, ' Connor Example', '2014', '2014-15 Regular Season',
+                                        'ER', 'C', 47, 44, 76, 120, 47, 14, 14, 22, 2, 3, 223, 7, 0, 6, 4, None, None,
+                                        None, None, None, None, None, None, 2.55, 0.3))
+    assert chl_playerpage._missing_player_pages('OHL') == ['1']
+
+    conn = db.connect('OHL')
+    assert db.table_is_current(conn.cursor(), 'chl_player_seasons', chl_playerseason._ensure_player_seasons_table)
+    assert conn.execute('SELECT id, goals, team_id IS NOT NULL FROM chl_player_seasons').fetchall() == [('1', 44, 1)]
+    conn.close()
+
+
+def test_bulk_writes_refuse_an_old_table(shards):
+    _old_table('NHL', OLD_NHL_SEASONS, ('8471215', 'Evgeni Malkin', '20152016', '2', 'PIT', 'C', 57, 27, 31, 58, 2,
+                                        52, 1.02, 7, 19, 0, 0, 1, 188, 14.4, '18:30', 22.1, 48.2))
+    conn = db.connect('NHL')
+    with pytest.raises(RuntimeError, match='tools.upgradetables'):
+        db.check_table_is_current(conn.cursor(), 'player_seasons', nhl_playerseason._ensure_player_seasons_table)
+    nhl_playerseason._upgrade_player_seasons_table(conn)
+    db.check_table_is_current(conn.cursor(), 'player_seasons', nhl_playerseason._ensure_player_seasons_table)
+    conn.close()
+
+
+def test_unknown_nhl_birth_dates_are_null(shards):
+    conn = db.connect('NHL')
+    c = conn.cursor()
+    nhl_playerpage._ensure_player_pages_table(c)
+    c.execute("INSERT INTO player_pages (id, name, birth_date) VALUES ('1', 'Old Save', 'None')")
+    page = nhl_playerpage.PlayerPage('2', 'New Save', '7', 'D', None, None, None,
+                                     nhl_playerpage.Birthplace(None, None, None), None,
+                                     nhl_playerpage.Draft(None, None, None, None))
+    nhl_playerpage._save_player_pages(c, [page])
+    conn.commit()
+
+    nhl_playerpage._upgrade_player_pages_table(conn)
+    assert c.execute('SELECT id, birth_date FROM player_pages ORDER BY id').fetchall() == [('1', None), ('2', None)]
+    conn.close()
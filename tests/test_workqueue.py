@@ -0,0 +1,132 @@
+import time
+import sqlite3
+import multiprocessing
+
+import pytest
+
+from common import workqueue
+from common.workqueue import claim, complete, connect_queue, enqueue, fail, queue_status
+from tools import pagequeue
+
+
+FETCH_SECONDS = 0.005
+PROCESSES = 4
+
+
+class _StubDriver:
+
+    def close(self):
+        pass
+
+
+def _stub_fetch(log_path):
+    """Return a stand-in for pagequeue._fetch_player_page logging every fetch to <log_path> instead of scraping.
+    Player '13' always fails.
+    """
+    def fetch(league, player_id, driver):
+        time.sleep(FETCH_SECONDS)
+        conn = sqlite3.connect(log_path, timeout=60)
+        conn.execute('INSERT INTO fetches VALUES (?, ?, ?)', (player_id, league, workqueue.worker_name()))
+        conn.commit()
+        conn.close()
+        if player_id == '13':
+            raise ValueError('no page')
+    return fetch
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    """Queue and fetch log under tmp_path, with pagequeue workers fetching through _stub_fetch
+
+    :return: str, str (queue path, fetch log path)
+    """
+    queue_path, log_path = str(tmp_path / 'queue.db'), str(tmp_path / 'fetches.db')
+    conn = sqlite3.connect(log_path)
+    conn.execute('CREATE TABLE fetches (player_id TEXT, league TEXT, worker TEXT)')
+    conn.close()
+    monkeypatch.setattr(workqueue, 'QUEUE_PATH', queue_path)
+    monkeypatch.setattr(pagequeue, 'acquire_driver', _StubDriver)
+    monkeypatch.setattr(pagequeue, '_fetch_player_page', _stub_fetch(log_path))
+    return queue_path, log_path
+
+
+def _fetches(log_path):
+    conn = sqlite3.connect(log_path)
+    rows = conn.execute('SELECT player_id, league, worker FROM fetches').fetchall()
+    conn.close()
+    return rows
+
+
+def _run_workers(processes, lease_seconds=workqueue.LEASE_SECONDS):
+    # Forked, so the workers fetch through the stand-ins of the fixture
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=pagequeue.run_worker, args=(None, None, lease_seconds)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert [worker.exitcode for worker in workers] == [0] * processes
+
+
+def test_workers_fetch_every_item_once(queue):
+    queue_path, log_path = queue
+    items = [(str(player_id), league) for league in ['NHL', 'OHL'] for player_id in range(150)]
+    conn = connect_queue(queue_path)
+    assert enqueue(conn, items) == len(items)
+    assert enqueue(conn, items[:10]) == 0
+
+    _run_workers(PROCESSES)
+
+    fetches = _fetches(log_path)
+    ok_fetches = [(player_id, league) for player_id, league, _ in fetches if player_id != '13']
+    assert sorted(ok_fetches) == sorted(item for item in items if item[0] != '13')
+    # The failing items were retried until they ran out of attempts, by whichever worker claimed them
+    assert sorted((player_id, league) for player_id, league, _ in fetches if player_id == '13') == \
+        [('13', 'NHL')] * workqueue.MAX_ATTEMPTS + [('13', 'OHL')] * workqueue.MAX_ATTEMPTS
+    assert len({worker for _, _, worker in fetches}) > 1
+    assert queue_status(conn) == {('NHL', 'done'): 149, ('NHL', 'failed'): 1, ('OHL', 'done'): 149,
+                                  ('OHL', 'failed'): 1}
+    assert conn.execute("SELECT error FROM work_queue WHERE state = 'failed'").fetchall() == \
+        [("ValueError('no page')",)] * 2
+    conn.close()
+
+
+def test_expired_leases_are_reclaimed(queue):
+    queue_path, log_path = queue
+    conn = connect_queue(queue_path)
+    enqueue(conn, [('1', 'WHL'), ('2', 'WHL'), ('3', 'WHL')])
+    # A worker that died holding two items: its leases expire and the items are claimed again
+    assert claim(conn, 'dead:1', 2, lease_seconds=0.1) == [('1', 'WHL'), ('2', 'WHL')]
+    time.sleep(0.2)
+
+    _run_workers(2)
+
+    assert sorted(player_id for player_id, _, _ in _fetches(log_path)) == ['1', '2', '3']
+    assert queue_status(conn) == {('WHL', 'done'): 3}
+    # The dead worker's late results are refused
+    assert not complete(conn, 'dead:1', ('1', 'WHL'))
+    fail(conn, 'dead:1', ('2', 'WHL'), 'late')
+    assert queue_status(conn) == {('WHL', 'done'): 3}
+
+    # An item whose every lease expired (its page kills the worker) is failed rather than claimed forever
+    enqueue(conn, [('4', 'WHL')])
+    for attempt in range(workqueue.MAX_ATTEMPTS):
+        assert claim(conn, 'dead:' + str(attempt), 1, lease_seconds=0.01) == [('4', 'WHL')]
+        time.sleep(0.05)
+    assert claim(conn, 'alive:1', 1) == []
+    assert queue_status(conn) == {('WHL', 'done'): 3, ('WHL', 'failed'): 1}
+    assert conn.execute("SELECT error, worker, attempts FROM work_queue WHERE player_id = '4'").fetchall() == \
+        [('expired lease', None, workqueue.MAX_ATTEMPTS)]
+    conn.close()
+
+
+def test_claims_are_leased_to_one_worker(queue):
+    queue_path, _ = queue
+    conn = connect_queue(queue_path)
+    enqueue(conn, [(str(player_id), 'QMJHL') for player_id in range(5)])
+    first = claim(conn, 'a:1', 3, leagues=['QMJHL'])
+    second = claim(conn, 'b:1', 3, leagues=['QMJHL'])
+    assert len(first) == 3 and len(second) == 2 and not set(first) & set(second)
+    assert claim(conn, 'c:1', 3) == []
+    assert claim(conn, 'c:1', 3, leagues=['OHL']) == []
+    conn.close()
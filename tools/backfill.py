@@ -0,0 +1,215 @@
+import time
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+
+from common.archive import list_snapshots, load_snapshot
+from common.db import check_table_is_current, connect, connect_federated
+from common.profiling import mark_phase, profile_run
+from common.snapshot import parse_snapshot
+from chl import playerpage as chl_playerpage
+from chl import playerseason as chl_playerseason
+from nhl import playerpage as nhl_playerpage
+from nhl import playerseason as nhl_playerseason
+
+
+# kind of snapshot: (table, function returning a table row, indices of the primary key in a row, batched writer,
+# function creating the table in a shard)
+TARGETS = {
+    'nhl_season': (
+        'player_seasons', nhl_playerseason._player_season_row, (0, 2, 3),
+        nhl_playerseason._save_single_player_seasons, nhl_playerseason._ensure_player_seasons_table),
+    'chl_season': (
+        'chl_player_seasons', chl_playerseason._player_season_row, (1, 7), chl_playerseason._save_player_seasons,
+        chl_playerseason._ensure_player_seasons_table),
+    'nhl_player': (
+        'player_pages', nhl_playerpage._player_page_row, (0,), nhl_playerpage._save_player_pages,
+        nhl_playerpage._ensure_player_pages_table),
+    'chl_player': (
+        'chl_player_pages', chl_playerpage._player_page_row, (0, 1), chl_playerpage._save_player_pages,
+        chl_playerpage._ensure_player_pages_table),
+}
+
+
+def _parse_document(kind, meta, document):
+    """Run the current parser for pages of kind <kind> over an archived page and return the parsed objects
+
+    :param kind: 'nhl_season' | 'nhl_player' | 'chl_season' | 'chl_player'
+    :param meta: dict
+    :param document: SnapshotElement
+    :return: [PlayerSeason] | [PlayerPage]
+    """
+    if kind == 'nhl_season':
+        return nhl_playerseason._parse_single_page(meta['season_year'], meta['season_type'], document)
+    elif kind == 'chl_season':
+        return chl_playerseason._parse_season_page(meta['league'], meta['season_name'], document)
+    elif kind == 'nhl_player':
+        return [nhl_playerpage._parse_loaded_player_page(meta['id'], document)]
+    elif kind == 'chl_player':
+        return [chl_playerpage._parse_loaded_player_page(meta['league'], meta['id'], document)]
+    else:
+        assert False, '{} is not a recognized kind of snapshot'.format(kind)
+
+
+def _parse_chunk(paths):
+    """Work unit run in a worker process: parse every snapshot in <paths>
+
+    :param paths: [str]
+    :return: {str: [PlayerSeason | PlayerPage]}, [(str, str)] parsed objects by kind, and (path, error) failures
+    """
+    parsed = {}
+    failures = []
+    for path in paths:
+        try:
+            kind, meta, page_source = load_snapshot(path)
+            parsed.setdefault(kind, []).extend(_parse_document(kind, meta, parse_snapshot(page_source)))
+        except Exception as e:  # A parser failing on one page must not sink the whole chunk
+            failures.append((path, repr(e)))
+    return parsed, failures
+
+
+def _load_existing_rows(c, table, key_indices):
+    """Return every row of <table> keyed by its primary key, along with the table's column names
+
+    :param c: database cursor
+    :param table: str
+    :param key_indices: (int)
+    :return: {tuple: tuple}, [str]
+    """
+    c.execute('SELECT * FROM ' + table)
+    columns = [description[0] for description in c.description]
+    existing = {}
+    for row in c.fetchall():
+        existing[tuple(row[i] for i in key_indices)] = tuple(row)
+    return existing, columns
+
+
+def _diff_rows(table, key_indices, rows, existing, columns, seen, max_shown):
+    """Compare freshly parsed rows with the saved ones, print the differences, and return (added, changed) counts
+
+    :param table: str
+    :param key_indices: (int)
+    :param rows: [tuple]
+    :param existing: {tuple: tuple}
+    :param columns: [str]
+    :param seen: set of the primary keys parsed so far, updated in place
+    :param max_shown: int, differences printed per call at most
+    :return: int, int
+    """
+    added, changed = 0, 0
+    for row in rows:
+        key = tuple(row[i] for i in key_indices)
+        seen.add(key)
+        old_row = existing.get(key)
+        if old_row is None:
+            added += 1
+            if added + changed <= max_shown:
+                print("+ " + table + " " + str(key))
+        elif tuple(old_row[:len(row)]) != tuple(row):  # Saved rows also hold dimension ids
+            changed += 1
+            if added + changed <= max_shown:
+                for column, old_value, new_value in zip(columns, old_row, row):
+                    if old_value != new_value:
+                        print("~ " + table + " " + str(key) + " " + column + ": " +
+                              repr(old_value) + " -> " + repr(new_value))
+    return added, changed
+
+
+def _save_to_shards(shard_conns, kind, objects):
+    """Write parsed objects with the batched writer of their kind, each into the shard of its league
+
+    :param shard_conns: {str: sqlite3.Connection}, league: connection, updated in place
+    :param kind: str
+    :param objects: [PlayerSeason | PlayerPage]
+    :return: None
+    """
+    save_func, ensure_func = TARGETS[kind][3:]
+    by_league = {}
+    for item in objects:
+        league = 'NHL' if kind.startswith('nhl') else item.league
+        by_league.setdefault(league, []).append(item)
+    for league, league_objects in by_league.items():
+        if league not in shard_conns:
+            shard_conns[league] = connect(league)
+        c = shard_conns[league].cursor()
+        check_table_is_current(c, TARGETS[kind][0], ensure_func)
+        ensure_func(c)
+        save_func(c, league_objects, replace=True)
+
+
+def backfill(kinds=None, dry_run=False, workers=None, chunk_size=200, max_shown=20):
+    """Re-parse every archived page with the current parsers and rewrite the tables from the results.
+
+    Snapshots are parsed in chunks of <chunk_size> across a pool of <workers> processes, and the results of each
+    chunk are written with the batched writers into the shards of their leagues and committed as they come back.
+    With <dry_run>, nothing is written and the differences between the re-parsed rows and the saved ones are printed
+    instead.
+
+    :param kinds: [str] | None, kinds of snapshot to re-parse, all of them by default
+    :param dry_run: bool
+    :param workers: int | None, defaults to the number of cores
+    :param chunk_size: int
+    :param max_shown: int, differences printed per chunk at most in a dry run
+    :return: None
+    """
+    conn = connect_federated()
+    c = conn.cursor()
+    shard_conns = {}
+
+    start_time = time.time()
+    paths = list_snapshots(kinds)
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    print(str(len(paths)) + " snapshots in " + str(len(chunks)) + " chunks")
+
+    existing, columns, seen = {}, {}, {}
+    totals = {}  # kind: [parsed, added, changed]
+    failure_counter = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for parsed, failures in executor.map(_parse_chunk, chunks):
+            for path, error in failures:
+                print("Could not parse " + path + ": " + error)
+            failure_counter += len(failures)
+            for kind, objects in parsed.items():
+                table, row_func, key_indices = TARGETS[kind][:3]
+                counts = totals.setdefault(kind, [0, 0, 0])
+                counts[0] += len(objects)
+                if dry_run:
+                    if table not in existing:
+                        existing[table], columns[table] = _load_existing_rows(c, table, key_indices)
+                        seen[table] = set()
+                    rows = [row_func(item) for item in objects]
+                    added, changed = _diff_rows(
+                        table, key_indices, rows, existing[table], columns[table], seen[table], max_shown)
+                    counts[1] += added
+                    counts[2] += changed
+                else:
+                    _save_to_shards(shard_conns, kind, objects)
+            for shard_conn in shard_conns.values():
+                shard_conn.commit()
+            mark_phase(str(sum(counts[0] for counts in totals.values())) + ' objects parsed')
+
+    for kind, counts in sorted(totals.items()):
+        table = TARGETS[kind][0]
+        if dry_run:
+            not_in_archive = len(existing[table]) - len(seen[table] & set(existing[table]))
+            print(table + ": " + str(counts[0]) + " rows parsed, " + str(counts[1]) + " new, " + str(counts[2]) +
+                  " changed, " + str(not_in_archive) + " saved rows not in the archive")
+        else:
+            print(table + ": " + str(counts[0]) + " rows rewritten")
+    print(str(failure_counter) + " snapshots could not be parsed")
+    print("That took " + str(time.time() - start_time) + " seconds")
+    for shard_conn in shard_conns.values():
+        shard_conn.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-parse archived pages and rewrite the tables from them')
+    parser.add_argument('--kind', action='append', choices=sorted(TARGETS), help='only re-parse this kind of page')
+    parser.add_argument('--dry-run', action='store_true', help='print the differences instead of writing them')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=200)
+    parser.add_argument('--profile', action='store_true', help='profile the run, see common/profiling.py')
+    args = parser.parse_args()
+    with profile_run('backfill', args.profile):
+        backfill(args.kind, args.dry_run, args.workers, args.chunk_size)
@@ -0,0 +1,405 @@
+import os
+import csv
+import gzip
+import json
+import time
+import argparse
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from common.db import bump_generation, check_table_is_current, connect
+from common.dims import team_ids
+from common.history import record_history
+from common.leaderboards import rebuild_leaderboards
+from common.profiling import mark_phase, profile_run
+from common.search import index_player_names
+from chl import playerseason as chl_playerseason
+from nhl import playerseason as nhl_playerseason
+
+
+CHUNK_ROWS = 50000  # Rows converted and written per transaction
+MAX_SHOWN = 20  # Rows that could not be converted printed at most
+
+# Position of a column in the nhl.com stats table: names the column may have in a dump, from the site's export
+# button or its stats api
+NHL_COLUMNS = [
+    (1, ['Player', 'skaterFullName', 'name']),
+    (3, ['Team', 'teamAbbrevs', 'team']),
+    (4, ['Pos', 'positionCode', 'pos']),
+    (5, ['GP', 'gamesPlayed', 'gp']),
+    (6, ['G', 'goals']),
+    (7, ['A', 'assists']),
+    (8, ['P', 'points']),
+    (9, ['+/-', 'plusMinus', 'plus_minus']),
+    (10, ['PIM', 'penaltyMinutes', 'pim']),
+    (11, ['P/GP', 'pointsPerGame', 'p_gp']),
+    (12, ['PPG', 'ppGoals', 'ppg']),
+    (13, ['PPP', 'ppPoints', 'ppp']),
+    (14, ['SHG', 'shGoals', 'shg']),
+    (15, ['SHP', 'shPoints', 'shp']),
+    (16, ['GWG', 'gameWinningGoals', 'gwg']),
+    (17, ['OTG', 'otGoals', 'otg']),
+    (18, ['S', 'shots', 's']),
+    (19, ['S%', 'shootingPct', 's_per']),
+    (20, ['TOI/GP', 'timeOnIcePerGame', 'toi_gp']),
+    (21, ['Shifts/GP', 'shiftsPerGame', 'shifts_gp']),
+    (22, ['FOW%', 'faceoffWinPct', 'fow_per']),
+]
+NHL_ID_COLUMNS = ['playerId', 'player_id', 'id']
+NHL_YEAR_COLUMNS = ['seasonId', 'Season', 'year']
+NHL_TYPE_COLUMNS = ['gameTypeId', 'season_type']
+
+# Headers of the chl stats tables. Dumps use the same headers; columns the parser needs in every season are
+# filled in as empty when a dump does not have them.
+CHL_REQUIRED_HEADERS = [
+    'Pos', '#', 'Inactive', 'Rookie', 'Name', 'Team', 'GP', 'G', 'A', 'PTS', '+/-', 'PIM', 'PPG', 'PPA', 'SHG',
+    'SHA', 'SOG', 'GWG', 'OTG', 'First', 'Insurance', 'PTS/G', 'PIM/G'
+]
+CHL_OPTIONAL_HEADERS = ['SOGP', 'SO-G', 'ATT', 'SOWG', 'SO%', 'FOA', 'FOW', 'FO%']
+CHL_ID_COLUMNS = ['player_id', 'playerId', 'id']
+CHL_LEAGUE_COLUMNS = ['league']
+CHL_SEASON_COLUMNS = ['season_name', 'season']
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8-sig', newline='')
+    return open(path, 'r', encoding='utf-8-sig', newline='')
+
+
+def _read_json_array(f, read_size=1 << 20):
+    """Yield the elements of a json array one at a time, without reading the whole file
+
+    :param f: text file positioned before the opening bracket
+    :param read_size: int
+    :return: generator of dict
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(read_size).lstrip()
+    assert buffer.startswith('['), 'not a json array'
+    pos = 1
+    at_end = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except ValueError:  # Element cut off at the end of the buffer
+            assert not at_end, 'truncated json array'
+            more = f.read(read_size)
+            at_end = more == ''
+            buffer = buffer[pos:] + more
+            pos = 0
+            continue
+        yield element
+        pos = end
+
+
+def read_records(path):
+    """Return the column names of a csv, json array or json lines dump (optionally gzipped), and a generator
+    streaming its records as lists of values in the order of the column names
+
+    :param path: str
+    :return: [str], generator of list
+    """
+    name = path[:-3] if path.endswith('.gz') else path
+    f = _open(path)
+    if name.endswith('.csv'):
+        records = csv.reader(f)
+    elif name.endswith('.jsonl') or name.endswith('.ndjson'):
+        records = (json.loads(line) for line in f if line.strip() != '')
+    elif name.endswith('.json'):
+        records = _read_json_array(f)
+    else:
+        assert False, '{} is not a csv, json or jsonl file'.format(path)
+
+    first = next(records, None)
+    if first is None:
+        f.close()
+        return [], iter([])
+    if isinstance(first, dict):
+        keys = list(first)
+
+        def generate():
+            yield [first[key] for key in keys]
+            for record in records:
+                yield [record.get(key) for key in keys]
+            f.close()
+    else:  # csv: the first row is the header
+        keys = first
+
+        def generate():
+            for record in records:
+                yield record
+            f.close()
+    return keys, generate()
+
+
+def _find_column(keys, names):
+    """Return the position in <keys> of the first of <names> found in it, or None"""
+    for name in names:
+        if name in keys:
+            return keys.index(name)
+    return None
+
+
+def _text(value):
+    """Return a dump value as the text the page parsers would have read from the stats table"""
+    if value.__class__ is str:
+        return value.strip()
+    if value is None:
+        return ''
+    return str(value)
+
+
+def _nhl_converter(keys, season_year=None, season_type='2'):
+    """Return a function converting a record of an nhl dump with columns <keys> into a PlayerSeason
+
+    :param keys: [str]
+    :param season_year: str | None, for dumps without a season column, e.g. '20152016'
+    :param season_type: str, for dumps without a game type column
+    :return: function
+    """
+    columns = [(index, _find_column(keys, names)) for index, names in NHL_COLUMNS]
+    columns = [(index, key) for index, key in columns if key is not None]
+    id_key = _find_column(keys, NHL_ID_COLUMNS)
+    year_key = _find_column(keys, NHL_YEAR_COLUMNS)
+    type_key = _find_column(keys, NHL_TYPE_COLUMNS)
+    assert id_key is not None, 'nhl dumps need a player id column, one of {}'.format(NHL_ID_COLUMNS)
+    assert year_key is not None or season_year is not None, 'no season column, give the season year'
+
+    def convert(record):
+        texts = [''] * 23
+        for index, key in columns:
+            value = record[key]
+            texts[index] = value.strip() if value.__class__ is str else _text(value)
+        year = _text(record[year_key]) if year_key is not None else season_year
+        type_ = _text(record[type_key]) if type_key is not None else season_type
+        return nhl_playerseason._parse_player_texts(year, type_, _text(record[id_key]), texts)
+    return convert
+
+
+def _chl_converter(keys, league=None, season_name=None):
+    """Return a function converting a record of a chl dump with columns <keys> into a PlayerSeason
+
+    :param keys: [str]
+    :param league: str | None, for dumps without a league column
+    :param season_name: str | None, for dumps without a season column
+    :return: function
+    """
+    headers = CHL_REQUIRED_HEADERS + [header for header in CHL_OPTIONAL_HEADERS if header in keys]
+    columns = [keys.index(header) if header in keys else None for header in headers]
+    id_key = _find_column(keys, CHL_ID_COLUMNS)
+    league_key = _find_column(keys, CHL_LEAGUE_COLUMNS)
+    season_key = _find_column(keys, CHL_SEASON_COLUMNS)
+    assert id_key is not None, 'chl dumps need a player id column, one of {}'.format(CHL_ID_COLUMNS)
+    assert league_key is not None or league is not None, 'no league column, give the league'
+    assert season_key is not None or season_name is not None, 'no season column, give the season name'
+    season_years = {}
+
+    def convert(record):
+        texts = ['' if key is None else _text(record[key]) for key in columns]
+        row_league = _text(record[league_key]) if league_key is not None else league
+        row_season_name = _text(record[season_key]) if season_key is not None else season_name
+        if row_season_name not in season_years:
+            season_years[row_season_name] = chl_playerseason._parse_season_yr(row_season_name)
+        return chl_playerseason._parse_player_texts(
+            row_league, season_years[row_season_name], row_season_name, _text(record[id_key]), texts, headers)
+    return convert
+
+
+class _ShardLoader:
+    """Writes converted rows into the season table of one shard with bulk-load settings, and rebuilds the table's
+    secondary indexes and the name index once everything is in"""
+
+    def __init__(self, league, table, ensure_func, replace, team_index):
+        self.league = league
+        self.table = table
+        self.team_index = team_index  # Of the team name in the rows, which get its id appended
+        self.conn = connect(league)
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('PRAGMA cache_size=-262144')  # 256 MiB
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+        c = self.conn.cursor()
+        check_table_is_current(c, table, ensure_func)
+        ensure_func(c)
+        # Secondary indexes are dropped during the load and built again in one pass at the end
+        c.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table,))
+        self.indexes = c.fetchall()
+        for name, _ in self.indexes:
+            c.execute('DROP INDEX ' + name)
+        self.conn.commit()
+        self.verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        self.names = {}  # (id, league): name
+        self.row_counter = 0
+
+    def write(self, rows, names):
+        teams = team_ids(self.conn.cursor(), self.league, set((self.league, row[self.team_index]) for row in rows))
+        rows = [row + (teams.get((self.league, row[self.team_index])),) for row in rows]
+        # Versions of the rows as loaded, so the deltas of later crawls have a base
+        record_history(self.conn.cursor(), self.table, rows, ignore_saved=self.verb == 'INSERT OR IGNORE')
+        self.conn.executemany(
+            self.verb + ' INTO ' + self.table + ' VALUES (' + ', '.join('?' * len(rows[0])) + ')', rows)
+        self.conn.commit()
+        self.names.update(names)
+        self.row_counter += len(rows)
+
+    def finish(self):
+        c = self.conn.cursor()
+        for _, sql in self.indexes:
+            c.execute(sql)
+        bump_generation(c, self.table)
+        rebuild_leaderboards(c, self.table)
+        index_player_names(c, [key + (name,) for key, name in self.names.items()])
+        self.conn.commit()
+        self.conn.close()
+
+
+def _make_converter(site, keys, options):
+    if site == 'nhl':
+        return _nhl_converter(keys, options['season_year'], options['season_type'])
+    return _chl_converter(keys, options['league'], options['season_name'])
+
+
+def _convert_chunk(site, keys, options, first_record, records):
+    """Work unit, run in a worker process when there are several: convert a chunk of records into table rows
+
+    :param site: 'nhl' | 'chl'
+    :param keys: [str]
+    :param options: dict, the values for columns missing from the dump
+    :param first_record: int, number of the first record of the chunk in the dump
+    :param records: [list]
+    :return: {str: [tuple]}, {str: {(str, str): str}}, [(int, str)]
+        rows and names ((id, league): name) by league, and (record number, error) failures
+    """
+    convert = _make_converter(site, keys, options)
+    rows_by_league = {}
+    names_by_league = {}
+    failures = []
+    for record_counter, record in enumerate(records, first_record):
+        try:
+            player_season = convert(record)
+        except Exception as e:  # One malformed record must not sink the load
+            failures.append((record_counter, repr(e)))
+            continue
+        if site == 'nhl':
+            row_league = 'NHL'
+            row = nhl_playerseason._player_season_row(player_season)
+        else:
+            row_league = player_season.league
+            row = chl_playerseason._player_season_row(player_season)
+        rows_by_league.setdefault(row_league, []).append(row)
+        names_by_league.setdefault(row_league, {})[(player_season.id, row_league)] = player_season.name
+    return rows_by_league, names_by_league, failures
+
+
+def _chunks(records, chunk_rows):
+    chunk = []
+    first_record = 0
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_rows:
+            yield first_record, chunk
+            first_record += len(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        yield first_record, chunk
+
+
+def bulk_load(path, site, league=None, season_name=None, season_year=None, season_type='2', replace=True,
+              chunk_rows=CHUNK_ROWS, workers=None):
+    """Load a dump of season stats into player_seasons (site 'nhl') or chl_player_seasons (site 'chl').
+
+    The dump is streamed <chunk_rows> records at a time. Every record goes through the same conversions as a row of
+    the stats table scraped from the site, and is written into the shard of its league. Chunks are converted across
+    a pool of <workers> processes while the main process writes, with at most two chunks per worker in flight so
+    memory stays bounded. Rows that can not be converted are skipped and reported.
+
+    :param path: str, .csv, .json (an array of objects) or .jsonl, optionally .gz
+    :param site: 'nhl' | 'chl'
+    :param league: str | None, chl only, for dumps without a league column
+    :param season_name: str | None, chl only, for dumps without a season column
+    :param season_year: str | None, nhl only, for dumps without a season column
+    :param season_type: str, nhl only, for dumps without a game type column
+    :param replace: bool, whether rows of seasons already saved are replaced or kept
+    :param chunk_rows: int
+    :param workers: int | None, defaults to the number of cores; with 1, chunks are converted in this process
+    :return: int, number of rows loaded
+    """
+    start_time = time.time()
+    keys, records = read_records(path)
+    options = {'league': league, 'season_name': season_name, 'season_year': season_year, 'season_type': season_type}
+    _make_converter(site, keys, options)  # Fail early on a dump missing required columns
+    if workers is None:
+        workers = os.cpu_count() or 1
+    loaders = {}
+    failure_counter = 0
+
+    def write(converted):
+        nonlocal failure_counter
+        rows_by_league, names_by_league, failures = converted
+        for record_counter, error in failures:
+            failure_counter += 1
+            if failure_counter <= MAX_SHOWN:
+                print("Could not convert record " + str(record_counter) + ": " + error)
+        for row_league, rows in rows_by_league.items():
+            if row_league not in loaders:
+                if site == 'nhl':
+                    loaders[row_league] = _ShardLoader(
+                        row_league, 'player_seasons', nhl_playerseason._ensure_player_seasons_table, replace, 4)
+                else:
+                    loaders[row_league] = _ShardLoader(
+                        row_league, 'chl_player_seasons', chl_playerseason._ensure_player_seasons_table, replace, 8)
+            loaders[row_league].write(rows, names_by_league[row_league])
+        mark_phase(str(sum(loader.row_counter for loader in loaders.values())) + ' rows')
+
+    if workers == 1:
+        for first_record, chunk in _chunks(records, chunk_rows):
+            write(_convert_chunk(site, keys, options, first_record, chunk))
+    else:
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for first_record, chunk in _chunks(records, chunk_rows):
+                pending.append(executor.submit(_convert_chunk, site, keys, options, first_record, chunk))
+                if len(pending) >= 2 * workers:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+
+    row_counter = 0
+    for row_league, loader in sorted(loaders.items()):
+        loader.finish()
+        row_counter += loader.row_counter
+        print(str(loader.row_counter) + " rows loaded into the " + row_league + " shard")
+    print(str(failure_counter) + " records could not be converted")
+    print("That took " + str(time.time() - start_time) + " seconds")
+    return row_counter
+
+
+if __name__ == '__main__':
+    from analytics.comparables import update_comparables_index
+
+    parser = argparse.ArgumentParser(description='Load a csv/json dump of season stats into the season tables')
+    parser.add_argument('site', choices=['nhl', 'chl'])
+    parser.add_argument('path', nargs='+')
+    parser.add_argument('--league', help='chl league, for dumps without a league column')
+    parser.add_argument('--season-name', help="chl season, e.g. '2015-16 Regular Season', for dumps without one")
+    parser.add_argument('--season-year', help="nhl season, e.g. '20152016', for dumps without one")
+    parser.add_argument('--season-type', default='2', help="nhl '2' (regular season) or '3' (playoffs)")
+    parser.add_argument('--keep', action='store_true', help='keep rows already saved instead of replacing them')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--profile', action='store_true', help='profile the run, see common/profiling.py')
+    args = parser.parse_args()
+
+    with profile_run('bulkload', args.profile) as profiler:
+        for dump_path in args.path:
+            bulk_load(dump_path, args.site, args.league, args.season_name, args.season_year, args.season_type,
+                      not args.keep, args.chunk_rows, args.workers)
+            profiler.phase(dump_path)
+        update_comparables_index()
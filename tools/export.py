@@ -0,0 +1,198 @@
+import io
+import os
+import csv
+import gzip
+import json
+import lzma
+import time
+import hashlib
+import argparse
+import datetime
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from common.db import DB_DIR, connect_federated, get_generation
+from common.profiling import mark_phase, profile_run
+
+
+EXPORT_TABLES = ['player_seasons', 'chl_player_seasons', 'player_pages', 'chl_player_pages']
+EXPORT_DIR = os.path.join(DB_DIR, 'exports')
+CHUNK_ROWS = 20000  # Rows read, encoded and compressed at once
+SHARD_ROWS = 500000
+EXTENSIONS = {'gz': '.gz', 'xz': '.xz', 'none': ''}
+
+
+def _encode_chunk(fmt, compression, columns, rows, header):
+    """Work unit, run in a worker process when there are several: encode rows as JSONL or CSV and compress them.
+
+    Compressed chunks are complete gzip members / xz streams, so the chunks of a shard written one after another
+    make a valid file.
+
+    :param fmt: 'jsonl' | 'csv'
+    :param compression: 'gz' | 'xz' | 'none'
+    :param columns: [str]
+    :param rows: [tuple]
+    :param header: bool, whether to start with the CSV header (the first chunk of a shard)
+    :return: bytes
+    """
+    if fmt == 'jsonl':
+        text = ''.join(json.dumps(dict(zip(columns, row)), separators=(',', ':')) + '\n' for row in rows)
+    else:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        if header:
+            writer.writerow(columns)
+        writer.writerows(rows)
+        text = buffer.getvalue()
+    data = text.encode('utf-8')
+    if compression == 'gz':
+        return gzip.compress(data, compresslevel=6)
+    if compression == 'xz':
+        return lzma.compress(data, preset=6)
+    return data
+
+
+class _ShardWriter:
+    """Writes compressed chunks into numbered shard files of at most <shard_rows> rows, and keeps their row counts
+    and checksums for the manifest"""
+
+    def __init__(self, out_dir, table, fmt, compression, shard_rows):
+        self.out_dir = out_dir
+        self.base_name = table + '-{0:05d}.' + fmt + EXTENSIONS[compression]
+        self.shard_rows = shard_rows
+        self.shards = []  # Manifest entries of the shards written so far
+        self._file = None
+        self._checksum = None
+
+    def needs_new_shard(self):
+        return self._file is None or self.shards[-1]['rows'] >= self.shard_rows
+
+    def write(self, data, num_rows):
+        if self.needs_new_shard():
+            self._close_shard()
+            file_name = self.base_name.format(len(self.shards))
+            self._file = open(os.path.join(self.out_dir, file_name), 'wb')
+            self._checksum = hashlib.sha256()
+            self.shards.append({'file': file_name, 'rows': 0, 'bytes': 0, 'sha256': None})
+        self._file.write(data)
+        self._checksum.update(data)
+        self.shards[-1]['rows'] += num_rows
+        self.shards[-1]['bytes'] += len(data)
+
+    def _close_shard(self):
+        if self._file is not None:
+            self._file.close()
+            self.shards[-1]['sha256'] = self._checksum.hexdigest()
+            self._file = None
+
+    def close(self):
+        self._close_shard()
+
+
+def export_table(table, fmt='jsonl', compression='gz', shard_rows=SHARD_ROWS, out_dir=None, chunk_rows=CHUNK_ROWS,
+                 workers=None):
+    """Export a season or page table, over every shard, to compressed JSONL or CSV shard files plus a manifest.
+
+    Rows are streamed from the cursor <chunk_rows> at a time and chunks are encoded and compressed across a pool of
+    <workers> processes, with at most two chunks per worker in flight: reading waits on compression, so memory stays
+    flat however large the table is.
+
+    :param table: str, one of EXPORT_TABLES
+    :param fmt: 'jsonl' | 'csv'
+    :param compression: 'gz' | 'xz' | 'none'
+    :param shard_rows: int, rows per shard file (rounded up to whole chunks)
+    :param out_dir: str | None, defaults to EXPORT_DIR/<table>
+    :param chunk_rows: int
+    :param workers: int | None, defaults to the number of cores; with 1, chunks are compressed in this process
+    :return: dict, the manifest
+    """
+    assert table in EXPORT_TABLES, '{} can not be exported'.format(table)
+    start_time = time.time()
+    out_dir = out_dir or os.path.join(EXPORT_DIR, table)
+    os.makedirs(out_dir, exist_ok=True)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunk_rows = min(chunk_rows, shard_rows)
+
+    conn = connect_federated(read_only=True)
+    c = conn.cursor()
+    generation = get_generation(c, [table])
+    c.execute('SELECT * FROM ' + table)
+    columns = [description[0] for description in c.description]
+    writer = _ShardWriter(out_dir, table, fmt, compression, shard_rows)
+    row_counter = 0
+
+    def chunks():
+        while True:
+            rows = c.fetchmany(chunk_rows)
+            if len(rows) == 0:
+                return
+            yield rows
+
+    def write(data, num_rows):
+        nonlocal row_counter
+        writer.write(data, num_rows)
+        row_counter += num_rows
+        mark_phase(str(row_counter) + ' rows')
+
+    # Whether a chunk starts a shard is known when it is read: every chunk but the last is full, and the writer starts
+    # a shard once the last one reached shard_rows, so shards are shard_rows rounded up to whole chunks
+    chunks_per_shard = -(-shard_rows // chunk_rows)
+    chunk_counter = 0
+    if workers == 1:
+        for rows in chunks():
+            header = fmt == 'csv' and chunk_counter % chunks_per_shard == 0
+            write(_encode_chunk(fmt, compression, columns, rows, header), len(rows))
+            chunk_counter += 1
+    else:
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for rows in chunks():
+                header = fmt == 'csv' and chunk_counter % chunks_per_shard == 0
+                pending.append((executor.submit(_encode_chunk, fmt, compression, columns, rows, header), len(rows)))
+                chunk_counter += 1
+                if len(pending) >= 2 * workers:
+                    future, num_rows = pending.popleft()
+                    write(future.result(), num_rows)
+            while pending:
+                future, num_rows = pending.popleft()
+                write(future.result(), num_rows)
+    writer.close()
+    conn.close()
+
+    manifest = {
+        'table': table,
+        'format': fmt,
+        'compression': compression,
+        'columns': columns,
+        'rows': row_counter,
+        'shards': writer.shards,
+        'generation': list(generation),  # Of the table when the export started
+        'created': datetime.datetime.now().isoformat(' ', 'seconds'),
+    }
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(str(row_counter) + " rows of " + table + " exported in " + str(len(writer.shards)) + " shards to " + out_dir)
+    print("That took " + str(time.time() - start_time) + " seconds")
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export season and page tables to compressed JSONL/CSV shards')
+    parser.add_argument('table', nargs='+', choices=EXPORT_TABLES)
+    parser.add_argument('--format', default='jsonl', choices=['jsonl', 'csv'])
+    parser.add_argument('--compression', default='gz', choices=sorted(EXTENSIONS))
+    parser.add_argument('--shard-rows', type=int, default=SHARD_ROWS)
+    parser.add_argument('--out-dir', default=None, help='defaults to exports/<table>')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--profile', action='store_true', help='profile the run, see common/profiling.py')
+    args = parser.parse_args()
+
+    with profile_run('export', args.profile) as profiler:
+        for export_table_name in args.table:
+            out_dir = os.path.join(args.out_dir, export_table_name) if args.out_dir else None
+            export_table(export_table_name, args.format, args.compression, args.shard_rows, out_dir,
+                         args.chunk_rows, args.workers)
+            profiler.phase(export_table_name)
@@ -0,0 +1,152 @@
+import sqlite3
+import time
+import argparse
+
+from multiprocessing import Process
+
+from common.browser import acquire_driver
+from common.db import CHL_LEAGUES, check_table_is_current, connect, connect_federated
+from common import throttle
+from common.profiling import profile_run
+from common.workqueue import (
+    LEASE_SECONDS, Heartbeat, claim, complete, connect_queue, enqueue, fail, queue_status, worker_name
+)
+from chl import feed as chl_feed
+from chl import playerpage as chl_playerpage
+from nhl import playerpage as nhl_playerpage
+
+
+def enqueue_player_pages():
+    """Queue every player with a saved season whose page has not been saved yet
+
+    :return: None
+    """
+    conn = connect_federated()
+    c = conn.cursor()
+    items = []
+    queries = [
+        ("SELECT DISTINCT id, 'NHL' FROM player_seasons WHERE id NOT IN (SELECT id FROM player_pages)",
+         "SELECT DISTINCT id, 'NHL' FROM player_seasons"),
+        ('SELECT DISTINCT id, league FROM chl_player_seasons '
+         'WHERE (id, league) NOT IN (SELECT id, league FROM chl_player_pages)',
+         'SELECT DISTINCT id, league FROM chl_player_seasons'),
+    ]
+    for sql, sql_without_pages in queries:
+        try:
+            c.execute(sql)
+        except sqlite3.OperationalError:  # No pages saved yet
+            c.execute(sql_without_pages)
+        items += c.fetchall()
+    conn.close()
+
+    queue_conn = connect_queue()
+    added = enqueue(queue_conn, items)
+    queue_conn.close()
+    print(str(added) + " player pages queued, " + str(len(items) - added) + " already in the queue")
+
+
+def _fetch_player_page(league, player_id, driver):
+    """Scrape the page of a player and save it in the shard of its league
+
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :param player_id: str
+    :param driver: WebDriver
+    :return: None
+    """
+    if league == 'NHL':
+        player_page = nhl_playerpage._parse_player_page(player_id, driver)
+        module = nhl_playerpage
+    elif chl_feed.backend(league) == 'feed':
+        throttle.controller(chl_feed.FEED_URL).pause()  # One request at a time: paced like a browser
+        player_page = chl_playerpage._grab_feed_player_pages(league, [player_id])[0]
+        module = chl_playerpage
+    else:
+        player_page = chl_playerpage._parse_player_page(
+            league, chl_playerpage.LEAGUE_URLS[league], player_id, driver)
+        module = chl_playerpage
+    conn = connect(league)
+    c = conn.cursor()
+    table = 'player_pages' if league == 'NHL' else 'chl_player_pages'
+    check_table_is_current(c, table, module._ensure_player_pages_table)
+    module._ensure_player_pages_table(c)
+    module._save_player_pages(c, [player_page], replace=True)
+    conn.commit()
+    conn.close()
+
+
+def run_worker(leagues=None, cap=None, lease_seconds=LEASE_SECONDS):
+    """Claim queued player pages one at a time and scrape them until the queue is empty or <cap> pages are done.
+
+    Leases are extended while a page is being scraped; a worker that dies leaves its item to be reclaimed by another
+    once the lease expires.
+
+    :param leagues: [str] | None, only scrape players of these leagues
+    :param cap: int | None
+    :param lease_seconds: float
+    :return: int, number of pages saved
+    """
+    worker = worker_name()
+    queue_conn = connect_queue()
+    driver = acquire_driver()
+    start_time = time.time()
+    page_counter = 0
+
+    while cap is None or page_counter < cap:
+        items = claim(queue_conn, worker, 1, leagues, lease_seconds)
+        if len(items) == 0:
+            break
+        player_id, league = items[0]
+        print('{0:.<40}'.format(worker + ' ' + league + ' ' + player_id), end='')
+        try:
+            with Heartbeat(worker, items, lease_seconds) as beat:
+                _fetch_player_page(league, player_id, driver)
+        except Exception as e:  # Give the item back rather than losing the worker
+            fail(queue_conn, worker, items[0], repr(e))
+            print(" failed: " + repr(e))
+            continue
+        if complete(queue_conn, worker, items[0]) and not beat.lost:
+            print(" done")
+        else:
+            print(" done, but the lease had expired")
+        page_counter += 1
+
+    driver.close()
+    queue_conn.close()
+    total_time = time.time() - start_time
+    print(worker + ": " + str(page_counter) + " pages saved. That took " + str(total_time) + " seconds")
+    return page_counter
+
+
+def print_status():
+    queue_conn = connect_queue()
+    for (league, state), count in sorted(queue_status(queue_conn).items()):
+        print('{0:<8}{1:<10}{2}'.format(league, state, count))
+    queue_conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crawl player pages from a work queue shared by many workers')
+    parser.add_argument('command', choices=['enqueue', 'work', 'status'])
+    parser.add_argument('--league', action='append', choices=['NHL'] + CHL_LEAGUES,
+                        help='only work on players of this league')
+    parser.add_argument('--processes', type=int, default=1, help='number of local worker processes')
+    parser.add_argument('--cap', type=int, default=None, help='pages saved per worker at most')
+    parser.add_argument('--lease', type=float, default=LEASE_SECONDS, help='seconds a claimed page is held for')
+    parser.add_argument('--profile', action='store_true', help='profile the run, see common/profiling.py')
+    args = parser.parse_args()
+
+    with profile_run('pagequeue_' + args.command, args.profile):
+        if args.command == 'enqueue':
+            enqueue_player_pages()
+        elif args.command == 'status':
+            print_status()
+        elif args.processes == 1:
+            run_worker(args.league, args.cap, args.lease)
+        else:
+            workers = [
+                Process(target=run_worker, args=(args.league, args.cap, args.lease)) for _ in range(args.processes)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
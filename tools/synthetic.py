@@ -0,0 +1,458 @@
+import os
+import json
+import math
+import time
+import random
+import argparse
+import datetime
+import threading
+
+from common.db import DB_DIR, SHARDS, connect, shard_path
+from common.profiling import mark_phase, profile_run
+from chl import playerpage as chl_playerpage
+from chl import playerseason as chl_playerseason
+from nhl import playerpage as nhl_playerpage
+from nhl import playerseason as nhl_playerseason
+
+
+# league: first season, last season, debut ages, last age, players per team, [(from season, teams)],
+# [(from season, games)]. Scale 1 gives about as many rows as the real tables (about 65k NHL player seasons).
+LEAGUES = {
+    'NHL': (1917, 2023, (19, 23), 40, 26,
+            [(1917, 4), (1926, 10), (1942, 6), (1967, 12), (1970, 14), (1972, 16), (1974, 18), (1979, 21), (1991, 22),
+             (1992, 24), (1993, 26), (1998, 27), (1999, 28), (2000, 30), (2017, 31), (2021, 32)],
+            [(1917, 24), (1931, 48), (1946, 60), (1949, 70), (1967, 76), (1974, 80), (1992, 82)]),
+    'OHL': (1975, 2023, (16, 17), 20, 25, [(1975, 12), (1990, 16), (1998, 20)], [(1975, 68)]),
+    'WHL': (1975, 2023, (16, 17), 20, 25, [(1975, 12), (1990, 14), (2000, 19), (2008, 22)], [(1975, 72)]),
+    'QMJHL': (1975, 2023, (16, 17), 20, 25, [(1975, 10), (1990, 13), (2000, 16), (2005, 18)], [(1975, 68)]),
+}
+SORTED_LEAGUES = sorted(LEAGUES)
+FIRST_NAMES = [
+    'Adam', 'Alex', 'Anton', 'Ben', 'Brad', 'Brent', 'Bryan', 'Carl', 'Chris', 'Cody', 'Connor', 'Dale', 'Dan',
+    'Darren', 'Dave', 'Derek', 'Dylan', 'Eric', 'Erik', 'Evan', 'Filip', 'Gord', 'Greg', 'Jake', 'Jamie', 'Jan',
+    'Jason', 'Jeff', 'Joel', 'John', 'Jonas', 'Josh', 'Kevin', 'Kyle', 'Lars', 'Luc', 'Marc', 'Mark', 'Matt', 'Mike',
+    'Mikko', 'Nick', 'Olli', 'Patrik', 'Paul', 'Pierre', 'Ryan', 'Sam', 'Scott', 'Sean', 'Sergei', 'Steve', 'Teemu',
+    'Tim', 'Tom', 'Travis', 'Tyler', 'Viktor', 'Wayne', 'Zach',
+]
+SURNAME_STARTS = [
+    'Ander', 'Bar', 'Ben', 'Berg', 'Black', 'Bou', 'Brod', 'Camp', 'Car', 'Dal', 'Del', 'Don', 'Dub', 'Fer', 'Gal',
+    'Gau', 'Hall', 'Han', 'Her', 'Hol', 'Jo', 'Kar', 'Kel', 'Kor', 'Lar', 'Lem', 'Mac', 'Mar', 'Mc', 'Mor', 'Nie',
+    'Nor', 'Pet', 'Ro', 'Sav', 'Ste', 'Sul', 'Tor', 'Wal', 'Wil',
+]
+SURNAME_ENDS = [
+    'ard', 'bach', 'berg', 'by', 'chuk', 'den', 'dre', 'el', 'er', 'ford', 'gren', 'ier', 'in', 'kin', 'ko', 'lund',
+    'man', 'ney', 'nen', 'ov', 'quist', 'rand', 'rin', 'ris', 'sen', 'ski', 'son', 'strom', 'ton', 'way',
+]
+BIRTHPLACES = [  # (city, state, country), weight
+    (('Toronto', 'ON', 'CAN'), 12), (('Montreal', 'QC', 'CAN'), 8), (('Edmonton', 'AB', 'CAN'), 6),
+    (('Winnipeg', 'MB', 'CAN'), 5), (('Regina', 'SK', 'CAN'), 4), (('Halifax', 'NS', 'CAN'), 2),
+    (('Vancouver', 'BC', 'CAN'), 5), (('Boston', 'MA', 'USA'), 4), (('Minneapolis', 'MN', 'USA'), 5),
+    (('Detroit', 'MI', 'USA'), 3), (('Buffalo', 'NY', 'USA'), 2), (('Stockholm', None, 'SWE'), 4),
+    (('Helsinki', None, 'FIN'), 3), (('Moscow', None, 'RUS'), 4), (('Prague', None, 'CZE'), 3),
+    (('Bratislava', None, 'SVK'), 1), (('Zurich', None, 'CHE'), 1), (('Riga', None, 'LVA'), 1),
+]
+POSITIONS = [('C', 25), ('LW', 20), ('RW', 20), ('D', 35)]
+ID_BASE = 10 ** 8  # Synthetic ids start here, far from real ones, and every universe has its own block of ids
+UNIVERSE_IDS = 10 ** 6
+
+
+def _era_value(eras, year):
+    """Return the value of the latest era starting at or before <year>"""
+    value = eras[0][1]
+    for first_year, era_value in eras:
+        if first_year <= year:
+            value = era_value
+    return value
+
+
+def _poisson(rng, lam):
+    if lam <= 0:
+        return 0
+    if lam > 30:  # Normal approximation
+        return max(0, int(round(rng.gauss(lam, math.sqrt(lam)))))
+    limit, k, product = math.exp(-lam), 0, rng.random()
+    while product > limit:
+        k += 1
+        product *= rng.random()
+    return k
+
+
+def _binomial(rng, n, p):
+    return sum(1 for _ in range(n) if rng.random() < p)
+
+
+def _weighted(rng, choices):
+    return rng.choices([choice for choice, _ in choices], [weight for _, weight in choices])[0]
+
+
+def _league_teams(league, seed, universe):
+    """Return the team codes of a league in a universe, most senior first; those of every universe are told apart"""
+    rng = random.Random('{}-{}-{}-teams'.format(seed, league, universe))
+    num_teams = max(teams for _, teams in LEAGUES[league][5])
+    codes = []
+    while len(codes) < num_teams:
+        code = ''.join(rng.choice('ABCDEFGHIJKLMNOPRSTVW') for _ in range(3)) + ('' if universe == 0 else str(universe))
+        if code not in codes:
+            codes.append(code)
+    return codes
+
+
+class _Player:
+    """A synthetic player: drawn once, name, build and talent, then moved from season to season"""
+
+    def __init__(self, rng, id_, birth_year, league):
+        self.id = id_
+        self.first_name = rng.choice(FIRST_NAMES)
+        self.last_name = rng.choice(SURNAME_STARTS) + rng.choice(SURNAME_ENDS)
+        self.birth_date = datetime.date(birth_year, rng.randint(1, 12), rng.randint(1, 28))
+        self.pos = _weighted(rng, POSITIONS)
+        self.talent = rng.betavariate(2, 5)
+        self.shoots = 'L' if rng.random() < 0.62 else 'R'
+        self.height = round(rng.gauss(185 if self.pos != 'D' else 188, 5.5), 2)
+        self.weight = round(rng.gauss(88 if self.pos != 'D' else 92, 7), 2)
+        self.birthplace = _weighted(rng, BIRTHPLACES)
+        self.num = rng.randint(2, 98)
+        self.shooting = rng.uniform(0.06, 0.16)
+        self.pim_rate = rng.expovariate(1 / 0.5)
+        self.league = league
+        self.team = None
+        self.seasons_played = 0
+
+    @property
+    def name(self):
+        return self.first_name + ' ' + self.last_name
+
+
+class _Universe:
+    """The synthetic history of one league: rosters season after season, players debuting, moving and leaving.
+
+    Every universe is drawn from its own random generator, seeded by the seed and the universe number, so a dataset
+    of any scale is the same whatever it was generated alongside.
+    """
+
+    def __init__(self, league, seed, universe, fraction=1.0):
+        self.league = league
+        self.universe = universe
+        self.rng = random.Random('{}-{}-{}'.format(seed, league, universe))
+        self.first_year, self.last_year, self.debut_ages, self.last_age, self.roster_size, self.team_eras, \
+            self.game_eras = LEAGUES[league]
+        self.fraction = fraction
+        self.teams = _league_teams(league, seed, universe)
+        self.nhl_teams = _league_teams('NHL', seed, universe)  # Who drafts the players into the NHL
+        self.next_id = ID_BASE + universe * UNIVERSE_IDS + SORTED_LEAGUES.index(league) * UNIVERSE_IDS // 4
+
+    def seasons(self):
+        """Yield (year, teams, roster, debuts) for every season of the league: the teams playing, every player of
+        the season and those of them playing their first"""
+        roster = []
+        for year in range(self.first_year, self.last_year + 1):
+            num_teams = max(1, int(round(_era_value(self.team_eras, year) * self.fraction)))
+            teams = self.teams[:num_teams]
+            roster = [player for player in roster if not self._leaves(player, year)]
+            for player in roster:
+                if player.team not in teams or self.rng.random() < 0.08:  # Traded, or the team folded
+                    player.team = self.rng.choice(teams)
+            counts = dict((team, 0) for team in teams)
+            for player in roster:
+                counts[player.team] += 1
+            debuts = []
+            for team in teams:
+                for _ in range(max(0, self.roster_size - counts[team])):
+                    player = _Player(
+                        self.rng, str(self.next_id), year - self.rng.randint(*self.debut_ages), self.league)
+                    player.team = team
+                    self.next_id += 1
+                    debuts.append(player)
+            roster += debuts
+            yield year, teams, roster, debuts
+            for player in roster:
+                player.seasons_played += 1
+
+    def _leaves(self, player, year):
+        age = year - player.birth_date.year
+        if age > self.last_age:
+            return True
+        leave_probability = 0.08 + 0.2 * (1 - player.talent) + max(0, age - 32) * 0.08
+        return self.rng.random() < leave_probability
+
+    def stat_line(self, player, games):
+        """Return the games, goals, assists and what follows from them of a season of <player>"""
+        rng = self.rng
+        gp = max(1, int(round(games * rng.betavariate(1.5 + 8 * player.talent, 1.5))))
+        if player.pos == 'D':
+            goal_rate, assist_rate = 0.02 + 0.2 * player.talent ** 1.5, 0.1 + 0.5 * player.talent ** 1.5
+        else:
+            goal_rate, assist_rate = 0.05 + 0.6 * player.talent ** 1.5, 0.07 + 0.7 * player.talent ** 1.5
+        goals = _poisson(rng, gp * goal_rate)
+        assists = _poisson(rng, gp * assist_rate)
+        shots = max(goals, int(round(goals / player.shooting))) if goals > 0 else _poisson(rng, gp * 1.2)
+        return {
+            'gp': gp, 'goals': goals, 'assists': assists, 'points': goals + assists,
+            'plus_minus': int(round(rng.gauss((player.talent - 0.3) * 30, 8) * gp / games)),
+            'pim': _poisson(rng, gp * player.pim_rate), 'ppg': _binomial(rng, goals, 0.25),
+            'ppa': _binomial(rng, assists, 0.3), 'shg': _binomial(rng, goals, 0.03),
+            'sha': _binomial(rng, assists, 0.02), 'gwg': _binomial(rng, goals, 0.15),
+            'otg': _binomial(rng, goals, 0.02), 's': shots,
+        }
+
+    def draft(self, player, teams, rounds, age):
+        """Return (year, team, round, overall) of the draft <player> was picked in at <age>, or Nones if undrafted"""
+        if self.rng.random() > 0.15 + 0.8 * player.talent:
+            return None, None, None, None
+        draft_round = min(rounds, 1 + int((1 - player.talent) * rounds * self.rng.random()))
+        overall = (draft_round - 1) * 30 + self.rng.randint(1, 30)
+        return str(player.birth_date.year + age), self.rng.choice(teams), str(draft_round), str(overall)
+
+
+
+def _nhl_season(universe, player, year, season_type):
+    line = universe.stat_line(player, _era_value(universe.game_eras, year) if season_type == '2'
+                              else universe.rng.randint(4, 26))
+    rng = universe.rng
+    tracked = year >= 1997  # Time on ice and faceoffs are only recorded from then on
+    toi_gp = int((600 if player.pos != 'D' else 900) + 600 * player.talent + rng.gauss(0, 60)) if tracked else None
+    return nhl_playerseason.PlayerSeason(
+        player.id, player.name, str(year) + str(year + 1), season_type, player.team, player.pos, line['gp'],
+        line['goals'], line['assists'], line['points'], line['plus_minus'], line['pim'],
+        round(line['points'] / line['gp'], 2), line['ppg'], line['ppg'] + line['ppa'], line['shg'],
+        line['shg'] + line['sha'], None, line['otg'], line['s'],
+        round(100 * line['goals'] / line['s'], 1) if line['s'] > 0 else None, toi_gp,
+        round(toi_gp / 45, 1) if tracked else None,
+        round(rng.gauss(48, 4), 1) if tracked and player.pos == 'C' else None)
+
+
+def _chl_season(universe, player, year, season_name, is_rookie, games):
+    line = universe.stat_line(player, games)
+    return chl_playerseason.PlayerSeason(
+        universe.league, player.id, player.num, True, is_rookie, ' ' + player.name,
+        chl_playerseason._parse_season_yr(season_name), season_name, player.team, player.pos, line['gp'],
+        line['goals'], line['assists'], line['points'], line['plus_minus'], line['pim'], line['ppg'], line['ppa'],
+        line['shg'], line['sha'], line['s'], line['gwg'], line['otg'], _binomial(universe.rng, line['goals'], 0.1),
+        _binomial(universe.rng, line['goals'], 0.1), None, None, None, None, None, None, None, None,
+        round(line['points'] / line['gp'], 2), round(line['pim'] / line['gp'], 2))
+
+
+def _nhl_page(universe, player):
+    city, state, country = player.birthplace
+    return nhl_playerpage.PlayerPage(
+        player.id, player.name, str(player.num), player.pos, player.height, player.weight, player.birth_date,
+        nhl_playerpage.Birthplace(city, state, country), player.shoots,
+        nhl_playerpage.Draft(*universe.draft(player, universe.nhl_teams, 7, 18)))
+
+
+def _chl_page(universe, player):
+    city, state, country = player.birthplace
+    nhl_draft = universe.draft(player, universe.nhl_teams, 7, 18) if universe.rng.random() < 0.5 else \
+        (None, None, None, None)
+    chl_year, chl_team, chl_round, chl_overall = universe.draft(player, universe.teams, 15, 15)
+    return chl_playerpage.PlayerPage(
+        player.id, universe.league, player.name, str(player.num), player.pos, player.height, player.weight,
+        player.birth_date, chl_playerpage.Birthplace(city, state, country), player.shoots,
+        chl_playerpage.NHL_Draft(*nhl_draft),
+        chl_playerpage.CHL_Draft(chl_year, universe.league if chl_year else None, chl_team, chl_round, chl_overall))
+
+
+def generate_universe(league, seed, universe, fraction=1.0):
+    """Generate one universe of a league and save it through the same save functions as the crawlers, a season per
+    transaction
+
+    :param league: 'NHL' | 'OHL' | 'WHL' | 'QMJHL'
+    :param seed: int
+    :param universe: int, universes of the same seed and league are independent, with ids and teams of their own
+    :param fraction: float, of the teams of the league in every season
+    :return: int, int (season rows, page rows saved)
+    """
+    conn = connect(league)
+    c = conn.cursor()
+    if league == 'NHL':
+        nhl_playerseason._ensure_player_seasons_table(c)
+        nhl_playerpage._ensure_player_pages_table(c)
+    else:
+        chl_playerseason._ensure_player_seasons_table(c)
+        chl_playerpage._ensure_player_pages_table(c)
+    generator = _Universe(league, seed, universe, fraction)
+    season_rows, page_rows = 0, 0
+    for year, teams, roster, debuts in generator.seasons():
+        playoff_teams = set(generator.rng.sample(teams, max(1, len(teams) // 2)))
+        games = _era_value(generator.game_eras, year)
+        if league == 'NHL':
+            regular = [_nhl_season(generator, player, year, '2') for player in roster]
+            playoffs = [_nhl_season(generator, player, year, '3') for player in roster
+                        if player.team in playoff_teams]
+            nhl_playerseason._save_single_player_seasons(c, regular)
+            nhl_playerseason._save_single_player_seasons(c, playoffs)
+            nhl_playerpage._save_player_pages(c, [_nhl_page(generator, player) for player in debuts])
+            season_rows += len(regular) + len(playoffs)
+        else:
+            season_name = str(year) + '-' + str(year + 1)[2:] + ' Regular Season'
+            playoff_name = str(year + 1) + ' Playoffs'
+            regular = [_chl_season(generator, player, year, season_name, player.seasons_played == 0, games)
+                       for player in roster]
+            playoffs = [_chl_season(generator, player, year, playoff_name, False, generator.rng.randint(4, 24))
+                        for player in roster if player.team in playoff_teams]
+            chl_playerseason._save_player_seasons(c, regular)
+            chl_playerseason._save_player_seasons(c, playoffs)
+            chl_playerpage._save_player_pages(c, [_chl_page(generator, player) for player in debuts])
+            season_rows += len(regular) + len(playoffs)
+        page_rows += len(debuts)
+        conn.commit()
+    conn.close()
+    return season_rows, page_rows
+
+
+def generate(scale=1.0, seed=0, leagues=None, first_universe=0):
+    """Fill the season and page tables of every league with a synthetic dataset of <scale> times the real size.
+
+    A dataset is made of whole universes plus a fraction of one, each a synthetic history of a league; the same
+    seed and scale always give the same rows.
+
+    :param scale: float
+    :param seed: int
+    :param leagues: [str] | None, defaults to every league
+    :param first_universe: int, universes already generated, to grow a dataset to a larger scale
+    :return: int, int (season rows, page rows saved)
+    """
+    start_time = time.time()
+    totals = [0, 0]
+    for universe in range(first_universe, int(math.ceil(scale))):
+        for league in leagues or SORTED_LEAGUES:
+            rows = generate_universe(league, seed, universe, min(1.0, scale - universe))
+            totals = [total + count for total, count in zip(totals, rows)]
+            mark_phase(league + ' universe ' + str(universe))
+    print(str(totals[0]) + " season rows and " + str(totals[1]) + " pages generated")
+    print("That took " + str(time.time() - start_time) + " seconds")
+    return tuple(totals)
+
+
+def _database_size():
+    """Return the bytes of every database file in DB_DIR, their WAL included"""
+    size = 0
+    for file_name in os.listdir(DB_DIR):
+        if file_name.startswith('hockey-stats') and ('.db' in file_name):
+            size += os.path.getsize(os.path.join(DB_DIR, file_name))
+    return size
+
+
+def _sample_queries(rng, samples):
+    """Return [(query name, function)] calling the read functions of the api with parameters drawn from the data"""
+    from api import readapi
+    from common.search import search_players
+
+    conn = connect('NHL')
+    nhl_ids = [row[0] for row in conn.execute(
+        'SELECT id FROM player_seasons ORDER BY random() LIMIT ?', (samples,))]
+    nhl_seasons = conn.execute(
+        "SELECT year, team FROM player_seasons WHERE season_type = '2' ORDER BY random() LIMIT ?",
+        (samples,)).fetchall()
+    conn.close()
+    conn = connect('OHL')
+    chl_seasons = conn.execute(
+        'SELECT id, season_name FROM chl_player_seasons ORDER BY random() LIMIT ?', (samples,)).fetchall()
+    conn.close()
+    queries = []
+    for i in range(samples):
+        year, team = nhl_seasons[i % len(nhl_seasons)]
+        id_, season_name = chl_seasons[i % len(chl_seasons)]
+        prefix = rng.choice(SURNAME_STARTS) + rng.choice(SURNAME_ENDS)[:2]
+        queries += [
+            ('nhl career', lambda id_=nhl_ids[i % len(nhl_ids)]: readapi.player_career(id_)),
+            ('nhl roster', lambda year=year, team=team: readapi.team_roster('NHL', team, year)),
+            ('nhl leaders', lambda year=year: readapi.season_leaders('NHL', year, rng.choice(['points', 'goals']))),
+            ('nhl season page', lambda year=year: readapi.season_table('NHL', year, '2', 50, 100)),
+            ('chl career', lambda id_=id_: readapi.player_career(id_, 'OHL')),
+            ('chl leaders', lambda season_name=season_name: readapi.season_leaders('OHL', season_name, 'points')),
+            ('name search', lambda prefix=prefix: search_players(prefix, 10)),
+        ]
+    return queries
+
+
+def _query_latencies(seed, samples):
+    """Time every sampled query once, in a thread of its own so it reads through fresh connections
+
+    :return: {str: (float, float)} query name: (p50, p95) in milliseconds
+    """
+    timings = {}
+
+    def run():
+        for name, query in _sample_queries(random.Random(seed), samples):
+            start_time = time.perf_counter()
+            query()
+            timings.setdefault(name, []).append(1000 * (time.perf_counter() - start_time))
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    latencies = {}
+    for name, values in timings.items():
+        values.sort()
+        latencies[name] = (values[len(values) // 2], values[min(len(values) - 1, int(0.95 * len(values)))])
+    return latencies
+
+
+def scale_benchmark(max_scale, seed=0, samples=50, results_path=None, first_universe=0):
+    """Grow a synthetic dataset one universe at a time up to <max_scale> and, after each, record the write throughput
+    of the universe, the size of the databases and the latency of the read api, so regressions show as the data
+    grows. Run in an empty directory, or in one holding the first <first_universe> universes of the same seed.
+
+    :param max_scale: int
+    :param seed: int
+    :param samples: int, calls timed per query at every scale
+    :param results_path: str | None, defaults to scale-benchmark.json in DB_DIR
+    :param first_universe: int, universes already generated
+    :return: [dict], one per scale
+    """
+    if first_universe == 0 and any(os.path.exists(shard_path(league)) for league in SHARDS):
+        raise ValueError('the scale benchmark generates its own data, run it in an empty directory or pass the '
+                         'universes already generated as first_universe')
+    results_path = results_path or os.path.join(DB_DIR, 'scale-benchmark.json')
+    results = []
+    for universe in range(first_universe, max_scale):
+        start_time = time.time()
+        season_rows, page_rows = generate(universe + 1, seed, first_universe=universe)
+        write_seconds = time.time() - start_time
+        latencies = _query_latencies(seed, samples)
+        results.append({
+            'scale': universe + 1, 'season_rows': season_rows, 'page_rows': page_rows,
+            'rows_per_second': (season_rows + page_rows) / write_seconds, 'database_bytes': _database_size(),
+            'latency_ms': dict((name, {'p50': p50, 'p95': p95}) for name, (p50, p95) in latencies.items()),
+        })
+        with open(results_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        mark_phase('scale ' + str(universe + 1))
+    _print_results(results)
+    return results
+
+
+def _print_results(results):
+    names = sorted(results[0]['latency_ms'])
+    print('{0:>6}{1:>12}{2:>10}'.format('scale', 'rows/s', 'MiB') +
+          ''.join('{0:>18}'.format(name) for name in names))
+    for result in results:
+        print('{0:>6}{1:>12.0f}{2:>10.1f}'.format(
+            result['scale'], result['rows_per_second'], result['database_bytes'] / 2 ** 20) +
+            ''.join('{0:>18}'.format('{0:.1f}/{1:.1f}ms'.format(
+                result['latency_ms'][name]['p50'], result['latency_ms'][name]['p95'])) for name in names))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic stats at scale, and benchmark how they scale')
+    parser.add_argument('command', choices=['generate', 'benchmark'])
+    parser.add_argument('--scale', type=float, default=1.0, help='times the size of the real tables')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--league', action='append', choices=SORTED_LEAGUES, help='only generate this league')
+    parser.add_argument('--samples', type=int, default=50, help='calls timed per query and scale (benchmark)')
+    parser.add_argument('--first-universe', type=int, default=0,
+                        help='universes already generated in this directory with the same seed, to grow the dataset')
+    parser.add_argument('--profile', action='store_true', help='profile the run, see common/profiling.py')
+    args = parser.parse_args()
+
+    with profile_run('synthetic_' + args.command, args.profile):
+        leagues = (args.league or SORTED_LEAGUES) if args.command == 'generate' else SHARDS
+        if args.first_universe == 0 and any(os.path.exists(shard_path(league)) for league in leagues):
+            parser.error('databases already exist here: pass --first-universe to grow their synthetic dataset, or '
+                         'run in a directory without databases')
+        if not 0 <= args.first_universe < math.ceil(args.scale):
+            parser.error('--first-universe must be at least 0 and below --scale')
+        if args.command == 'generate':
+            generate(args.scale, args.seed, args.league, args.first_universe)
+        else:
+            scale_benchmark(int(math.ceil(args.scale)), args.seed, args.samples, first_universe=args.first_universe)
@@ -0,0 +1,46 @@
+import os
+import time
+
+from common.db import CHL_LEAGUES, connect, shard_path
+from common.history import upgrade_history_keys
+from common.profiling import profile_run
+from chl import playerpage as chl_playerpage
+from chl import playerseason as chl_playerseason
+from nhl import playerpage as nhl_playerpage
+from nhl import playerseason as nhl_playerseason
+
+
+def upgrade_tables():
+    """Rebuild the season and page tables of every shard that were created with an older definition, moving their
+    rows over in batches, and key the chl season history by league
+
+    :return: None
+    """
+    start_time = time.time()
+    upgrades = [
+        ('NHL', nhl_playerseason._upgrade_player_seasons_table), ('NHL', nhl_playerpage._upgrade_player_pages_table)
+    ]
+    for league in CHL_LEAGUES:
+        upgrades += [
+            (league, chl_playerseason._upgrade_player_seasons_table),
+            (league, chl_playerpage._upgrade_player_pages_table)
+        ]
+    for league, upgrade_func in upgrades:
+        if not os.path.exists(shard_path(league)):
+            continue
+        conn = connect(league)
+        upgrade_func(conn)
+        conn.close()
+    for league in CHL_LEAGUES:
+        if not os.path.exists(shard_path(league)):
+            continue
+        conn = connect(league)
+        print(league + ": " + str(upgrade_history_keys(conn.cursor(), league)) + " history entries keyed by league")
+        conn.commit()
+        conn.close()
+    print("That took " + str(time.time() - start_time) + " seconds")
+
+
+if __name__ == '__main__':
+    with profile_run('upgradetables'):
+        upgrade_tables()